@@ -0,0 +1,87 @@
+"""
+Step time and activation memory of gradient checkpointing policies on a
+tiny LoRA transformer. Peak memory is reported on cuda devices.
+
+    python -m benchmarks.bench_checkpointing --policies none 0.5 all
+"""
+
+import argparse
+import json
+import torch
+from benchmarks.bench_transformer import git_commit, time_case
+from models.checkpointing import (
+    activation_bytes_per_block,
+    configure_checkpointing,
+    plan_checkpointing,
+)
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+
+
+def run(policies, model_config, resolution, text_length, batch_size, device):
+    model = PartialFluxTransformer2DModel.from_tiny_config(**model_config)
+    model.requires_grad_(False)
+    apply_lora(model, rank=16, alpha=16)
+    model.to(device).train()
+    inputs = make_inputs(
+        model, resolution, text_length, batch_size, device, torch.float32
+    )
+    block_bytes = activation_bytes_per_block(model, lambda: model(**inputs))
+    results = []
+    for policy in policies:
+        budget_bytes = None
+        if policy.startswith("auto:"):
+            # auto with a budget given as a fraction of the full activations
+            budget_bytes = int(float(policy.split(":")[1]) * sum(block_bytes))
+            indices = plan_checkpointing(block_bytes, budget_bytes)
+            configure_checkpointing(model, ",".join(map(str, indices)) or "none")
+        else:
+            indices = configure_checkpointing(model, policy)
+        if torch.device(device).type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        timings = time_case(model, inputs, warmup=1, iters=3, device=device)
+        result = {
+            "policy": policy,
+            "checkpointed_blocks": indices,
+            "kept_activation_mb": sum(
+                b for i, b in enumerate(block_bytes) if i not in indices
+            )
+            / 2**20,
+            **timings,
+        }
+        if torch.device(device).type == "cuda":
+            result["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+        print(result)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gradient checkpointing benchmarks")
+    parser.add_argument(
+        "--policies",
+        nargs="+",
+        default=["none", "double", "single", "0.5", "auto:0.5", "all"],
+        help='Policies as accepted by main.py, "auto:F" budgets a fraction F',
+    )
+    parser.add_argument("--resolution", type=int, nargs=2, default=[512, 512])
+    parser.add_argument("--text_length", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--num_single_layers", type=int, default=8)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default=f"debug/bench_ckpt_{git_commit()}.json")
+    args = parser.parse_args()
+
+    results = run(
+        args.policies,
+        {"num_layers": args.num_layers, "num_single_layers": args.num_single_layers},
+        args.resolution,
+        args.text_length,
+        args.batch_size,
+        args.device,
+    )
+    with open(args.output, "w") as f:
+        json.dump(
+            {"commit": git_commit(), "device": args.device, "results": results}, f
+        )
@@ -0,0 +1,116 @@
+"""
+Compile cost against steady state speedup of the compiled blocks on a tiny
+LoRA transformer. Run twice with the same --cache_dir to see the cost of a
+warm compile cache.
+
+    python -m benchmarks.bench_compile --resolutions 256 256 256 384 --cache_dir debug/compile_cache
+"""
+
+import argparse
+import json
+import torch
+from torch._dynamo.utils import counters
+from benchmarks.bench_transformer import git_commit, time_case
+from models.compile import (
+    compile_blocks,
+    compile_report,
+    enable_compile_cache,
+    save_compile_cache,
+    warmup_shapes,
+)
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+
+
+def run(
+    model_config,
+    resolutions,
+    text_lengths,
+    batch_size,
+    backend,
+    mode,
+    cache_dir,
+    device,
+):
+    model = PartialFluxTransformer2DModel.from_tiny_config(**model_config)
+    model.requires_grad_(False)
+    apply_lora(model, rank=16, alpha=16)
+    model.to(device).train()
+
+    def inputs_for(resolution, text_length):
+        return make_inputs(
+            model, resolution, text_length, batch_size, device, torch.float32
+        )
+
+    def run_step(inputs):
+        model(**inputs)[1].pow(2).mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    reference = inputs_for(resolutions[0], text_lengths[0])
+    eager = time_case(model, reference, warmup=1, iters=3, device=device)
+
+    if cache_dir is not None:
+        enable_compile_cache(cache_dir)
+    compile_blocks(model, backend=backend, mode=mode, num_shapes=len(resolutions))
+    seconds = warmup_shapes(
+        lambda _, latent_size: run_step(
+            inputs_for((latent_size[1] * 16, latent_size[0] * 16), text_lengths[0])
+        ),
+        [(batch_size, (height // 16, width // 16)) for width, height in resolutions],
+        device,
+    )
+    if cache_dir is not None:
+        save_compile_cache(cache_dir)
+    graphs = counters["stats"]["unique_graphs"]
+    # other caption lengths must reuse the warmed up graphs
+    for resolution in resolutions:
+        for text_length in text_lengths[1:]:
+            run_step(inputs_for(resolution, text_length))
+    compiled = time_case(model, reference, warmup=1, iters=3, device=device)
+
+    step_seconds = lambda t: (t["forward_ms"] + t["backward_ms"]) / 1000
+    report = compile_report(
+        sum(seconds.values()), step_seconds(eager), step_seconds(compiled)
+    )
+    report.update(
+        backend=backend,
+        mode=mode,
+        shapes=len(seconds),
+        recompiles_after_warmup=counters["stats"]["unique_graphs"] - graphs,
+    )
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="torch.compile benchmarks")
+    parser.add_argument(
+        "--resolutions",
+        type=int,
+        nargs="+",
+        default=[256, 256, 256, 384, 384, 256],
+        help="Flat list of width height pairs, one compiled shape each",
+    )
+    parser.add_argument("--text_lengths", type=int, nargs="+", default=[64, 77, 100])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--num_single_layers", type=int, default=4)
+    parser.add_argument("--backend", default="inductor")
+    parser.add_argument("--mode", default=None)
+    parser.add_argument("--cache_dir", default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default=f"debug/bench_compile_{git_commit()}.json")
+    args = parser.parse_args()
+
+    report = run(
+        {"num_layers": args.num_layers, "num_single_layers": args.num_single_layers},
+        [args.resolutions[i : i + 2] for i in range(0, len(args.resolutions), 2)],
+        args.text_lengths,
+        args.batch_size,
+        args.backend,
+        args.mode,
+        args.cache_dir,
+        args.device,
+    )
+    with open(args.output, "w") as f:
+        json.dump({"commit": git_commit(), "device": args.device, **report}, f)
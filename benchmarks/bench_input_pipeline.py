@@ -0,0 +1,186 @@
+"""
+Training loop throughput with the old input pipeline (no workers, blocking
+copies) against DataLoader workers, pinned memory and the device prefetcher,
+with and without gradient accumulation. Samples are serialized like a cache
+and deserialized on every read, `--read_ms` adds storage latency.
+
+    python -m benchmarks.bench_input_pipeline --device cuda --read_ms 5
+"""
+
+import argparse
+import io
+import json
+import time
+import torch
+from torch.utils.data import DataLoader, Dataset
+from benchmarks.bench_transformer import git_commit, synchronize
+from data.core_data import collate_fn, move_batch
+from data.prefetch import DevicePrefetcher
+from data.sampler import BucketBatchSampler
+from lightning_modules.noise_schedule import add_noise, build_timestep_sampler
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel
+
+
+class SerializedSamples(Dataset):
+    def __init__(self, config, latent_sizes, num_samples, text_length, read_ms=0.0):
+        self.read_ms = read_ms
+        self.latent_sizes = []
+        self.samples = []
+        for i in range(num_samples):
+            height, width = latent_sizes[i % len(latent_sizes)]
+            length = text_length - i % 8
+            feeds = {
+                "latents": torch.randn(1, height * width, config.in_channels),
+                "prompt_embeds": torch.randn(1, length, config.joint_attention_dim),
+                "pooled_prompt_embeds": torch.randn(1, config.pooled_projection_dim),
+                "text_length": torch.tensor([length]),
+                "guidance": torch.tensor([3.5]),
+            }
+            buffer = io.BytesIO()
+            torch.save(feeds, buffer)
+            self.samples.append(buffer.getvalue())
+            self.latent_sizes.append((height, width))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        if self.read_ms:
+            time.sleep(self.read_ms / 1000)
+        feeds = torch.load(io.BytesIO(self.samples[index]), weights_only=True)
+        feeds["latent_size"] = self.latent_sizes[index]
+        return feeds
+
+
+def image_ids(latent_size, device):
+    height, width = latent_size
+    ids = torch.zeros(height, width, 3, device=device)
+    ids[..., 1] = torch.arange(height, device=device)[:, None]
+    ids[..., 2] = torch.arange(width, device=device)[None, :]
+    return ids.reshape(-1, 3)
+
+
+def run_loop(
+    model,
+    dataset,
+    batch_size: int,
+    accumulation: int,
+    num_workers: int,
+    prefetch: bool,
+    device,
+    max_batches: int,
+) -> dict:
+    sampler = BucketBatchSampler(dataset.latent_sizes, batch_size=batch_size, seed=0)
+    loader = DataLoader(
+        dataset,
+        batch_sampler=sampler,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        pin_memory=prefetch and torch.device(device).type == "cuda",
+        persistent_workers=num_workers > 0,
+    )
+    timesteps = build_timestep_sampler("uniform", seed=0)
+    batches = DevicePrefetcher(loader, device) if prefetch else loader
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad])
+
+    samples, data_wait, micro_batches = 0, 0.0, 0
+    iterator = iter(batches)
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(max_batches):
+        wait_start = time.perf_counter()
+        batch = next(iterator, None)
+        data_wait += time.perf_counter() - wait_start
+        if batch is None:
+            break
+        if not prefetch:
+            batch = move_batch(batch, device)
+        feeds, _ = add_noise(batch, timesteps)
+        text_length = feeds["prompt_embeds"].shape[1]
+        _, hidden_states = model(
+            hidden_states=feeds["latents"],
+            encoder_hidden_states=feeds["prompt_embeds"],
+            pooled_projections=feeds["pooled_prompt_embeds"],
+            timestep=feeds["timestep"],
+            img_ids=image_ids(feeds["latent_size"], device),
+            txt_ids=torch.zeros(text_length, 3, device=device),
+            guidance=feeds["guidance"],
+        )
+        # the partial transformer stops before the output projection
+        loss = hidden_states.float().pow(2).mean() / accumulation
+        loss.backward()
+        samples += feeds["latents"].shape[0]
+        micro_batches += 1
+        if micro_batches % accumulation == 0:
+            optimizer.step()
+            optimizer.zero_grad()
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+    return {
+        "samples_per_sec": samples / elapsed,
+        "data_wait_ms": data_wait / micro_batches * 1000,
+        "optimizer_steps": micro_batches // accumulation,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Input pipeline benchmarks")
+    parser.add_argument("--latent_sizes", type=int, nargs="+", default=[16, 16, 16, 24])
+    parser.add_argument("--num_samples", type=int, default=96)
+    parser.add_argument("--text_length", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--accumulation", type=int, default=2)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--read_ms", type=float, default=2.0)
+    parser.add_argument("--max_batches", type=int, default=48)
+    parser.add_argument("--num_layers", type=int, default=1)
+    parser.add_argument("--num_single_layers", type=int, default=2)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument(
+        "--output", default=f"debug/bench_input_pipeline_{git_commit()}.json"
+    )
+    args = parser.parse_args()
+
+    model = PartialFluxTransformer2DModel.from_tiny_config(
+        num_layers=args.num_layers, num_single_layers=args.num_single_layers
+    )
+    model.requires_grad_(False)
+    apply_lora(model, rank=16, alpha=16)
+    model.to(args.device).train()
+    dataset = SerializedSamples(
+        model.config,
+        [args.latent_sizes[i : i + 2] for i in range(0, len(args.latent_sizes), 2)],
+        args.num_samples,
+        args.text_length,
+        args.read_ms,
+    )
+    micro_batch_size = max(args.batch_size // args.accumulation, 1)
+    cases = {
+        "baseline": (args.batch_size, 1, 0, False),
+        "prefetch": (args.batch_size, 1, args.num_workers, True),
+        f"prefetch_accumulate_{args.accumulation}": (
+            micro_batch_size,
+            args.accumulation,
+            args.num_workers,
+            True,
+        ),
+    }
+    results = {}
+    for name, (batch_size, accumulation, num_workers, prefetch) in cases.items():
+        results[name] = run_loop(
+            model,
+            dataset,
+            batch_size,
+            accumulation,
+            num_workers,
+            prefetch,
+            args.device,
+            args.max_batches,
+        )
+        print(
+            f"{name}: {results[name]['samples_per_sec']:.1f} samples/s, "
+            f"data wait {results[name]['data_wait_ms']:.1f}ms"
+        )
+    with open(args.output, "w") as f:
+        json.dump({"commit": git_commit(), "device": args.device, **results}, f)
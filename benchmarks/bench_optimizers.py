@@ -0,0 +1,94 @@
+"""
+Optimizer state memory and step time of the optimizer backends on a tiny
+LoRA transformer. Backends whose dependency is missing are skipped.
+
+    python -m benchmarks.bench_optimizers --backends adamw cpu_offload --lora_rank 64
+"""
+
+import argparse
+import json
+import time
+import torch
+from benchmarks.bench_transformer import git_commit, synchronize
+from lightning_modules.optimizers import (
+    OPTIMIZER_BACKENDS,
+    build_optimizer,
+    format_memory,
+    optimizer_memory,
+    synchronize_optimizer,
+)
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+
+
+def time_steps(model, optimizer, inputs, warmup: int, iters: int, device) -> float:
+    step_times = []
+    for i in range(warmup + iters):
+        synchronize(device)
+        start = time.perf_counter()
+        _, hidden_states = model(**inputs)
+        hidden_states.float().pow(2).mean().backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        synchronize(device)
+        if i >= warmup:
+            step_times.append(time.perf_counter() - start)
+    synchronize_optimizer(optimizer)
+    return sorted(step_times)[len(step_times) // 2] * 1000
+
+
+def run(backends, model_config, resolution, text_length, lora_rank, device, iters):
+    results = []
+    for backend in backends:
+        model = PartialFluxTransformer2DModel.from_tiny_config(**model_config)
+        model.requires_grad_(False)
+        apply_lora(model, rank=lora_rank, alpha=lora_rank)
+        model.to(device).train()
+        params = [p for p in model.parameters() if p.requires_grad]
+        try:
+            optimizer = build_optimizer(params, backend=backend)
+        except ImportError as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+        if hasattr(optimizer, "train"):
+            optimizer.train()
+        inputs = make_inputs(model, resolution, text_length, 1, device, torch.float32)
+        step_ms = time_steps(model, optimizer, inputs, 1, iters, device)
+        memory = optimizer_memory(optimizer)
+        result = {
+            "backend": backend,
+            "trainable_params": sum(p.numel() for p in params),
+            "state_bytes": memory,
+            "step_ms": step_ms,
+        }
+        print(f"{backend}: {format_memory(memory)}, step {step_ms:.1f}ms")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimizer backend benchmarks")
+    parser.add_argument(
+        "--backends", nargs="+", default=list(OPTIMIZER_BACKENDS), help="Backends"
+    )
+    parser.add_argument("--resolution", type=int, nargs=2, default=[256, 256])
+    parser.add_argument("--text_length", type=int, default=64)
+    parser.add_argument("--lora_rank", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default=f"debug/bench_optim_{git_commit()}.json")
+    args = parser.parse_args()
+
+    results = run(
+        args.backends,
+        {},
+        args.resolution,
+        args.text_length,
+        args.lora_rank,
+        args.device,
+        args.iters,
+    )
+    with open(args.output, "w") as f:
+        json.dump(
+            {"commit": git_commit(), "device": args.device, "results": results}, f
+        )
@@ -0,0 +1,82 @@
+"""
+Weight memory, peak memory and step time of LoRA training on a quantized
+frozen base transformer against the bf16 baseline.
+
+    python -m benchmarks.bench_quantization --weights qint8 qfloat8
+"""
+
+import argparse
+import json
+import torch
+from benchmarks.bench_transformer import git_commit, time_case
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+from models.quantization import quantize_base_weights, state_dict_bytes
+
+
+def build_model(model_config: dict, weights: str, lora_rank: int, device, dtype):
+    model = PartialFluxTransformer2DModel.from_tiny_config(**model_config)
+    model.requires_grad_(False)
+    apply_lora(model, rank=lora_rank, alpha=lora_rank)
+    model.to(device)
+    model.to(dtype)
+    if weights != "bf16":
+        quantize_base_weights(model, weights=weights)
+    return model.train()
+
+
+def run(
+    weights_list, model_config, resolution, text_length, batch_size, lora_rank, device
+):
+    dtype = torch.bfloat16
+    results = []
+    reference = None
+    for weights in ["bf16"] + list(weights_list):
+        model = build_model(model_config, weights, lora_rank, device, dtype)
+        torch.manual_seed(0)
+        inputs = make_inputs(model, resolution, text_length, batch_size, device, dtype)
+        with torch.no_grad():
+            output = model(**inputs)[1].float()
+        reference = output if reference is None else reference
+        if torch.device(device).type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        timings = time_case(model, inputs, warmup=1, iters=3, device=device)
+        result = {
+            "weights": weights,
+            "weight_mb": state_dict_bytes(model) / 2**20,
+            **timings,
+            "output_rel_error": ((output - reference).norm() / reference.norm()).item(),
+        }
+        if torch.device(device).type == "cuda":
+            result["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+        print(result)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantized base benchmarks")
+    parser.add_argument(
+        "--weights", nargs="+", default=["qint8", "qfloat8"], help="qint8 qfloat8 qint4"
+    )
+    parser.add_argument("--resolution", type=int, nargs=2, default=[256, 256])
+    parser.add_argument("--text_length", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--lora_rank", type=int, default=16)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default=f"debug/bench_quant_{git_commit()}.json")
+    args = parser.parse_args()
+
+    results = run(
+        args.weights,
+        {},
+        args.resolution,
+        args.text_length,
+        args.batch_size,
+        args.lora_rank,
+        args.device,
+    )
+    with open(args.output, "w") as f:
+        json.dump(
+            {"commit": git_commit(), "device": args.device, "results": results}, f
+        )
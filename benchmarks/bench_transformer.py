@@ -0,0 +1,195 @@
+"""
+Forward/backward microbenchmarks of tiny randomly initialized Flux
+transformers. Runs without a GPU and without network access.
+
+    python -m benchmarks.bench_transformer --output debug/bench.json
+    python -m benchmarks.bench_transformer --compare debug/old.json debug/new.json
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+import torch
+from models.lora import apply_lora
+from models.partial_flux_transformer import (
+    TINY_FLUX_CONFIG,
+    PartialFluxTransformer2DModel,
+    make_inputs,
+)
+
+DEFAULT_GRID = {
+    "resolutions": [[256, 256], [512, 512], [512, 768]],
+    "text_lengths": [64, 256],
+    "batch_sizes": [1, 2],
+    "lora_ranks": [0, 16],
+    "gradient_checkpointing": [False, True],
+}
+
+
+def git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def build_model(model_config: dict, lora_rank: int, gradient_checkpointing: bool):
+    model = PartialFluxTransformer2DModel.from_tiny_config(**model_config)
+    if lora_rank > 0:
+        model.requires_grad_(False)
+        apply_lora(model, rank=lora_rank, alpha=lora_rank)
+    if gradient_checkpointing:
+        model.enable_gradient_checkpointing()
+    return model
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_case(model, inputs: dict, warmup: int, iters: int, device) -> dict:
+    forward_times, backward_times = [], []
+    for i in range(warmup + iters):
+        synchronize(device)
+        start = time.perf_counter()
+        _, hidden_states = model(**inputs)
+        loss = hidden_states.float().pow(2).mean()
+        synchronize(device)
+        forward_end = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        backward_end = time.perf_counter()
+        model.zero_grad(set_to_none=True)
+        if i >= warmup:
+            forward_times.append(forward_end - start)
+            backward_times.append(backward_end - forward_end)
+    forward = sorted(forward_times)[len(forward_times) // 2]
+    backward = sorted(backward_times)[len(backward_times) // 2]
+    return {"forward_ms": forward * 1000, "backward_ms": backward * 1000}
+
+
+def run(grid: dict, model_config: dict, warmup: int, iters: int, device, dtype):
+    results = []
+    cases = itertools.product(
+        grid["lora_ranks"],
+        grid["gradient_checkpointing"],
+        grid["resolutions"],
+        grid["text_lengths"],
+        grid["batch_sizes"],
+    )
+    model_key, model = None, None
+    for lora_rank, checkpointing, resolution, text_length, batch_size in cases:
+        if model_key != (lora_rank, checkpointing):
+            model_key = (lora_rank, checkpointing)
+            model = build_model(model_config, lora_rank, checkpointing)
+            model.to(device).train()
+            if dtype != torch.float32:
+                model.to(dtype)
+        inputs = make_inputs(model, resolution, text_length, batch_size, device, dtype)
+        timings = time_case(model, inputs, warmup, iters, device)
+        step_seconds = (timings["forward_ms"] + timings["backward_ms"]) / 1000
+        image_tokens = inputs["hidden_states"].shape[1]
+        result = {
+            "resolution": list(resolution),
+            "text_length": text_length,
+            "batch_size": batch_size,
+            "lora_rank": lora_rank,
+            "gradient_checkpointing": checkpointing,
+            "image_tokens": image_tokens,
+            **timings,
+            "samples_per_sec": batch_size / step_seconds,
+            "tokens_per_sec": batch_size * (image_tokens + text_length) / step_seconds,
+        }
+        print(
+            f"{resolution[0]}x{resolution[1]} txt={text_length} bs={batch_size} "
+            f"rank={lora_rank} ckpt={checkpointing}: fwd {timings['forward_ms']:.1f}ms "
+            f"bwd {timings['backward_ms']:.1f}ms"
+        )
+        results.append(result)
+    return results
+
+
+def case_key(result: dict) -> tuple:
+    return (
+        tuple(result["resolution"]),
+        result["text_length"],
+        result["batch_size"],
+        result["lora_rank"],
+        result["gradient_checkpointing"],
+    )
+
+
+def compare(baseline_file: str, candidate_file: str):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(candidate_file) as f:
+        candidate = json.load(f)
+    baseline_results = {case_key(r): r for r in baseline["results"]}
+    print(f"{baseline['commit']} -> {candidate['commit']}")
+    for result in candidate["results"]:
+        old = baseline_results.get(case_key(result))
+        if old is None:
+            continue
+        old_ms = old["forward_ms"] + old["backward_ms"]
+        new_ms = result["forward_ms"] + result["backward_ms"]
+        print(
+            f"{case_key(result)}: {old_ms:.1f}ms -> {new_ms:.1f}ms ({old_ms / new_ms:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiny Flux transformer benchmarks")
+    parser.add_argument("--config", help="JSON file overriding the grid and model")
+    parser.add_argument("--output", default=f"debug/bench_{git_commit()}.json")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        raise SystemExit(0)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    grid, model_config = dict(DEFAULT_GRID), {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        model_config = config.pop("model", {})
+        grid.update(config)
+
+    results = run(
+        grid,
+        model_config,
+        args.warmup,
+        args.iters,
+        args.device,
+        getattr(torch, args.dtype),
+    )
+    report = {
+        "commit": git_commit(),
+        "torch": torch.__version__,
+        "device": args.device,
+        "dtype": args.dtype,
+        "threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "model": {**TINY_FLUX_CONFIG, **model_config},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
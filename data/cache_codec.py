@@ -0,0 +1,149 @@
+"""
+Scaled int8 / fp8 storage of cached latents and text embeddings.
+
+Each quantized tensor is stored next to a `<name>_scale` tensor in its
+original dtype. Latents and prompt embeddings get one scale per channel
+(last dim), pooled embeddings one per sample. The report compares a
+full precision cache against its quantized encodings.
+
+    python -m data.cache_codec --cache_dir debug/test_cache --format int8 fp8
+"""
+
+import argparse
+import json
+import tempfile
+import numpy as np
+import torch
+from typing import Dict
+
+STORAGE_FORMATS = {"int8": torch.int8, "fp8": torch.float8_e4m3fn}
+QUANTIZED_KEYS = ("latents", "prompt_embeds", "pooled_prompt_embeds")
+SCALE_SUFFIX = "_scale"
+
+
+def qmax(storage_format: str) -> float:
+    if storage_format == "int8":
+        return 127.0
+    return torch.finfo(STORAGE_FORMATS[storage_format]).max
+
+
+def quantize(tensor: torch.Tensor, storage_format: str):
+    """
+    Returns the quantized tensor and its scale, `tensor ~= q * scale`.
+    """
+    x = tensor.float()
+    dims = tuple(range(1, x.ndim - 1)) if x.ndim > 2 else (x.ndim - 1,)
+    amax = x.abs().amax(dim=dims, keepdim=True)
+    scale = amax.clamp(min=torch.finfo(torch.float32).tiny) / qmax(storage_format)
+    q = x / scale
+    if storage_format == "int8":
+        q = q.round().clamp(-127, 127)
+    return q.to(STORAGE_FORMATS[storage_format]), scale.to(tensor.dtype)
+
+
+def dequantize(q: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    return (q.float() * scale.float()).to(scale.dtype)
+
+
+def encode_tensors(tensors: Dict[str, torch.Tensor], storage_format: str = None):
+    if storage_format is None:
+        return tensors
+    encoded = dict(tensors)
+    for name in QUANTIZED_KEYS:
+        if name in encoded:
+            encoded[name], encoded[name + SCALE_SUFFIX] = quantize(
+                encoded[name], storage_format
+            )
+    return encoded
+
+
+def decode_tensors(tensors: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """
+    Dequantizes every tensor stored with a scale. Works on single samples
+    and on collated batches, on any device.
+    """
+    decoded = dict(tensors)
+    for name in QUANTIZED_KEYS:
+        scale = decoded.pop(name + SCALE_SUFFIX, None)
+        if scale is not None:
+            decoded[name] = dequantize(decoded[name], scale)
+    return decoded
+
+
+def tensor_bytes(tensors: Dict[str, torch.Tensor]) -> int:
+    return sum(
+        t.numel() * t.element_size() for t in tensors.values() if torch.is_tensor(t)
+    )
+
+
+def reconstruction_report(samples, storage_formats, cache_flux=None) -> dict:
+    """
+    Size and relative L2 / max abs error of each quantized tensor, averaged
+    over `samples`. With a `CacheFlux`, latents are also decoded by the VAE
+    and compared as images (PSNR in dB).
+    """
+    report = {}
+    for storage_format in storage_formats:
+        errors, raw_bytes, stored_bytes = {}, 0, 0
+        for feeds in samples:
+            encoded = encode_tensors(feeds, storage_format)
+            decoded = decode_tensors(encoded)
+            raw_bytes += tensor_bytes(feeds)
+            stored_bytes += tensor_bytes(encoded)
+            for name in QUANTIZED_KEYS:
+                if name not in feeds:
+                    continue
+                reference, value = feeds[name].float(), decoded[name].float()
+                rel = ((value - reference).norm() / reference.norm()).item()
+                errors.setdefault(f"{name}_rel_l2", []).append(rel)
+                errors.setdefault(f"{name}_max_abs", []).append(
+                    (value - reference).abs().max().item()
+                )
+            if cache_flux is not None and "latent_size" in feeds:
+                errors.setdefault("image_psnr", []).append(
+                    image_psnr(cache_flux, feeds, decoded)
+                )
+        report[storage_format] = {
+            "compression": raw_bytes / stored_bytes,
+            **{name: sum(v) / len(v) for name, v in errors.items()},
+        }
+    return report
+
+
+def image_psnr(cache_flux, reference: dict, decoded: dict) -> float:
+    latent_height, latent_width = reference["latent_size"]
+    # one cell of the packed latent grid covers vae_scale_factor pixels
+    height = latent_height * cache_flux.vae_scale_factor
+    width = latent_width * cache_flux.vae_scale_factor
+    pixels = [
+        torch.from_numpy(
+            np.asarray(cache_flux.decode_from_latent(feeds["latents"], height, width))
+        ).float()
+        for feeds in (reference, decoded)
+    ]
+    mse = (pixels[0] - pixels[1]).pow(2).mean().item()
+    return 10 * torch.log10(torch.tensor(255.0**2 / max(mse, 1e-10))).item()
+
+
+if __name__ == "__main__":
+    from data.core_data import CoreCachedDataset
+
+    parser = argparse.ArgumentParser(description="Cache quantization error report")
+    parser.add_argument("--cache_dir", default="debug/test_cache")
+    parser.add_argument("--format", nargs="+", default=["int8", "fp8"])
+    parser.add_argument("--num_samples", type=int, default=16)
+    parser.add_argument(
+        "--decode", action="store_true", help="Also compare VAE decoded images"
+    )
+    args = parser.parse_args()
+
+    dataset = CoreCachedDataset(args.cache_dir)
+    samples = [dataset[i] for i in range(min(args.num_samples, len(dataset)))]
+    cache_flux = None
+    if args.decode:
+        from data.cache_data import CacheFlux
+
+        # only the vae is used, keep the writers away from the cache
+        cache_flux = CacheFlux(save_dir=tempfile.mkdtemp(), torch_dtype=torch.bfloat16)
+    report = reconstruction_report(samples, args.format, cache_flux)
+    print(json.dumps(report, indent=2))
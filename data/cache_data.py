@@ -2,8 +2,12 @@ import torch
 import transformers
 import diffusers
 from data.core_data import CoreDataset
+from data.shard_cache import ShardWriter, ShardedCacheReader
+from data.text_cache import TEXT_SUBDIR, text_key
+from data.cache_codec import STORAGE_FORMATS, encode_tensors
 from PIL import Image
 import os
+from typing import List
 from diffusers.image_processor import VaeImageProcessor
 
 
@@ -13,8 +17,23 @@ class CacheFlux:
         pretrained_path: str = "black-forest-labs/FLUX.1-dev",
         save_dir: str = "data/cache",
         torch_dtype: torch.dtype = torch.float32,
+        cache_format: str = "sharded",
+        shard_size: int = 1 << 30,
+        incremental: bool = True,
+        storage_format: str = None,
+        device: str = "cuda",
     ):
+        """
+        With `incremental`, samples already in `save_dir` (including those of
+        an interrupted run) are kept and only new keys need encoding, see
+        `is_cached` and `retain`. `storage_format` ("int8" or "fp8") stores
+        latents and embeddings quantized, see `data/cache_codec.py`.
+        """
+        assert cache_format in ("sharded", "pt"), cache_format
+        assert storage_format in (None, *STORAGE_FORMATS), storage_format
+        self.storage_format = storage_format
         self.save_dir = save_dir
+        self.cache_format = cache_format
         self.guidance_scale = 3.5
         self.pretrained_path = pretrained_path
         self.pipeline = diffusers.FluxPipeline.from_pretrained(
@@ -26,41 +45,58 @@ class CacheFlux:
         )
         self.vae_scale_factor = 2 ** (len(self.pipeline.vae.config.block_out_channels))
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor)
-        self.device = "cuda"
+        self.device = device
         self.pipeline.to(self.device)
         self.torch_dtype = torch_dtype
         os.makedirs(save_dir, exist_ok=True)
+        self.writer = (
+            ShardWriter(save_dir, shard_size=shard_size, resume=incremental)
+            if cache_format == "sharded"
+            else None
+        )
+        self.max_sequence_length = 256
+        self.text_settings = {
+            "pretrained_path": pretrained_path,
+            "max_sequence_length": self.max_sequence_length,
+            "dtype": str(torch_dtype),
+            "trim_padding": True,
+            "storage_format": storage_format,
+        }
+        # everything that changes the cached tensors, part of every cache key
+        self.encoder_settings = {
+            "pretrained_path": pretrained_path,
+            "dtype": str(torch_dtype),
+            "guidance_scale": self.guidance_scale,
+            "storage_format": storage_format,
+            "text": self.text_settings,
+        }
+        # prompt embeddings are stored once per caption and referenced by key
+        self.text_writer = ShardWriter(
+            os.path.join(save_dir, TEXT_SUBDIR),
+            shard_size=shard_size,
+            resume=incremental,
+        )
+        self.text_keys = set(self.text_writer.keys())
 
     @torch.no_grad()
     def __call__(self, image: Image.Image, prompt: str, filename: str):
-        height, width = image.size
-        (
-            prompt_embeds,
-            pooled_prompt_embeds,
-            text_ids,
-        ) = self.pipeline.encode_prompt(
-            prompt=prompt,
-            prompt_2=prompt,
-            device=self.device,
-            num_images_per_prompt=1,
-            max_sequence_length=256,
-        )
+        feeds = self.encode_batch([image], [prompt])[0]
+        self.write(feeds, filename)
+
+    @torch.no_grad()
+    def encode_batch(self, images: List[Image.Image], prompts: List[str]):
+        """
+        Encodes a batch of images sharing one bucket size and their prompts.
+        Returns one feeds dict per sample, already moved to the cpu.
+        """
+        width, height = images[0].size
+        assert all(image.size == (width, height) for image in images)
+        batch_size = len(images)
+        keys = [text_key(prompt, self.text_settings) for prompt in prompts]
+        text_embeds = self.encode_new_prompts(keys, prompts)
 
         num_channels_latents = self.transformer_config.in_channels // 4
-        noise_latents, latent_image_ids = self.pipeline.prepare_latents(
-            batch_size=1,
-            num_channels_latents=num_channels_latents,
-            height=height,
-            width=width,
-            dtype=prompt_embeds.dtype,
-            device=self.device,
-            generator=None,
-            latents=None,
-        )
-        print(noise_latents.shape)
-        latents = self.image_processor.preprocess(
-            image,
-        )
+        latents = self.image_processor.preprocess(images)
         latents = latents.to(self.device, self.torch_dtype)
         latents = self.pipeline.vae.encode(latents).latent_dist.sample()
         latents = (
@@ -69,34 +105,133 @@ class CacheFlux:
 
         height = 2 * (int(height) // self.vae_scale_factor)
         width = 2 * (int(width) // self.vae_scale_factor)
-        print(height, width)
         latents = self.pipeline._pack_latents(
             latents,
-            batch_size=1,
+            batch_size=batch_size,
             num_channels_latents=num_channels_latents,
             height=height,
             width=width,
         )
-        assert latents.shape == noise_latents.shape
-        guidance = (
-            torch.tensor([self.guidance_scale]).to(self.torch_dtype).to(self.device)
+        latents = latents.to(self.torch_dtype).cpu()
+
+        batch = []
+        for i, key in enumerate(keys):
+            # position ids and guidance are rebuilt from these at load time
+            feeds = {
+                "latents": latents[i : i + 1].clone(),
+                "latent_size": [height // 2, width // 2],
+                "guidance_scale": self.guidance_scale,
+                "text_key": key,
+            }
+            # the first sample referencing a new caption carries its embeddings
+            if key in text_embeds:
+                feeds["text_embeds"] = text_embeds.pop(key)
+            batch.append(feeds)
+        return batch
+
+    @torch.no_grad()
+    def encode_new_prompts(self, keys: List[str], prompts: List[str]):
+        """
+        Encodes each caption not seen before exactly once.
+        """
+        new_prompts = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in self.text_keys and key not in new_prompts:
+                new_prompts[key] = prompt
+        if not new_prompts:
+            return {}
+        prompt_embeds, pooled_prompt_embeds, _ = self.pipeline.encode_prompt(
+            prompt=list(new_prompts.values()),
+            prompt_2=list(new_prompts.values()),
+            device=self.device,
+            num_images_per_prompt=1,
+            max_sequence_length=self.max_sequence_length,
+        )
+        text_lengths = self.text_lengths(list(new_prompts.values()))
+        prompt_embeds = prompt_embeds.to(self.torch_dtype).cpu()
+        pooled_prompt_embeds = pooled_prompt_embeds.to(self.torch_dtype).cpu()
+        self.text_keys.update(new_prompts)
+        # T5 padding is dropped here and re-added per batch by collate_fn
+        return {
+            key: {
+                "prompt_embeds": prompt_embeds[i : i + 1, :length].clone(),
+                "pooled_prompt_embeds": pooled_prompt_embeds[i : i + 1].clone(),
+                "text_length": length,
+            }
+            for i, (key, length) in enumerate(zip(new_prompts, text_lengths))
+        }
+
+    def text_lengths(self, prompts: List[str]) -> List[int]:
+        """
+        Number of real (non padding) T5 tokens of each prompt, including EOS.
+        """
+        text_inputs = self.pipeline.tokenizer_2(
+            prompts,
+            padding="max_length",
+            max_length=self.max_sequence_length,
+            truncation=True,
+            return_tensors="pt",
         )
+        return text_inputs.attention_mask.sum(dim=1).tolist()
+
+    def write(self, feeds: dict, filename: str):
+        feeds = dict(feeds)
+        text_embeds = feeds.pop("text_embeds", None)
+        if text_embeds is not None:
+            text_embeds = dict(text_embeds)
+            meta = {"text_length": text_embeds.pop("text_length")}
+            text_embeds = encode_tensors(text_embeds, self.storage_format)
+            self.text_writer.add(feeds["text_key"], text_embeds, meta)
+        feeds = encode_tensors(feeds, self.storage_format)
+        if self.writer is not None:
+            tensors = {k: v for k, v in feeds.items() if isinstance(v, torch.Tensor)}
+            meta = {k: v for k, v in feeds.items() if k not in tensors}
+            self.writer.add(filename, tensors, meta)
+        else:
+            torch.save(feeds, os.path.join(self.save_dir, f"{filename}.pt"))
+
+    def is_cached(self, filename: str) -> bool:
+        if self.writer is not None:
+            return filename in self.writer
+        return os.path.exists(os.path.join(self.save_dir, f"{filename}.pt"))
 
-        feeds = {
-            "latents": latents.to(self.torch_dtype).cpu(),
-            "pooled_prompt_embeds": pooled_prompt_embeds.to(self.torch_dtype).cpu(),
-            "prompt_embeds": prompt_embeds.to(self.torch_dtype).cpu(),
-            "text_ids": text_ids.to(self.torch_dtype).cpu(),
-            "latent_image_ids": latent_image_ids.to(self.torch_dtype).cpu(),
-            "guidance": guidance.to(self.torch_dtype).cpu(),
+    def retain(self, filenames) -> int:
+        """
+        Drops cached samples not in `filenames` and the prompt embeddings no
+        remaining sample references. Returns the number of dropped samples.
+        """
+        filenames = set(filenames)
+        if self.writer is None:
+            stale = [
+                name
+                for name in os.listdir(self.save_dir)
+                if name.endswith(".pt") and name[: -len(".pt")] not in filenames
+            ]
+            for name in stale:
+                os.remove(os.path.join(self.save_dir, name))
+            return len(stale)
+        dropped = self.writer.retain(filenames)
+        text_keys = {
+            self.writer.meta(key).get("text_key") for key in self.writer.keys()
         }
+        self.text_writer.retain(text_keys)
+        self.text_keys &= text_keys
+        return dropped
 
-        torch.save(feeds, os.path.join(self.save_dir, f"{filename}.pt"))
+    def close(self):
+        """
+        Finalizes the shard indexes. Must be called once caching is done.
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.text_writer.close()
 
     @torch.no_grad()
     def decode_from_latent(self, latents: torch.Tensor, height, width):
+        # `vae_scale_factor` includes the 2x2 packing, `_unpack_latents`
+        # expects the compression of the VAE alone and adds the packing itself
         latents = self.pipeline._unpack_latents(
-            latents, height, width, self.vae_scale_factor
+            latents, height, width, self.vae_scale_factor // 2
         )
         latents = latents.to(self.device)
         latents = (
@@ -116,9 +251,10 @@ if __name__ == "__main__":
             metadata_file="dataset/itay_test/metadata.json",
         )
         image, caption = dataset[0]
-        height, width = image.size
+        width, height = image.size
         image.save("debug/image_2.jpg")
         cache_flux(image, caption, "image")
-        feeds = torch.load("data/cache/image.pt")
+        cache_flux.close()
+        feeds = ShardedCacheReader("debug/cache")[0]
         image = cache_flux.decode_from_latent(feeds["latents"], height, width)
         image.save("debug/image_2_reconstructed.jpg")
@@ -0,0 +1,239 @@
+import threading
+import queue
+import time
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from data.image_decode import iter_decoded
+
+
+class StageMeter:
+    """
+    Accumulates busy time and processed images of one pipeline stage.
+    """
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.images = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, images: int, seconds: float):
+        with self._lock:
+            self.images += images
+            self.seconds += seconds
+
+    @property
+    def images_per_sec(self) -> float:
+        busy = self.seconds / self.workers
+        return self.images / busy if busy > 0 else 0.0
+
+    def __repr__(self):
+        return f"{self.name}: {self.images_per_sec:.2f} img/s ({self.images} images, {self.seconds:.1f}s busy)"
+
+
+class CacheEngine:
+    """
+    Caches a `CoreDataset` with three overlapping stages:
+    image decode/resize in a thread or process pool, batched text + VAE encoding grouped
+    by bucket size, and background writes through `CacheFlux.write`.
+
+    Datasets with a `cache_key` method are cached incrementally: samples are
+    keyed by the content hash of image, caption and encoder settings, keys
+    already in the cache are skipped without decoding, and cached samples no
+    longer in the dataset are dropped at the end of the run.
+    """
+
+    def __init__(
+        self,
+        cache_flux,
+        batch_size: int = 8,
+        num_workers: int = 8,
+        prefetch: int = 64,
+        write_queue_size: int = 64,
+        key_fn: Callable[[int], str] = None,
+        decode_processes: bool = False,
+    ):
+        self.cache_flux = cache_flux
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.write_queue_size = write_queue_size
+        self.key_fn = key_fn
+        self.decode_processes = decode_processes
+        self.meters = {
+            "decode": StageMeter("decode", workers=num_workers),
+            "encode": StageMeter("encode"),
+            "write": StageMeter("write"),
+        }
+
+    def _iter_decoded(self, dataset: Dataset, indices: List[int]):
+        for index, image, caption, seconds in iter_decoded(
+            dataset,
+            indices,
+            num_workers=self.num_workers,
+            prefetch=self.prefetch,
+            processes=self.decode_processes,
+        ):
+            self.meters["decode"].add(1, seconds)
+            yield index, image, caption
+
+    def _writer_loop(self, write_queue: queue.Queue, errors: list):
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if errors:
+                continue
+            keys, feeds = item
+            start = time.perf_counter()
+            try:
+                for key, sample in zip(keys, feeds):
+                    self.cache_flux.write(sample, key)
+            except Exception as e:
+                errors.append(e)
+            self.meters["write"].add(len(keys), time.perf_counter() - start)
+
+    def _encode(self, batch: list, keys: List[str], write_queue: queue.Queue):
+        indices, images, captions = zip(*batch)
+        start = time.perf_counter()
+        feeds = self.cache_flux.encode_batch(list(images), list(captions))
+        self.meters["encode"].add(len(batch), time.perf_counter() - start)
+        write_queue.put(([keys[index] for index in indices], feeds))
+
+    def _keys(self, dataset: Dataset, indices: Sequence[int]) -> Dict[int, str]:
+        if self.key_fn is not None:
+            return {index: self.key_fn(index) for index in indices}
+        if hasattr(dataset, "cache_key"):
+            settings = self.cache_flux.encoder_settings
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                keys = executor.map(
+                    lambda index: dataset.cache_key(index, settings), indices
+                )
+                return dict(zip(indices, keys))
+        return {index: f"{index:08d}" for index in indices}
+
+    def _pending(self, keys: Dict[int, str]) -> List[int]:
+        """
+        First index of every key that is not cached yet.
+        """
+        is_cached = getattr(self.cache_flux, "is_cached", lambda key: False)
+        pending = {}
+        for index, key in keys.items():
+            if key not in pending and not is_cached(key):
+                pending[key] = index
+        return list(pending.values())
+
+    @torch.no_grad()
+    def run(
+        self, dataset: Dataset, indices: Sequence[int] = None
+    ) -> Dict[str, StageMeter]:
+        """
+        Caches `indices` of `dataset`, all of it by default. Cached samples
+        outside of `indices` are dropped as stale.
+        """
+        write_queue = queue.Queue(maxsize=self.write_queue_size)
+        errors = []
+        writer = threading.Thread(
+            target=self._writer_loop, args=(write_queue, errors), daemon=True
+        )
+        writer.start()
+
+        start = time.perf_counter()
+        if indices is None:
+            indices = range(len(dataset))
+        keys = self._keys(dataset, list(indices))
+        pending = self._pending(keys)
+        buckets = defaultdict(list)
+        pbar = tqdm(desc="Caching", total=len(pending))
+        try:
+            for index, image, caption in self._iter_decoded(dataset, pending):
+                bucket = buckets[image.size]
+                bucket.append((index, image, caption))
+                if len(bucket) >= self.batch_size:
+                    self._encode(bucket, keys, write_queue)
+                    pbar.update(len(bucket))
+                    buckets[image.size] = []
+                if errors:
+                    break
+            for bucket in buckets.values():
+                if bucket and not errors:
+                    self._encode(bucket, keys, write_queue)
+                    pbar.update(len(bucket))
+        finally:
+            write_queue.put(None)
+            writer.join()
+            pbar.close()
+        if errors:
+            # written samples are journaled, a rerun resumes from here
+            raise errors[0]
+        dropped = 0
+        if hasattr(self.cache_flux, "retain"):
+            dropped = self.cache_flux.retain(keys.values())
+        self.cache_flux.close()
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Cached {len(pending)} new images in {elapsed:.1f}s, "
+            f"{len(set(keys.values())) - len(pending)} unchanged, {dropped} stale dropped"
+        )
+        for meter in self.meters.values():
+            print(meter)
+        return self.meters
+
+
+if __name__ == "__main__":
+    from data.core_data import CoreDataset
+    from data.cache_data import CacheFlux
+
+    parser = argparse.ArgumentParser(description="Batched dataset caching")
+    parser.add_argument("--metadata_file", default="dataset/itay_test/metadata.json")
+    parser.add_argument("--root_folder", default="dataset/itay_test/images")
+    parser.add_argument("--save_dir", default="debug/test_cache")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument(
+        "--decode_processes",
+        action="store_true",
+        help="Decode images in worker processes instead of threads",
+    )
+    parser.add_argument(
+        "--resized_cache_dir",
+        default=None,
+        help="Keep resized images here so later runs skip full-size decoding",
+    )
+    parser.add_argument(
+        "--storage_format",
+        default=None,
+        choices=["int8", "fp8"],
+        help="Store latents and embeddings quantized with per-channel scales",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Re-encode everything instead of updating the existing cache",
+    )
+    args = parser.parse_args()
+
+    dataset = CoreDataset(
+        root_folder=args.root_folder,
+        metadata_file=args.metadata_file,
+        resized_cache_dir=args.resized_cache_dir,
+    )
+    cache_flux = CacheFlux(
+        save_dir=args.save_dir,
+        torch_dtype=torch.bfloat16,
+        incremental=not args.rebuild,
+        storage_format=args.storage_format,
+    )
+    CacheEngine(
+        cache_flux,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        decode_processes=args.decode_processes,
+    ).run(dataset)
@@ -1,21 +1,26 @@
 from torch.utils.data import Dataset
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 import torch
 import json
 import glob
-import random
+import hashlib
 import os
+import tempfile
+import numpy as np
 from PIL import Image
+from data.shard_cache import ShardedCacheReader
+from data.text_cache import TextEmbeddingStore
+from data.hashing import content_hash
+from data.cache_codec import decode_tensors
 
 
-class CoreDataset(Dataset):
-    def __init__(self, metadata_file: str, root_folder: str):
-        with open(metadata_file, "r") as f:
-            self.metadata = json.load(f)
-        self.root_folder = root_folder
-        self.bucket_config = self._init_bucket()
+class AspectBuckets:
+    """
+    Bucket sizes around `base_size` pixels by aspect ratio, and the nearest
+    bucket of an image size.
+    """
 
-    def _init_bucket(
+    def __init__(
         self,
         base_size: int = 1024,
         min_size: int = 512,
@@ -41,68 +46,278 @@ class CoreDataset(Dataset):
         for width in widths:
             for height in heights:
                 res = (width * height) ** -2
-                if not (base_res * 8 < res < base_res * 1.1):
+                if not (base_res / 1.1 < res < base_res * 8):
                     continue
                 ratio = width / height
                 sizes[ratio] = (width, height)
         print(f"Initialized {len(sizes)} bucket sizes")
-        for k, v in sizes:
+        for k, v in sizes.items():
             print(f"Bucket ratio: {k} size: {v}")
-        return sizes
+        self.sizes = sizes
+        # sorted ratios and the midpoints between neighbours, for searchsorted
+        self._ratios = np.array(sorted(sizes))
+        self._edges = (self._ratios[1:] + self._ratios[:-1]) / 2
+
+    def nearest_buckets(
+        self, widths: Sequence[int], heights: Sequence[int]
+    ) -> List[Tuple[int, int]]:
+        ratios = np.asarray(widths, dtype=np.float64) / np.asarray(heights)
+        positions = np.searchsorted(self._edges, ratios, side="left")
+        return [self.sizes[r] for r in self._ratios[positions].tolist()]
+
+    def nearest_bucket(self, width: int, height: int) -> Tuple[int, int]:
+        return self.nearest_buckets([width], [height])[0]
+
+
+def resize_to_bucket(
+    image: Image.Image, bucket_size: Tuple[int, int], draft: bool = True
+) -> Image.Image:
+    """
+    Decodes an opened image and resizes it to `bucket_size`. JPEGs are
+    decoded at a reduced scale first when `draft` is set.
+    """
+    if draft and image.format == "JPEG":
+        # decodes at 1/2, 1/4 or 1/8 scale, never below the bucket size
+        image.draft("RGB", bucket_size)
+    image = image.convert("RGB")
+    # reducing_gap first shrinks by an integer factor with a box filter
+    return image.resize(bucket_size, Image.BICUBIC, reducing_gap=3.0)
+
+
+class CoreDataset(Dataset):
+    """
+    Images resized to the nearest aspect ratio bucket, with their captions.
+
+    JPEGs are decoded at a reduced scale (`Image.draft`) when the bucket is
+    at most half the source size, which skips most of the IDCT work on large
+    photos. With `resized_cache_dir`, resized images are stored as PNG keyed
+    by source path, mtime, size and bucket, and reused on later passes.
+    """
+
+    def __init__(
+        self,
+        metadata_file: str,
+        root_folder: str,
+        resized_cache_dir: str = None,
+        draft: bool = True,
+    ):
+        with open(metadata_file, "r") as f:
+            self.metadata = json.load(f)
+        self.root_folder = root_folder
+        self.resized_cache_dir = resized_cache_dir
+        self.draft = draft
+        if resized_cache_dir is not None:
+            os.makedirs(resized_cache_dir, exist_ok=True)
+        self.buckets = AspectBuckets()
+        self.bucket_config = self.buckets.sizes
 
     def __len__(self):
         return len(self.metadata)
 
+    def image_path(self, index) -> str:
+        return os.path.join(self.root_folder, self.metadata[index]["image_path"])
+
+    def nearest_buckets(
+        self, widths: Sequence[int], heights: Sequence[int]
+    ) -> List[Tuple[int, int]]:
+        return self.buckets.nearest_buckets(widths, heights)
+
+    def nearest_bucket(self, width: int, height: int) -> Tuple[int, int]:
+        return self.buckets.nearest_bucket(width, height)
+
+    def resized_cache_path(self, index, bucket_size: Tuple[int, int]) -> str:
+        image_path = self.image_path(index)
+        stat = os.stat(image_path)
+        key = f"{os.path.abspath(image_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+        key = f"{key}:{bucket_size[0]}x{bucket_size[1]}"
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.resized_cache_dir, name[:2], f"{name}.png")
+
+    def load_image(self, index) -> Image.Image:
+        """
+        Decodes and resizes image `index` to its bucket size.
+        """
+        with Image.open(self.image_path(index)) as image:
+            bucket_size = self.nearest_bucket(*image.size)
+            cache_path = None
+            if self.resized_cache_dir is not None:
+                cache_path = self.resized_cache_path(index, bucket_size)
+                if os.path.exists(cache_path):
+                    with Image.open(cache_path) as cached:
+                        return cached.convert("RGB")
+            image = resize_to_bucket(image, bucket_size, self.draft)
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format="PNG", compress_level=1)
+            os.replace(tmp_path, cache_path)
+        return image
+
+    def cache_key(self, index, settings: dict) -> str:
+        """
+        Content hash of the image file, caption, bucket size and encoder
+        `settings`. Only the image header is read to find the bucket.
+        """
+        image_path = self.image_path(index)
+        with Image.open(image_path) as image:
+            bucket_size = self.nearest_bucket(*image.size)
+        return content_hash(
+            image_path,
+            self.metadata[index]["caption"],
+            {**settings, "bucket_size": list(bucket_size)},
+        )
+
     def __getitem__(self, index):
-        metadata = self.metadata[index]
-        caption = metadata["caption"]
-        image_path = metadata["image_path"]
-        image_path = os.path.join(self.root_folder, image_path)
-        image = Image.open(image_path).convert("RGB")
-        width, height = image.size
-        ratio = width / height
-        # select nearest bucket size
-        bucket_ratio = min(self.bucket_config.keys(), key=lambda x: abs(x - ratio))
-        bucket_size = self.bucket_config[bucket_ratio]
-        image = image.resize(bucket_size)
-        return image, caption
+        return self.load_image(index), self.metadata[index]["caption"]
 
 
 class CoreCachedDataset(Dataset):
-    def __init__(self, cached_folder: str, max_len: int = 512):
-        self.cached_files = glob.glob(f"{cached_folder}/*.pt")
+    def __init__(
+        self,
+        cached_folder: str,
+        max_len: int = 512,
+        text_cache_size: int = 1024,
+        dequantize_on: str = "dataset",
+    ):
+        """
+        Quantized caches are dequantized in `__getitem__` with
+        `dequantize_on="dataset"`, or kept quantized through collation and
+        dequantized by `move_batch` with `dequantize_on="device"`.
+        """
+        assert dequantize_on in ("dataset", "device"), dequantize_on
+        self.dequantize_on = dequantize_on
+        if ShardedCacheReader.exists(cached_folder):
+            self.reader = ShardedCacheReader(cached_folder)
+            self.cached_files = None
+        else:
+            self.reader = None
+            self.cached_files = glob.glob(f"{cached_folder}/*.pt")
+        self.text_store = (
+            TextEmbeddingStore(cached_folder, capacity=text_cache_size)
+            if TextEmbeddingStore.exists(cached_folder)
+            else None
+        )
         self.max_len = max_len
-        self.max_step = 1000
 
     def __len__(self):
+        if self.reader is not None:
+            return len(self.reader)
         return len(self.cached_files)
 
-    def add_noise(self, latent: torch.Tensor, dtype: torch.dtype):
-        sigma = random.random()
-        noise = torch.randn_like(latent).to(dtype)
-        noised_latent = (1 - sigma) * latent + sigma * noise
-        return noised_latent, sigma, noise
+    def load(self, index) -> dict:
+        if self.reader is not None:
+            feeds = self.reader[index]
+            meta = self.reader.meta(index)
+        else:
+            feeds = torch.load(self.cached_files[index])
+            meta = {
+                k: feeds.pop(k) for k in list(feeds) if not torch.is_tensor(feeds[k])
+            }
+        key = meta.get("text_key")
+        if key is not None:
+            feeds.update(self.text_store[key])
+        if "text_length" not in feeds:
+            feeds["text_length"] = torch.tensor([feeds["prompt_embeds"].shape[1]])
+        # position ids are rebuilt on the training device from the sizes
+        feeds.pop("text_ids", None)
+        latent_image_ids = feeds.pop("latent_image_ids", None)
+        if "latent_size" in meta:
+            feeds["latent_size"] = tuple(meta["latent_size"])
+        elif latent_image_ids is not None:
+            # caches written before the sizes were stored
+            feeds["latent_size"] = tuple(int(i) + 1 for i in latent_image_ids[-1, 1:])
+        if "guidance" not in feeds:
+            feeds["guidance"] = torch.tensor([meta.get("guidance_scale", 3.5)])
+        if self.dequantize_on == "dataset":
+            feeds = decode_tensors(feeds)
+        return feeds
+
+    def bucket_key(self, index) -> tuple:
+        """
+        Samples with equal keys can be batched together.
+        """
+        if self.reader is not None:
+            latent_size = self.reader.meta(index).get("latent_size")
+            if latent_size is not None:
+                return tuple(latent_size)
+        return sample_bucket_key(self.load(index))
+
+    def token_counts(self, index) -> Tuple[int, int]:
+        """
+        (image tokens, text tokens) of a sample, without loading sharded
+        tensors.
+        """
+        if self.reader is not None:
+            image_tokens = self.reader.shape(index, "latents")[1]
+            key = self.reader.meta(index).get("text_key")
+            if key is not None:
+                return image_tokens, self.text_store.text_length(key)
+        feeds = self.load(index)
+        return feeds["latents"].shape[1], int(feeds["text_length"])
 
     def __getitem__(self, index):
-        cached_file = self.cached_files[index]
-        feeds = torch.load(cached_file)
-        latent = feeds["latents"]
-        dtype = latent.dtype
-        noised_latent, sigma, noise = self.add_noise(latent, dtype)
-        feeds["timestep"] = torch.Tensor([sigma])
-        feeds["latents"] = noised_latent
-        step = int(sigma * self.max_step)
-        target = noise - latent
-        metadata = {
-            "step": step,
-            "sigma": sigma,
-        }
-
-        return feeds, target, metadata
-
-
-def collate_fn(batch):
-    feeds, targets, metadata = zip(*batch)
-    feeds = {k: torch.cat([f[k] for f in feeds], dim=0) for k in feeds[0]}
-    targets = torch.cat(targets, dim=0)
-    return feeds, targets, metadata
+        # noising happens batched on the training device, see
+        # lightning_modules/noise_schedule.py
+        return self.load(index)
+
+
+def sample_bucket_key(feeds: dict) -> tuple:
+    """
+    The latent grid of a sample. Transposed grids hold as many tokens, so the
+    latents shape alone only keys caches written before the sizes were
+    stored.
+    """
+    if "latent_size" in feeds:
+        return tuple(feeds["latent_size"])
+    return tuple(feeds["latents"].shape)
+
+
+# identical for every sample of a bucket
+SHARED_KEYS = ("latent_size",)
+TEXT_KEYS = ("prompt_embeds", "text_length")
+
+
+def pad_text(feeds) -> dict:
+    """
+    Pads trimmed prompt embeddings to the longest caption of the batch and
+    builds the matching attention mask.
+    """
+    lengths = torch.cat([f["text_length"] for f in feeds])
+    max_length = int(lengths.max())
+    first = feeds[0]["prompt_embeds"]
+    prompt_embeds = first.new_zeros(len(feeds), max_length, first.shape[-1])
+    for i, f in enumerate(feeds):
+        length = int(f["text_length"])
+        prompt_embeds[i, :length] = f["prompt_embeds"][0, :length]
+    return {
+        "prompt_embeds": prompt_embeds,
+        "text_attention_mask": torch.arange(max_length)[None] < lengths[:, None],
+    }
+
+
+def collate_fn(feeds):
+    for k in SHARED_KEYS:
+        if k in feeds[0]:
+            values = {tuple(f[k]) for f in feeds}
+            assert len(values) == 1, f"a batch mixes {k} {sorted(values)}"
+    collated = {
+        k: feeds[0][k] if k in SHARED_KEYS else torch.cat([f[k] for f in feeds], dim=0)
+        for k in feeds[0]
+        if k not in TEXT_KEYS
+    }
+    collated.update(pad_text(feeds))
+    return collated
+
+
+def move_batch(batch: dict, device, non_blocking: bool = False) -> dict:
+    """
+    Moves the tensors of a collated batch, sizes stay on the host. Quantized
+    tensors are dequantized after the copy. `non_blocking` copies only
+    overlap with compute from pinned memory.
+    """
+    batch = {
+        k: v.to(device, non_blocking=non_blocking) if torch.is_tensor(v) else v
+        for k, v in batch.items()
+    }
+    return decode_tensors(batch)
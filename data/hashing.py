@@ -0,0 +1,17 @@
+import hashlib
+import json
+from typing import Dict
+
+
+def content_hash(path: str, caption: str, settings: Dict, chunk_size: int = 1 << 20):
+    """
+    Cache key of an image file with its caption under the given encoder
+    settings. Any change to the file bytes, caption or settings changes it.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    payload = json.dumps({"caption": caption, **settings}, sort_keys=True)
+    digest.update(payload.encode("utf-8"))
+    return digest.hexdigest()
@@ -0,0 +1,305 @@
+"""
+Parallel cache builds over several devices or CPU process pools.
+
+The dataset is split into `num_parts` disjoint parts. Every part is cached
+by its own process, on its own device, into its own incremental cache under
+`<save_dir>/parts/part-XXX-of-YYY` with the usual `CacheEngine` pipeline.
+Once all parts are done their indexes are merged into `<save_dir>`, which
+`CoreCachedDataset` reads like a single process cache; shard files stay
+where the parts wrote them.
+
+A part that fails leaves its journal behind and can be rerun alone with
+`--parts`, which resumes from the samples it already wrote.
+
+    python -m data.parallel_cache --devices cuda:0 cuda:1 cuda:2 cuda:3
+    python -m data.parallel_cache --devices cpu cpu --parts 1
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Sequence
+import torch
+from torch.utils.data import Dataset
+from data.shard_cache import INDEX_FILE, JOURNAL_FILE
+from data.text_cache import TEXT_SUBDIR
+
+PARTS_SUBDIR = "parts"
+PART_PATTERN = "part-{:03d}-of-{:03d}"
+# written by a part once its index is final
+STATUS_FILE = "part.json"
+
+
+def part_dir(save_dir: str, part: int, num_parts: int) -> str:
+    return os.path.join(save_dir, PARTS_SUBDIR, PART_PATTERN.format(part, num_parts))
+
+
+def part_indices(dataset: Dataset, part: int, num_parts: int) -> List[int]:
+    """
+    Indices of `dataset` cached by `part`. Samples with an `image_path` in
+    their metadata are assigned by its hash, so they stay in their part when
+    the metadata is reordered or extended; other datasets are split round
+    robin.
+    """
+    metadata = getattr(dataset, "metadata", None)
+    if metadata is None:
+        return list(range(part, len(dataset), num_parts))
+    indices = []
+    for index, item in enumerate(metadata):
+        digest = hashlib.sha1(item["image_path"].encode("utf-8")).digest()
+        if int.from_bytes(digest[:8], "big") % num_parts == part:
+            indices.append(index)
+    return indices
+
+
+def cache_part(
+    part: int,
+    num_parts: int,
+    save_dir: str,
+    device: str,
+    dataset_fn: Callable[[], Dataset],
+    cache_flux_fn: Callable[..., object],
+    engine_kwargs: Dict = None,
+    num_threads: int = None,
+) -> dict:
+    """
+    Caches one part with `cache_flux_fn(save_dir=..., device=...)` and
+    records its status. Runs in the launched process.
+    """
+    from data.cache_engine import CacheEngine
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if device.startswith("cuda"):
+        torch.cuda.set_device(torch.device(device))
+    directory = part_dir(save_dir, part, num_parts)
+    status_path = os.path.join(directory, STATUS_FILE)
+    if os.path.exists(status_path):
+        os.remove(status_path)
+
+    start = time.perf_counter()
+    dataset = dataset_fn()
+    indices = part_indices(dataset, part, num_parts)
+    cache_flux = cache_flux_fn(save_dir=directory, device=device)
+    meters = CacheEngine(cache_flux, **(engine_kwargs or {})).run(dataset, indices)
+    status = {
+        "part": part,
+        "num_parts": num_parts,
+        "device": device,
+        "samples": len(indices),
+        "encoded": meters["encode"].images,
+        "seconds": time.perf_counter() - start,
+    }
+    with open(status_path, "w") as f:
+        json.dump(status, f)
+    return status
+
+
+def launch(
+    save_dir: str,
+    devices: Sequence[str],
+    dataset_fn: Callable[[], Dataset],
+    cache_flux_fn: Callable[..., object],
+    num_parts: int = None,
+    parts: Sequence[int] = None,
+    engine_kwargs: Dict = None,
+) -> Dict[int, int]:
+    """
+    Caches `parts` (all of them by default) of a `num_parts` split, one
+    process per entry of `devices` at a time. A device may be listed more
+    than once, e.g. several `cpu` processes, which then share the cores.
+    Returns the exit code of every part.
+    """
+    num_parts = num_parts or len(devices)
+    pending = list(range(num_parts) if parts is None else parts)
+    cpu_processes = sum(device == "cpu" for device in devices)
+    num_threads = max(os.cpu_count() // cpu_processes, 1) if cpu_processes else None
+    context = multiprocessing.get_context("spawn")
+    running = {}
+    free = list(devices)
+    exit_codes = {}
+    while pending or running:
+        while pending and free:
+            part, device = pending.pop(0), free.pop(0)
+            process = context.Process(
+                target=cache_part,
+                args=(part, num_parts, save_dir, device, dataset_fn, cache_flux_fn),
+                kwargs={
+                    "engine_kwargs": engine_kwargs,
+                    "num_threads": num_threads if device == "cpu" else None,
+                },
+                name=PART_PATTERN.format(part, num_parts),
+            )
+            process.start()
+            running[process.sentinel] = (part, device, process)
+            print(f"Started part {part} of {num_parts} on {device}")
+        for sentinel in wait(list(running)):
+            part, device, process = running.pop(sentinel)
+            process.join()
+            exit_codes[part] = process.exitcode
+            free.append(device)
+            if process.exitcode != 0:
+                print(f"Part {part} failed with exit code {process.exitcode}")
+    return exit_codes
+
+
+def part_status(save_dir: str, num_parts: int) -> Dict[int, dict]:
+    """
+    Status of every finished part, parts still to be (re)run are missing.
+    """
+    statuses = {}
+    for part in range(num_parts):
+        path = os.path.join(part_dir(save_dir, part, num_parts), STATUS_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                statuses[part] = json.load(f)
+    return statuses
+
+
+def _merge_indexes(merged_dir: str, source_dirs: List[str]) -> int:
+    """
+    Writes one index over the shards of several `ShardWriter` indexes,
+    shard paths are made relative to `merged_dir`. A key cached by more than
+    one part (identical content at several paths) is kept once.
+    """
+    shards, samples, seen = [], [], set()
+    for source_dir in source_dirs:
+        with open(os.path.join(source_dir, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        prefix = os.path.relpath(source_dir, merged_dir)
+        first_shard = len(shards)
+        shards.extend(os.path.join(prefix, name) for name in index["shards"])
+        for sample in index["samples"]:
+            if sample["key"] in seen:
+                continue
+            seen.add(sample["key"])
+            for entry in sample["tensors"].values():
+                entry["shard"] += first_shard
+            samples.append(sample)
+    os.makedirs(merged_dir, exist_ok=True)
+    merged = {"version": 1, "shards": shards, "samples": samples}
+    tmp_path = os.path.join(merged_dir, INDEX_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(merged, f)
+    os.replace(tmp_path, os.path.join(merged_dir, INDEX_FILE))
+    return len(samples)
+
+
+def merge_parts(save_dir: str, num_parts: int) -> int:
+    """
+    Merges the sample and prompt embedding indexes of all parts into
+    `save_dir`. Returns the number of samples, raises if a part has not
+    finished.
+    """
+    statuses = part_status(save_dir, num_parts)
+    missing = sorted(set(range(num_parts)) - set(statuses))
+    if missing:
+        raise RuntimeError(
+            f"Parts {missing} of {num_parts} are not finished, rerun them with "
+            f"--parts {' '.join(map(str, missing))}"
+        )
+    directories = [part_dir(save_dir, part, num_parts) for part in range(num_parts)]
+    # a single process cache written to `save_dir` before is replaced
+    journal = os.path.join(save_dir, JOURNAL_FILE)
+    if os.path.exists(journal):
+        os.remove(journal)
+    count = _merge_indexes(save_dir, directories)
+    _merge_indexes(
+        os.path.join(save_dir, TEXT_SUBDIR),
+        [os.path.join(directory, TEXT_SUBDIR) for directory in directories],
+    )
+    return count
+
+
+def report(statuses: Dict[int, dict], wall_seconds: float) -> str:
+    lines = [
+        f"part {part} on {s['device']}: {s['encoded']} encoded of {s['samples']}, "
+        f"{s['encoded'] / max(s['seconds'], 1e-9):.2f} img/s"
+        for part, s in sorted(statuses.items())
+    ]
+    encoded = sum(s["encoded"] for s in statuses.values())
+    lines.append(
+        f"{encoded} images in {wall_seconds:.1f}s, "
+        f"{encoded / max(wall_seconds, 1e-9):.2f} img/s overall"
+    )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from data.core_data import CoreDataset
+    from data.cache_data import CacheFlux
+
+    parser = argparse.ArgumentParser(description="Parallel dataset caching")
+    parser.add_argument("--metadata_file", default="dataset/itay_test/metadata.json")
+    parser.add_argument("--root_folder", default="dataset/itay_test/images")
+    parser.add_argument("--save_dir", default="debug/test_cache")
+    parser.add_argument(
+        "--devices",
+        nargs="+",
+        default=["cuda:0"],
+        help="One process per entry, e.g. cuda:0 cuda:1 or cpu cpu cpu",
+    )
+    parser.add_argument(
+        "--num_parts",
+        type=int,
+        default=None,
+        help="Dataset parts, defaults to one per device. Keep it fixed "
+        "between runs, samples move between parts when it changes",
+    )
+    parser.add_argument(
+        "--parts", type=int, nargs="+", default=None, help="Only (re)run these parts"
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="Decode threads per process"
+    )
+    parser.add_argument("--resized_cache_dir", default=None)
+    parser.add_argument(
+        "--storage_format",
+        default=None,
+        choices=["int8", "fp8"],
+        help="Store latents and embeddings quantized with per-channel scales",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Re-encode everything instead of updating the existing parts",
+    )
+    args = parser.parse_args()
+
+    num_parts = args.num_parts or len(args.devices)
+    start = time.perf_counter()
+    exit_codes = launch(
+        args.save_dir,
+        args.devices,
+        functools.partial(
+            CoreDataset,
+            metadata_file=args.metadata_file,
+            root_folder=args.root_folder,
+            resized_cache_dir=args.resized_cache_dir,
+        ),
+        functools.partial(
+            CacheFlux,
+            torch_dtype=torch.bfloat16,
+            incremental=not args.rebuild,
+            storage_format=args.storage_format,
+        ),
+        num_parts=num_parts,
+        parts=args.parts,
+        engine_kwargs={"batch_size": args.batch_size, "num_workers": args.num_workers},
+    )
+    wall_seconds = time.perf_counter() - start
+    statuses = part_status(args.save_dir, num_parts)
+    print(report({p: s for p, s in statuses.items() if p in exit_codes}, wall_seconds))
+    failed = sorted(part for part, code in exit_codes.items() if code != 0)
+    if failed:
+        raise SystemExit(
+            f"Parts {failed} failed, rerun them with --parts {' '.join(map(str, failed))}"
+        )
+    count = merge_parts(args.save_dir, num_parts)
+    print(f"Merged {num_parts} parts, {count} samples in {args.save_dir}")
@@ -0,0 +1,86 @@
+"""
+Overlapped host to device copies of training batches.
+
+`DevicePrefetcher` wraps a DataLoader and stages batch n + 1 on the device
+while batch n is trained on. On CUDA the copy runs from pinned memory on a
+side stream, quantized caches are dequantized there as well, and the
+compute stream only waits on the event of the batch it is handed. Elsewhere
+batches are moved synchronously, as `move_batch` does.
+
+With a `StepProfiler` the copies are timed as its "h2d" phase, on the side
+stream with CUDA events. The compute stream waits for them on the device,
+so they do not show up in the host timed "data_wait".
+"""
+
+import contextlib
+import torch
+from data.core_data import move_batch
+
+
+def pin_batch(batch: dict) -> dict:
+    return {
+        k: v.pin_memory() if torch.is_tensor(v) and not v.is_pinned() else v
+        for k, v in batch.items()
+    }
+
+
+class DevicePrefetcher:
+    """
+    Iterates over the batches of `loader` already moved to `device`. Batches
+    the DataLoader did not pin (`pin_memory=False`) are pinned here first.
+    """
+
+    def __init__(self, loader, device, profiler=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.profiler = profiler
+        self.stream = None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _timed(self):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase("h2d")
+
+    def _stage(self, batch: dict):
+        if self.stream is None:
+            with self._timed():
+                return move_batch(batch, self.device), None
+        # wait for the compute stream, it may still use memory the caching
+        # allocator hands out to this copy
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            # the events of the phase are recorded on the side stream
+            with self._timed():
+                batch = move_batch(pin_batch(batch), self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, ready
+
+    def _hand_over(self, batch: dict, ready) -> dict:
+        if ready is None:
+            return batch
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(ready)
+        for value in batch.values():
+            if torch.is_tensor(value):
+                # allocated on the side stream, freed after use on this one
+                value.record_stream(current)
+        return batch
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        batch = next(iterator, None)
+        if batch is None:
+            return
+        staged = self._stage(batch)
+        while staged is not None:
+            batch = next(iterator, None)
+            # the next copy is queued before the current batch is handed out
+            following = self._stage(batch) if batch is not None else None
+            yield self._hand_over(*staged)
+            staged = following
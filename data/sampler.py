@@ -0,0 +1,148 @@
+import random
+from collections import defaultdict
+from typing import Hashable, List, Sequence, Tuple
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yields batches whose samples share one bucket key (e.g. the latent shape),
+    so they can be stacked without padding. Samples are shuffled within each
+    bucket and the resulting batches are shuffled across buckets.
+    """
+
+    def __init__(
+        self,
+        bucket_keys: Sequence[Hashable],
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+    ):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+        self.buckets = defaultdict(list)
+        for index, key in enumerate(bucket_keys):
+            self.buckets[key].append(index)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def resume(self, epoch: int, start_batch: int):
+        """
+        Makes the next iteration replay `epoch` starting at batch `start_batch`.
+        """
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def split_bucket(self, indices: List[int]) -> List[List[int]]:
+        batches = []
+        for start in range(0, len(indices), self.batch_size):
+            batch = indices[start : start + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                continue
+            batches.append(batch)
+        return batches
+
+    def batches(self) -> List[List[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for indices in self.buckets.values():
+            indices = list(indices)
+            if self.shuffle:
+                rng.shuffle(indices)
+            batches.extend(self.split_bucket(indices))
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def mean_batch_size(self) -> float:
+        batches = self.batches()
+        return sum(len(batch) for batch in batches) / max(len(batches), 1)
+
+    def __iter__(self):
+        batches = self.batches()[self.start_batch :]
+        self.start_batch = 0
+        self.epoch += 1
+        yield from batches
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(v) // self.batch_size for v in self.buckets.values())
+        return sum(-(-len(v) // self.batch_size) for v in self.buckets.values())
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    """
+    Bucketed batches sized to a per-step token budget instead of a fixed
+    batch size. Samples are added to a batch while
+    `batch_size * (image_tokens + longest_text_tokens) <= token_budget`,
+    text being padded to the longest caption of the batch. Small buckets
+    therefore get larger batches than large ones.
+    """
+
+    def __init__(
+        self,
+        bucket_keys: Sequence[Hashable],
+        sample_tokens: Sequence[Tuple[int, int]],
+        token_budget: int,
+        max_batch_size: int = None,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+    ):
+        super().__init__(
+            bucket_keys, batch_size=1, shuffle=shuffle, drop_last=drop_last, seed=seed
+        )
+        self.sample_tokens = sample_tokens
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+
+    def split_bucket(self, indices):
+        batches, batch = [], []
+        image_tokens, text_tokens = 0, 0
+        for index in indices:
+            image, text = self.sample_tokens[index]
+            tokens = (len(batch) + 1) * (
+                max(image_tokens, image) + max(text_tokens, text)
+            )
+            full = self.max_batch_size is not None and len(batch) == self.max_batch_size
+            if batch and (tokens > self.token_budget or full):
+                batches.append(batch)
+                batch, image_tokens, text_tokens = [], 0, 0
+            # a sample over budget still gets a batch of its own
+            batch.append(index)
+            image_tokens = max(image_tokens, image)
+            text_tokens = max(text_tokens, text)
+        if batch:
+            # the trailing batch of a bucket is dropped when another sample fits
+            if not (self.drop_last and self._fits_more(batch)):
+                batches.append(batch)
+        return batches
+
+    def _fits_more(self, batch) -> bool:
+        if self.max_batch_size is not None and len(batch) >= self.max_batch_size:
+            return False
+        image = max(self.sample_tokens[i][0] for i in batch)
+        text = max(self.sample_tokens[i][1] for i in batch)
+        return (len(batch) + 1) * (image + text) <= self.token_budget
+
+    def __len__(self):
+        # batch boundaries depend on the shuffled order of text lengths
+        return len(self.batches())
+
+
+def resume_loader(loader, sampler: BucketBatchSampler, epoch: int, start_batch: int):
+    """
+    Makes the next iteration of `loader` replay `epoch` of `sampler` from
+    `start_batch`. Loaders that set the epoch on every iteration, such as
+    accelerate's prepared DataLoader, are moved to `epoch` too, otherwise
+    they would reset the sampler to their own iteration count.
+    """
+    if hasattr(loader, "set_epoch"):
+        loader.set_epoch(epoch)
+    sampler.resume(epoch, start_batch)
@@ -0,0 +1,311 @@
+import torch
+import json
+import mmap
+import os
+import glob
+import argparse
+import shutil
+from typing import Dict, List
+
+INDEX_FILE = "index.json"
+# appended after every sample so an interrupted run can be resumed
+JOURNAL_FILE = "index.journal"
+SHARD_PATTERN = "shard-{:05d}.bin"
+ALIGNMENT = 64
+
+
+def dtype_to_str(dtype: torch.dtype) -> str:
+    return str(dtype).replace("torch.", "")
+
+
+def str_to_dtype(name: str) -> torch.dtype:
+    return getattr(torch, name)
+
+
+def tensor_to_bytes(tensor: torch.Tensor) -> memoryview:
+    tensor = tensor.detach().cpu().contiguous()
+    return memoryview(tensor.reshape(-1).view(torch.uint8).numpy())
+
+
+class ShardWriter:
+    """
+    Writes cached samples into a few large contiguous shard files plus a single
+    index recording the shard, byte offset, dtype and shape of every tensor.
+
+    Every sample is also appended to a journal once its bytes are in the
+    shard, so with `resume=True` a writer picks up the samples of a previous
+    run, finished (index) or interrupted (journal), and only appends new
+    shards. Adding an existing key replaces the sample.
+
+    Without `resume` the previous cache is rebuilt next to itself: new shards
+    never reuse the names of old ones, and the old shards are deleted only
+    once the new index is in place, so an interrupted rebuild leaves the
+    previous cache readable.
+    """
+
+    def __init__(self, save_dir: str, shard_size: int = 1 << 30, resume: bool = False):
+        self.save_dir = save_dir
+        self.shard_size = shard_size
+        self.shards: List[str] = []
+        self.samples: List[Dict] = []
+        self._positions: Dict[str, int] = {}
+        self._file = None
+        self._offset = 0
+        os.makedirs(save_dir, exist_ok=True)
+        journal_path = os.path.join(save_dir, JOURNAL_FILE)
+        # shards of the cache being rebuilt, deleted once the new index is in
+        self._replaced_shards: List[str] = []
+        shards, samples = self._read_existing(journal_path)
+        if resume:
+            self.shards = shards
+            for sample in samples:
+                self._record(sample)
+        else:
+            self._replaced_shards = shards
+        self._journal = open(journal_path, "a" if resume else "w")
+
+    def _read_existing(self, journal_path: str):
+        """
+        Shard names and samples of the index and journal left in `save_dir`.
+        """
+        shards, samples = [], []
+        index_path = os.path.join(self.save_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            shards = list(index["shards"])
+            samples = list(index["samples"])
+        if os.path.exists(journal_path):
+            with open(journal_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn last line of a crashed run
+                        break
+                    if "shard" in entry:
+                        shards.append(entry["shard"])
+                    else:
+                        samples.append(entry)
+        return shards, samples
+
+    def _record(self, sample: Dict):
+        position = self._positions.get(sample["key"])
+        if position is None:
+            self._positions[sample["key"]] = len(self.samples)
+            self.samples.append(sample)
+        else:
+            self.samples[position] = sample
+
+    def _log(self, entry: Dict):
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._file.close()
+        number = len(self.shards)
+        # never reuse the file of a shard that earlier runs may reference
+        while (
+            SHARD_PATTERN.format(number) in self.shards
+            or SHARD_PATTERN.format(number) in self._replaced_shards
+        ):
+            number += 1
+        name = SHARD_PATTERN.format(number)
+        self.shards.append(name)
+        self._log({"shard": name})
+        self._file = open(os.path.join(self.save_dir, name), "wb")
+        self._offset = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def keys(self) -> List[str]:
+        return [sample["key"] for sample in self.samples]
+
+    def meta(self, key: str) -> Dict:
+        return self.samples[self._positions[key]].get("meta", {})
+
+    def add(self, key: str, tensors: Dict[str, torch.Tensor], meta: Dict = None):
+        if self._file is None or self._offset >= self.shard_size:
+            self._open_shard()
+        entries = {}
+        for name, tensor in tensors.items():
+            data = tensor_to_bytes(tensor)
+            padding = -self._offset % ALIGNMENT
+            if padding:
+                self._file.write(b"\0" * padding)
+                self._offset += padding
+            entries[name] = {
+                "shard": len(self.shards) - 1,
+                "offset": self._offset,
+                "dtype": dtype_to_str(tensor.dtype),
+                "shape": list(tensor.shape),
+            }
+            self._file.write(data)
+            self._offset += data.nbytes
+        sample = {"key": key, "tensors": entries}
+        if meta:
+            sample["meta"] = meta
+        self._file.flush()
+        self._log(sample)
+        self._record(sample)
+
+    def retain(self, keys) -> int:
+        """
+        Drops every sample whose key is not in `keys`, returns how many were
+        dropped. Shards left without samples are deleted on `close`.
+        """
+        keys = set(keys)
+        kept = [sample for sample in self.samples if sample["key"] in keys]
+        dropped = len(self.samples) - len(kept)
+        self.samples = []
+        self._positions = {}
+        for sample in kept:
+            self._record(sample)
+        return dropped
+
+    def _drop_unused_shards(self):
+        used = sorted(
+            {
+                entry["shard"]
+                for sample in self.samples
+                for entry in sample["tensors"].values()
+            }
+        )
+        for number, name in enumerate(self.shards):
+            path = os.path.join(self.save_dir, name)
+            if number not in used and os.path.exists(path):
+                os.remove(path)
+        renumber = {old: new for new, old in enumerate(used)}
+        for sample in self.samples:
+            for entry in sample["tensors"].values():
+                entry["shard"] = renumber[entry["shard"]]
+        self.shards = [self.shards[number] for number in used]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._drop_unused_shards()
+        index = {"version": 1, "shards": self.shards, "samples": self.samples}
+        tmp_path = os.path.join(self.save_dir, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.save_dir, INDEX_FILE))
+        for name in self._replaced_shards:
+            path = os.path.join(self.save_dir, name)
+            # shards of other writers referenced by a merged index stay
+            if os.path.dirname(name) or name in self.shards:
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+        self._replaced_shards = []
+        # the index now holds everything the journal recorded
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            os.remove(os.path.join(self.save_dir, JOURNAL_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardedCacheReader:
+    """
+    Reads samples written by `ShardWriter`. Shards are memory mapped lazily in
+    each process and tensors are returned as zero-copy views of the mapping.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.samples = index["samples"]
+        self._maps = {}
+        self._key_to_index = None
+
+    @staticmethod
+    def exists(cache_dir: str) -> bool:
+        return os.path.exists(os.path.join(cache_dir, INDEX_FILE))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getstate__(self):
+        # mmaps are reopened lazily in DataLoader workers
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def _get_map(self, shard: int) -> mmap.mmap:
+        if shard not in self._maps:
+            with open(os.path.join(self.cache_dir, self.shards[shard]), "rb") as f:
+                # copy-on-write keeps the buffer writable for torch.frombuffer
+                # without ever touching the file
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._maps[shard]
+
+    def key(self, index: int) -> str:
+        return self.samples[index]["key"]
+
+    def find(self, key: str) -> int:
+        if self._key_to_index is None:
+            self._key_to_index = {s["key"]: i for i, s in enumerate(self.samples)}
+        return self._key_to_index[key]
+
+    def meta(self, index: int) -> Dict:
+        return self.samples[index].get("meta", {})
+
+    def shape(self, index: int, name: str) -> List[int]:
+        return self.samples[index]["tensors"][name]["shape"]
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        tensors = {}
+        for name, entry in self.samples[index]["tensors"].items():
+            dtype = str_to_dtype(entry["dtype"])
+            shape = entry["shape"]
+            count = 1
+            for dim in shape:
+                count *= dim
+            if count == 0:
+                tensors[name] = torch.empty(shape, dtype=dtype)
+                continue
+            tensors[name] = torch.frombuffer(
+                self._get_map(entry["shard"]),
+                dtype=dtype,
+                count=count,
+                offset=entry["offset"],
+            ).view(shape)
+        return tensors
+
+
+def convert_pt_folder(pt_folder: str, save_dir: str, shard_size: int = 1 << 30):
+    pt_files = sorted(glob.glob(f"{pt_folder}/*.pt"))
+    with ShardWriter(save_dir, shard_size=shard_size) as writer:
+        for pt_file in pt_files:
+            feeds = torch.load(pt_file)
+            key = os.path.splitext(os.path.basename(pt_file))[0]
+            tensors = {k: v for k, v in feeds.items() if isinstance(v, torch.Tensor)}
+            meta = {k: v for k, v in feeds.items() if k not in tensors}
+            writer.add(key, tensors, meta)
+    # shared prompt embeddings are already sharded, see data/text_cache.py
+    text_dir = os.path.join(pt_folder, "text")
+    if os.path.isdir(text_dir):
+        shutil.copytree(text_dir, os.path.join(save_dir, "text"), dirs_exist_ok=True)
+    print(f"Converted {len(pt_files)} samples into {len(writer.shards)} shards")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a folder of .pt cache files into the sharded format."
+    )
+    parser.add_argument("--pt_folder", required=True)
+    parser.add_argument("--save_dir", required=True)
+    parser.add_argument("--shard_size_mb", type=int, default=1024)
+    args = parser.parse_args()
+    convert_pt_folder(args.pt_folder, args.save_dir, args.shard_size_mb << 20)
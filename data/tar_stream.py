@@ -0,0 +1,428 @@
+"""
+Streaming datasets over tar shards, for datasets too large for a metadata
+file or a cache index.
+
+A shard holds samples as consecutive members sharing a key:
+- raw: `<key>.jpg|.png|.webp` and `<key>.txt` with the caption
+- cached: `<key>.pth` with the tensors and `<key>.json` with the sizes
+
+Shards are shuffled per epoch and split across ranks and DataLoader workers,
+then samples pass through a shuffle buffer. Cached samples are batched by
+latent shape inside the workers. Every sample and batch carries the
+`stream_position` (shard, offset, shard size or -1) of its samples, which
+`StreamProgress` turns into a resume point.
+
+    python -m data.tar_stream --cached_folder debug/test_cache --save_dir debug/shards
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import random
+import tarfile
+from collections import defaultdict
+from typing import Dict, Iterator, List, Sequence, Tuple
+import torch
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+from data.cache_codec import decode_tensors
+from data.core_data import (
+    AspectBuckets,
+    collate_fn,
+    resize_to_bucket,
+    sample_bucket_key,
+)
+
+SHARD_PATTERN = "shard-{:06d}.tar"
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp")
+
+
+def split_name(name: str) -> Tuple[str, str]:
+    """
+    `dir/abc.jpg` -> (`dir/abc`, `jpg`). Keys may contain dots in directory
+    names but not in the file name.
+    """
+    directory, base = os.path.split(name)
+    key, _, extension = base.partition(".")
+    return os.path.join(directory, key), extension.lower()
+
+
+class TarShardWriter:
+    """
+    Writes samples, given as `{extension: bytes}`, into numbered tar shards
+    of `samples_per_shard` samples each.
+    """
+
+    def __init__(self, save_dir: str, samples_per_shard: int = 1000):
+        self.save_dir = save_dir
+        self.samples_per_shard = samples_per_shard
+        self.shards: List[str] = []
+        self._tar = None
+        self._count = 0
+        os.makedirs(save_dir, exist_ok=True)
+
+    def _open_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+        name = SHARD_PATTERN.format(len(self.shards))
+        self.shards.append(name)
+        self._tar = tarfile.open(os.path.join(self.save_dir, name), "w")
+        self._count = 0
+
+    def add(self, key: str, files: Dict[str, bytes]):
+        if self._tar is None or self._count >= self.samples_per_shard:
+            self._open_shard()
+        for extension, data in files.items():
+            info = tarfile.TarInfo(f"{key}.{extension}")
+            info.size = len(data)
+            self._tar.addfile(info, io.BytesIO(data))
+        self._count += 1
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def encode_cached(feeds: dict) -> Dict[str, bytes]:
+    tensors = {k: v for k, v in feeds.items() if torch.is_tensor(v)}
+    meta = {k: list(v) if isinstance(v, tuple) else v for k, v in feeds.items()}
+    meta = {k: v for k, v in meta.items() if k not in tensors}
+    buffer = io.BytesIO()
+    torch.save(tensors, buffer)
+    return {"pth": buffer.getvalue(), "json": json.dumps(meta).encode()}
+
+
+def decode_cached(files: Dict[str, bytes]) -> dict:
+    feeds = torch.load(io.BytesIO(files["pth"]), weights_only=True)
+    meta = json.loads(files.get("json", b"{}"))
+    if "latent_size" in meta:
+        feeds["latent_size"] = tuple(meta["latent_size"])
+    return feeds
+
+
+def decode_raw(
+    files: Dict[str, bytes], buckets: AspectBuckets = None
+) -> Tuple[Image.Image, str]:
+    """
+    The image and caption of a raw sample. With `buckets`, the image is
+    resized to its nearest bucket as `CoreDataset.load_image` does.
+    """
+    extension = next(e for e in IMAGE_EXTENSIONS if e in files)
+    with Image.open(io.BytesIO(files[extension])) as image:
+        if buckets is None:
+            image = image.convert("RGB")
+        else:
+            image = resize_to_bucket(image, buckets.nearest_bucket(*image.size))
+    return image, files["txt"].decode("utf-8")
+
+
+def iter_tar_samples(path: str) -> Iterator[Tuple[str, Dict[str, bytes]]]:
+    """
+    Reads a tar shard front to back and yields `(key, {extension: bytes})`
+    for every group of consecutive members sharing a key.
+    """
+    key, files = None, {}
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, extension = split_name(member.name)
+            if member_key != key and files:
+                yield key, files
+                files = {}
+            key = member_key
+            files[extension] = tar.extractfile(member).read()
+    if files:
+        yield key, files
+
+
+def iter_shard_samples(path: str) -> Iterator[Tuple[int, Dict[str, bytes], int]]:
+    """
+    `(offset, files, size)` of every sample of a shard, `size` is the
+    number of samples in the shard on its last sample and -1 before.
+    """
+    previous = None
+    for offset, (_, files) in enumerate(iter_tar_samples(path)):
+        if previous is not None:
+            yield previous + (-1,)
+        previous = (offset, files)
+    if previous is not None:
+        yield previous + (previous[0] + 1,)
+
+
+class TarShardDataset(IterableDataset):
+    """
+    Streams raw `(image, caption, stream_position)` samples or cached batches
+    from tar shards.
+
+    Every epoch the shards are shuffled with `seed + epoch`, then shard
+    `i` of that order is read by global worker `i % (world_size *
+    num_workers)`. `buffer_size` samples per worker are kept for the sample
+    shuffle. With `batch_size`, cached samples are collated into batches of
+    one latent shape; partial batches are emitted at the end of the stream.
+    With `resize_to_bucket`, raw images are resized to their aspect ratio
+    bucket like `CoreDataset` images.
+    """
+
+    def __init__(
+        self,
+        shards,
+        mode: str = "cached",
+        batch_size: int = None,
+        shuffle: bool = True,
+        buffer_size: int = 1000,
+        seed: int = 0,
+        rank: int = None,
+        world_size: int = None,
+        dequantize_on: str = "dataset",
+        resize_to_bucket: bool = False,
+    ):
+        assert mode in ("cached", "raw"), mode
+        assert dequantize_on in ("dataset", "device"), dequantize_on
+        if isinstance(shards, str):
+            shards = sorted(glob.glob(shards))
+        if not shards:
+            raise ValueError("No tar shards given")
+        self.shards = list(shards)
+        self.mode = mode
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        if rank is None:
+            distributed = torch.distributed.is_available() and (
+                torch.distributed.is_initialized()
+            )
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size or 1
+        self.dequantize_on = dequantize_on
+        self.buckets = AspectBuckets() if resize_to_bucket else None
+        self.epoch = 0
+        self.resume_epoch = None
+        self.start_positions: Dict[int, dict] = {}
+
+    def set_epoch(self, epoch: int):
+        """
+        Iteration runs in DataLoader workers, which do not report back, so
+        the epoch is set from the training loop like a `DistributedSampler`.
+        """
+        self.epoch = epoch
+
+    def resume(self, epoch: int, positions: Dict[int, dict]):
+        """
+        Makes the next iteration replay `epoch` without the samples recorded
+        as consumed in `positions`, the per shard (position in the epoch
+        order) progress of `StreamProgress.state_dict()`. Finished shards are
+        not read again; samples that were still in a shuffle buffer are.
+        """
+        self.epoch = self.resume_epoch = epoch
+        self.start_positions = {
+            int(k): StreamProgress.load_shard(v) for k, v in positions.items()
+        }
+
+    def shard_order(self) -> List[int]:
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return order
+
+    def worker_shards(self) -> Tuple[int, List[Tuple[int, int]]]:
+        """
+        Global worker id and its `(position, shard)` pairs for this epoch.
+        """
+        info = get_worker_info()
+        num_workers = info.num_workers if info is not None else 1
+        worker_id = info.id if info is not None else 0
+        total = self.world_size * num_workers
+        global_id = self.rank * num_workers + worker_id
+        order = self.shard_order()
+        shards = [
+            (position, shard)
+            for position, shard in enumerate(order)
+            if position % total == global_id
+        ]
+        return global_id, shards
+
+    def _read(self, shards: List[Tuple[int, int]]):
+        progress = self.start_positions if self.epoch == self.resume_epoch else {}
+        for position, shard in shards:
+            state = progress.get(position)
+            if state is not None and state["next"] == state["size"]:
+                continue
+            for offset, files, size in iter_shard_samples(self.shards[shard]):
+                if state is not None and (
+                    offset < state["next"] or offset in state["consumed"]
+                ):
+                    continue
+                yield position, offset, size, files
+
+    def _shuffled(self, samples, rng: random.Random):
+        if not self.shuffle or self.buffer_size <= 1:
+            yield from samples
+            return
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            index = rng.randrange(len(buffer))
+            yield buffer[index]
+            buffer[index] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _decode(self, position: int, offset: int, size: int, files: Dict[str, bytes]):
+        stream_position = torch.tensor([[position, offset, size]])
+        if self.mode == "raw":
+            return decode_raw(files, self.buckets) + (stream_position,)
+        feeds = decode_cached(files)
+        if self.dequantize_on == "dataset":
+            feeds = decode_tensors(feeds)
+        feeds["stream_position"] = stream_position
+        return feeds
+
+    def _batched(self, samples):
+        buckets = defaultdict(list)
+        for feeds in samples:
+            bucket = buckets[sample_bucket_key(feeds)]
+            bucket.append(feeds)
+            if len(bucket) >= self.batch_size:
+                yield collate_fn(bucket)
+                bucket.clear()
+        for bucket in buckets.values():
+            if bucket:
+                yield collate_fn(bucket)
+
+    def __iter__(self):
+        global_id, shards = self.worker_shards()
+        rng = random.Random(f"{self.seed}-{self.epoch}-{global_id}")
+        samples = (
+            self._decode(*sample) for sample in self._shuffled(self._read(shards), rng)
+        )
+        if self.mode == "cached" and self.batch_size is not None:
+            samples = self._batched(samples)
+        yield from samples
+
+
+class StreamProgress:
+    """
+    Tracks the consumed samples of every shard from the `stream_position`
+    of training batches, to be saved with checkpoints and passed to
+    `TarShardDataset.resume`. Per shard it keeps the lowest unconsumed
+    offset, the consumed offsets above it (samples leave the shuffle buffer
+    out of order) and the shard size once its last sample was seen.
+    """
+
+    def __init__(self):
+        self.shards: Dict[int, dict] = {}
+
+    @staticmethod
+    def load_shard(state) -> dict:
+        if isinstance(state, int):
+            # last consumed offset, as recorded before watermarks
+            return {"next": state + 1, "consumed": set(), "size": None}
+        return {
+            "next": int(state["next"]),
+            "consumed": set(state["consumed"]),
+            "size": state["size"],
+        }
+
+    def update(self, stream_position: torch.Tensor):
+        for position, offset, size in stream_position.tolist():
+            shard = self.shards.setdefault(
+                position, {"next": 0, "consumed": set(), "size": None}
+            )
+            if size >= 0:
+                shard["size"] = size
+            if offset >= shard["next"]:
+                shard["consumed"].add(offset)
+            while shard["next"] in shard["consumed"]:
+                shard["consumed"].remove(shard["next"])
+                shard["next"] += 1
+
+    def reset(self):
+        self.shards = {}
+
+    def state_dict(self) -> dict:
+        return {
+            "positions": {
+                position: {**shard, "consumed": sorted(shard["consumed"])}
+                for position, shard in self.shards.items()
+            }
+        }
+
+    def load_state_dict(self, state: dict):
+        self.shards = {
+            int(k): self.load_shard(v) for k, v in state["positions"].items()
+        }
+
+
+def write_raw_shards(
+    metadata_file: str, root_folder: str, save_dir: str, samples_per_shard: int = 1000
+) -> List[str]:
+    """
+    Packs the images of a `CoreDataset` metadata file, undecoded, with their
+    captions.
+    """
+    with open(metadata_file, "r") as f:
+        metadata = json.load(f)
+    with TarShardWriter(save_dir, samples_per_shard) as writer:
+        for i, item in enumerate(metadata):
+            extension = os.path.splitext(item["image_path"])[1][1:].lower()
+            with open(os.path.join(root_folder, item["image_path"]), "rb") as f:
+                image = f.read()
+            writer.add(
+                f"{i:08d}", {extension: image, "txt": item["caption"].encode("utf-8")}
+            )
+    return writer.shards
+
+
+def write_cached_shards(
+    cached_folder: str,
+    save_dir: str,
+    samples_per_shard: int = 1000,
+    indices: Sequence[int] = None,
+) -> List[str]:
+    """
+    Packs a cache into self-contained samples, shared prompt embeddings are
+    copied into every sample and quantized tensors stay quantized.
+    """
+    from data.core_data import CoreCachedDataset
+
+    dataset = CoreCachedDataset(cached_folder, dequantize_on="device")
+    indices = range(len(dataset)) if indices is None else indices
+    with TarShardWriter(save_dir, samples_per_shard) as writer:
+        for i in indices:
+            writer.add(f"{i:08d}", encode_cached(dataset[i]))
+    return writer.shards
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack samples into tar shards")
+    parser.add_argument("--cached_folder", default=None)
+    parser.add_argument("--metadata_file", default=None)
+    parser.add_argument("--root_folder", default=None)
+    parser.add_argument("--save_dir", required=True)
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.cached_folder is not None:
+        shards = write_cached_shards(
+            args.cached_folder, args.save_dir, args.samples_per_shard
+        )
+    else:
+        shards = write_raw_shards(
+            args.metadata_file, args.root_folder, args.save_dir, args.samples_per_shard
+        )
+    print(f"Wrote {len(shards)} shards to {args.save_dir}")
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict
+import torch
+from data.shard_cache import ShardedCacheReader
+
+TEXT_SUBDIR = "text"
+
+
+def text_key(caption: str, settings: Dict) -> str:
+    """
+    Content address of a caption under the given text encoder settings.
+    """
+    payload = json.dumps({"caption": caption, **settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TextEmbeddingStore:
+    """
+    Resolves `text_key` references of cached samples against the shared
+    prompt embeddings stored under `<cache_dir>/text`.
+    """
+
+    def __init__(self, cache_dir: str, capacity: int = 1024):
+        self.reader = ShardedCacheReader(os.path.join(cache_dir, TEXT_SUBDIR))
+        self.cache = LRUCache(capacity)
+
+    @staticmethod
+    def exists(cache_dir: str) -> bool:
+        return ShardedCacheReader.exists(os.path.join(cache_dir, TEXT_SUBDIR))
+
+    def __getitem__(self, key: str) -> Dict[str, torch.Tensor]:
+        tensors = self.cache.get(key)
+        if tensors is None:
+            index = self.reader.find(key)
+            tensors = self.reader[index]
+            text_length = self.reader.meta(index).get("text_length")
+            if text_length is not None:
+                tensors["text_length"] = torch.tensor([text_length])
+            self.cache.put(key, tensors)
+        return dict(tensors)
+
+    def text_length(self, key: str) -> int:
+        """
+        Number of real tokens of a cached prompt, read from the index only.
+        """
+        index = self.reader.find(key)
+        text_length = self.reader.meta(index).get("text_length")
+        if text_length is None:
+            text_length = self.reader.shape(index, "prompt_embeds")[1]
+        return text_length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = LRUCache(self.cache.capacity)
+        return state
@@ -1,15 +1,30 @@
-import pytorch_lightning as L
-import diffusers
 import torch
-import schedulefree
-from peft import LoraConfig, set_peft_model_state_dict
 from peft.utils import get_peft_model_state_dict
-import math
-from optimum.quanto import freeze, qfloat8, quantize, qint4
-import bitsandbytes as bnb
 import gc
-import wandb
+from contextlib import nullcontext
 from torch import nn
+from models.lora import LORA_TARGET_MODULES, apply_lora, fused_lora
+from models.loading import load_transformer
+from lightning_modules.optimizers import build_optimizer, eval_mode_weights
+from models.checkpointing import configure_checkpointing
+from models.rotary import position_ids, rotary_key
+from models.compile import (
+    compile_blocks,
+    compile_report,
+    enable_compile_cache,
+    plan_shapes,
+    save_compile_cache,
+    synthetic_batch,
+    time_steps,
+    warmup_shapes,
+)
+from data.core_data import move_batch
+from lightning_modules.noise_schedule import (
+    TimestepSampler,
+    UniformTimestepSampler,
+    add_noise,
+    repeat_batch,
+)
 
 
 def flush():
@@ -26,23 +41,75 @@ class FluxLightning(nn.Module):
         learning_rate: float = 1e-4,
         weight_decay: float = 1e-4,
         torch_dtype: torch.dtype = torch.bfloat16,
+        use_text_attention_mask: bool = False,
+        timestep_sampler: TimestepSampler = None,
+        quantize_base: str = None,
+        optimizer_backend: str = "schedulefree",
+        gradient_checkpointing: str = "all",
+        fast_start: bool = True,
     ):
+        """
+        With `fast_start` only the transformer weights are loaded, the rest
+        of the pipeline is loaded on first use by validation.
+        """
         super().__init__()
+        self.use_text_attention_mask = use_text_attention_mask
+        self.timestep_sampler = timestep_sampler or UniformTimestepSampler()
+        self._validation_latents = {}
+        self.quantize_base = quantize_base
+        self.optimizer_backend = optimizer_backend
         self.learning_rate = learning_rate
         self.weight_decay = weight_decay
         self.torch_dtype = torch_dtype
+        self.pretrained_path = denoiser_pretrained_path
+        self._pipeline = None
+
+        if fast_start:
+            self.denoiser = load_transformer(
+                denoiser_pretrained_path, torch_dtype=self.torch_dtype, device="cuda"
+            )
+        else:
+            self._pipeline = self.load_pipeline()
+            self.denoiser = self._pipeline.transformer
+            self.denoiser.to("cuda")
+            # the vae comes first in the component order, it decides the
+            # pipeline's execution device
+            self._pipeline.vae.to(self.denoiser.device)
+        self.apply_lora(self.denoiser)
+        if quantize_base is not None:
+            from models.quantization import quantize_base_weights
+
+            quantize_base_weights(self.denoiser, weights=quantize_base)
+        # "auto" needs a probe batch, main.py configures it once data is loaded
+        if gradient_checkpointing != "auto":
+            self.configure_checkpointing(gradient_checkpointing)
+        self.print_trainable_parameters(self.denoiser)
 
-        self.pipeline = diffusers.FluxPipeline.from_pretrained(
-            "black-forest-labs/FLUX.1-dev",
+    def load_pipeline(self, transformer=None):
+        """
+        Flux pipeline without text encoders and tokenizers, validation
+        renders precomputed prompt embeddings. Reuses `transformer` when
+        given instead of loading one.
+        """
+        import diffusers
+
+        components = {} if transformer is None else {"transformer": transformer}
+        return diffusers.FluxPipeline.from_pretrained(
+            self.pretrained_path,
             torch_dtype=self.torch_dtype,
             text_encoder=None,
             text_encoder_2=None,
+            tokenizer=None,
+            tokenizer_2=None,
+            **components,
         )
-        self.denoiser = self.pipeline.transformer
-        self.denoiser.to("cuda")
-        self.apply_lora(self.denoiser)
-        self.denoiser.enable_gradient_checkpointing()
-        self.print_trainable_parameters(self.denoiser)
+
+    @property
+    def pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self.load_pipeline(transformer=self.denoiser)
+            self._pipeline.vae.to(self.denoiser.device)
+        return self._pipeline
 
     @staticmethod
     def print_trainable_parameters(model):
@@ -65,15 +132,107 @@ class FluxLightning(nn.Module):
         rank=32,
         alpha=32,
         init_lora_weights="gaussian",
-        target_modules=["to_k", "to_q", "to_v", "to_out.0."],
+        target_modules=LORA_TARGET_MODULES,
     ):
-        transformer_lora_config = LoraConfig(
-            r=rank,
-            lora_alpha=alpha,
-            init_lora_weights=init_lora_weights,
-            target_modules=target_modules,
+        apply_lora(model, rank, alpha, init_lora_weights, target_modules)
+
+    def configure_checkpointing(
+        self, policy: str, probe_batch: dict = None, budget_bytes: int = None
+    ):
+        """
+        Selects which denoiser blocks are recomputed in the backward pass, see
+        `models.checkpointing`. `probe_batch` is a clean cached batch used to
+        measure activations for the "auto" policy.
+        """
+        probe = None
+        if probe_batch is not None:
+            feeds = self.probe_feeds(probe_batch)
+            probe = lambda: self(**feeds)
+        return configure_checkpointing(self.denoiser, policy, probe, budget_bytes)
+
+    def probe_feeds(self, batch, repeats: int = 1):
+        """
+        Model inputs for memory probes, noised at a fixed sigma so probing
+        does not advance the timestep sampler.
+        """
+        feeds = move_batch(repeat_batch(batch, repeats), self.denoiser.device)
+        latents = feeds["latents"]
+        feeds["timestep"] = latents.new_full((latents.shape[0],), 0.5)
+        return feeds
+
+    def memory_probe_step(self, batch, repeats: int = 1):
+        """
+        Forward and backward on `batch` repeated `repeats` times, gradients
+        are discarded.
+        """
+        feeds = self.probe_feeds(batch, repeats)
+        self(**feeds).float().pow(2).mean().backward()
+        self.denoiser.zero_grad(set_to_none=True)
+
+    def compile_denoiser(
+        self,
+        shapes,
+        text_length: int = 256,
+        cache_dir: str = None,
+        backend: str = "inductor",
+        mode: str = None,
+        report_iters: int = 3,
+    ) -> dict:
+        """
+        Compiles the denoiser blocks for the (batch size, latent size) shapes
+        of training, see `models.compile`, and compiles each shape once with a
+        synthetic batch. The first shape is also timed eagerly before and
+        compiled after, the returned report weighs compile time against the
+        per-step gain.
+        """
+        dynamic_batch, warmup = plan_shapes(shapes)
+        device = self.denoiser.device
+        config = self.denoiser.config
+
+        def run_step(batch_size, latent_size, padded=False):
+            batch = synthetic_batch(
+                config, batch_size, latent_size, text_length, self.torch_dtype, padded
+            )
+            self.memory_probe_step(batch)
+
+        # padded prompts add an attention mask, a second graph per shape
+        variants = [False, True] if self.use_text_attention_mask else [False]
+        reference = lambda: run_step(*warmup[0])
+        eager_step = None
+        if report_iters:
+            reference()
+            eager_step = time_steps(reference, report_iters, device)
+        if cache_dir is not None:
+            enable_compile_cache(cache_dir)
+        compile_blocks(
+            self.denoiser,
+            backend=backend,
+            mode=mode,
+            dynamic_batch=dynamic_batch,
+            num_shapes=len(warmup) * len(variants),
         )
-        model.add_adapter(transformer_lora_config)
+        compile_seconds = 0.0
+        for padded in variants:
+            seconds = warmup_shapes(
+                lambda batch_size, latent_size: run_step(
+                    batch_size, latent_size, padded
+                ),
+                warmup,
+                device,
+            )
+            compile_seconds += sum(seconds.values())
+        if cache_dir is not None:
+            save_compile_cache(cache_dir)
+        report = {
+            "shapes": len(warmup) * len(variants),
+            "dynamic_batch": dynamic_batch,
+            "compile_seconds": compile_seconds,
+        }
+        if report_iters:
+            compiled_step = time_steps(reference, report_iters, device)
+            report.update(compile_report(compile_seconds, eager_step, compiled_step))
+        print(f"Compiled denoiser: {report}")
+        return report
 
     def forward(
         self,
@@ -85,65 +244,159 @@ class FluxLightning(nn.Module):
         latent_image_ids: torch.Tensor = None,
         joint_attention_kwargs: dict = None,
         guidance: torch.Tensor = None,
+        text_attention_mask: torch.Tensor = None,
+        latent_size: tuple = None,
         **kwargs,
     ):
-        noise_pred = self.denoiser(
-            hidden_states=latents,
-            timestep=timestep,
-            pooled_projections=pooled_prompt_embeds,
-            encoder_hidden_states=prompt_embeds,
-            txt_ids=text_ids,
-            img_ids=latent_image_ids,
-            joint_attention_kwargs=joint_attention_kwargs,
-            guidance=guidance,
-            return_dict=False,
-        )[0]
+        if (
+            self.use_text_attention_mask
+            and text_attention_mask is not None
+            and not text_attention_mask.all()
+        ):
+            # mask the per-batch padding of trimmed prompts, image tokens are always kept
+            image_mask = text_attention_mask.new_ones(latents.shape[:2])
+            attention_mask = torch.cat([text_attention_mask, image_mask], dim=1)
+            joint_attention_kwargs = {
+                **(joint_attention_kwargs or {}),
+                "attention_mask": attention_mask[:, None, None, :],
+            }
+        text_length = prompt_embeds.shape[1]
+        rotary = nullcontext()
+        if latent_size is not None:
+            # ids are generated on the device and their rotary embeddings reused
+            if text_ids is None or latent_image_ids is None:
+                text_ids, latent_image_ids = position_ids(
+                    text_length, latent_size, latents.device
+                )
+            rotary = rotary_key(self.denoiser, text_length, latent_size)
+        with rotary:
+            noise_pred = self.denoiser(
+                hidden_states=latents,
+                timestep=timestep,
+                pooled_projections=pooled_prompt_embeds,
+                encoder_hidden_states=prompt_embeds,
+                txt_ids=text_ids,
+                img_ids=latent_image_ids,
+                joint_attention_kwargs=joint_attention_kwargs,
+                guidance=guidance,
+                return_dict=False,
+            )[0]
         return noise_pred
 
-    def loss_fn(self, noise_pred, targets):
-        loss = ((noise_pred - targets) ** 2).mean()
-        return loss
+    def loss_fn(self, noise_pred, targets, normalizer: float = None):
+        """
+        Mean squared error. With `normalizer` the per-sample losses are summed
+        and divided by it instead of the batch size, so every sample carries
+        the same weight when batch sizes vary between steps.
+        """
+        errors = (noise_pred.float() - targets.float()) ** 2
+        if normalizer is None:
+            return errors.mean()
+        return errors.flatten(1).mean(dim=1).sum() / normalizer
+
+    def add_noise(self, feeds, repeats: int = 1):
+        """
+        Noises clean cached latents on their device, returns feeds and targets.
+        With `repeats` > 1 every latent is noised that many times in the batch.
+        """
+        return add_noise(feeds, self.timestep_sampler, repeats=repeats)
 
     def training_step(self, batch, batch_idx):
-        feeds, targets, metadata = batch
-        for k, v in feeds.items():
-            feeds[k] = v.to(self.denoiser.device)
+        feeds = move_batch(batch, self.denoiser.device)
+        feeds, targets = self.add_noise(feeds)
         noise_pred = self(**feeds)
         loss = self.loss_fn(noise_pred, targets)
         return loss
 
     @torch.no_grad()
-    def validation_step(self, batch, lora_path):
-        self.pipeline.load_lora_weights(lora_path)
-        feeds, targets, metadata = batch
-        prompt_embeds = feeds["prompt_embeds"][:1]
-        pooled_prompt_embeds = feeds["pooled_prompt_embeds"][:1]
-        width = 768
-        height = 1024
-        steps = 20
-        image = self.pipeline(
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            height=height,
-            width=width,
-            num_inference_steps=steps,
-            generator=torch.Generator().manual_seed(42),
-        ).images[0]
-        image = wandb.Image(image, caption="TODO: Add caption")
-        wandb.log({f"Validation image": image})
+    def validation_step(
+        self,
+        batch,
+        optimizer=None,
+        fuse_lora: bool = False,
+        height: int = 1024,
+        width: int = 768,
+        steps: int = 20,
+        seed: int = 42,
+    ):
+        """
+        Renders a batch of precomputed validation prompt embeddings with the
+        live adapter weights, no save/reload round trip. Schedule-free
+        optimizers are swapped to their averaged weights while sampling.
+        """
+        device = self.denoiser.device
+        prompt_embeds = batch["prompt_embeds"].to(device, self.torch_dtype)
+        pooled_prompt_embeds = batch["pooled_prompt_embeds"].to(
+            device, self.torch_dtype
+        )
+        batch_size = prompt_embeds.shape[0]
+        latents = self.validation_latents(batch_size, height, width, seed)
+        joint_attention_kwargs = None
+        text_attention_mask = batch.get("text_attention_mask")
+        if self.use_text_attention_mask and text_attention_mask is not None:
+            image_mask = text_attention_mask.new_ones(batch_size, latents.shape[1])
+            attention_mask = torch.cat([text_attention_mask, image_mask], dim=1)
+            joint_attention_kwargs = {
+                "attention_mask": attention_mask[:, None, None, :].to(device)
+            }
+        # adapters cannot be merged into quantized base weights
+        fuse_lora = fuse_lora and self.quantize_base is None
+        with eval_mode_weights(optimizer), fused_lora(self.denoiser, fuse_lora):
+            images = self.pipeline(
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                latents=latents,
+                height=height,
+                width=width,
+                num_inference_steps=steps,
+                joint_attention_kwargs=joint_attention_kwargs,
+            ).images
+        import wandb
+
+        wandb.log(
+            {
+                "Validation images": [
+                    wandb.Image(image, caption=f"validation prompt {i}")
+                    for i, image in enumerate(images)
+                ]
+            }
+        )
+        return images
+
+    def validation_latents(self, batch_size, height, width, seed):
+        """
+        Initial noise for validation, drawn once so every validation run starts
+        from the same latents.
+        """
+        key = (batch_size, height, width, seed)
+        if self._validation_latents.get("key") != key:
+            latents, _ = self.pipeline.prepare_latents(
+                batch_size=batch_size,
+                num_channels_latents=self.denoiser.config.in_channels // 4,
+                height=height,
+                width=width,
+                dtype=self.torch_dtype,
+                device=self.denoiser.device,
+                generator=torch.Generator().manual_seed(seed),
+            )
+            self._validation_latents = {"key": key, "latents": latents}
+        return self._validation_latents["latents"]
 
     def configure_optimizers(self):
         params_to_optimize = list(
             filter(lambda p: p.requires_grad, self.denoiser.parameters())
         )
-        optimizer = schedulefree.AdamWScheduleFree(
+        optimizer = build_optimizer(
             params_to_optimize,
+            backend=self.optimizer_backend,
             lr=self.learning_rate,
             weight_decay=self.weight_decay,
         )
         return optimizer
 
     def save_lora(self, path: str):
+        import diffusers
+
         transformer_lora_layers = get_peft_model_state_dict(self.denoiser)
         diffusers.FluxPipeline.save_lora_weights(
             save_directory=path,
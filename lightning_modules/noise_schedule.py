@@ -0,0 +1,134 @@
+import torch
+from typing import Dict, Tuple
+from data.core_data import SHARED_KEYS
+
+
+class TimestepSampler:
+    """
+    Draws flow matching sigmas in (0, 1) directly on the training device.
+    Each rank gets its own seeded generator so runs are reproducible.
+    """
+
+    def __init__(self, seed: int = 0, rank: int = 0):
+        self.seed = seed + rank
+        self._generators = {}
+
+    def generator(self, device: torch.device) -> torch.Generator:
+        device = torch.device(device)
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self._generators[device] = generator
+        return self._generators[device]
+
+    def sample(self, batch_size: int, device: torch.device) -> torch.Tensor:
+        raise NotImplementedError
+
+    def state_dict(self) -> dict:
+        return {
+            str(device): generator.get_state().tolist()
+            for device, generator in self._generators.items()
+        }
+
+    def load_state_dict(self, state: dict):
+        for device, generator_state in state.items():
+            self.generator(device).set_state(
+                torch.tensor(generator_state, dtype=torch.uint8)
+            )
+
+
+class UniformTimestepSampler(TimestepSampler):
+    def sample(self, batch_size, device):
+        return torch.rand(batch_size, generator=self.generator(device), device=device)
+
+
+class LogitNormalTimestepSampler(TimestepSampler):
+    def __init__(self, mean: float = 0.0, std: float = 1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.mean = mean
+        self.std = std
+
+    def sample(self, batch_size, device):
+        normal = torch.randn(
+            batch_size, generator=self.generator(device), device=device
+        )
+        return torch.sigmoid(normal * self.std + self.mean)
+
+
+class ShiftedTimestepSampler(TimestepSampler):
+    """
+    Shifts sigmas of a base sampler towards the noisy end, as done for high
+    resolution flow matching: sigma' = shift * sigma / (1 + (shift - 1) * sigma).
+    """
+
+    def __init__(self, base: TimestepSampler, shift: float = 3.0):
+        self.base = base
+        self.shift = shift
+
+    def generator(self, device):
+        return self.base.generator(device)
+
+    def state_dict(self):
+        return self.base.state_dict()
+
+    def load_state_dict(self, state):
+        self.base.load_state_dict(state)
+
+    def sample(self, batch_size, device):
+        sigma = self.base.sample(batch_size, device)
+        return self.shift * sigma / (1 + (self.shift - 1) * sigma)
+
+
+def build_timestep_sampler(
+    name: str = "uniform", seed: int = 0, rank: int = 0, shift: float = 3.0
+) -> TimestepSampler:
+    if name == "uniform":
+        return UniformTimestepSampler(seed=seed, rank=rank)
+    if name == "logit_normal":
+        return LogitNormalTimestepSampler(seed=seed, rank=rank)
+    if name == "shifted":
+        return ShiftedTimestepSampler(
+            UniformTimestepSampler(seed=seed, rank=rank), shift=shift
+        )
+    if name == "shifted_logit_normal":
+        return ShiftedTimestepSampler(
+            LogitNormalTimestepSampler(seed=seed, rank=rank), shift=shift
+        )
+    raise ValueError(f"Unknown timestep sampler: {name}")
+
+
+def repeat_batch(feeds: Dict[str, torch.Tensor], repeats: int):
+    """
+    Repeats every sample of a batch `repeats` times along the batch dim so
+    each copy can get its own (sigma, noise) draw.
+    """
+    if repeats == 1:
+        return dict(feeds)
+    return {
+        k: v if k in SHARED_KEYS else v.repeat_interleave(repeats, dim=0)
+        for k, v in feeds.items()
+    }
+
+
+def add_noise(
+    feeds: Dict[str, torch.Tensor], sampler: TimestepSampler, repeats: int = 1
+) -> Tuple[Dict[str, torch.Tensor], torch.Tensor]:
+    """
+    Noises a batch of clean latents on their device and returns the flow
+    matching target `noise - latents`. The input dict is left untouched so
+    the same clean batch can be noised again for several steps.
+    """
+    feeds = repeat_batch(feeds, repeats)
+    latents = feeds["latents"]
+    sigma = sampler.sample(latents.shape[0], latents.device)
+    noise = torch.randn(
+        latents.shape,
+        generator=sampler.generator(latents.device),
+        device=latents.device,
+        dtype=latents.dtype,
+    )
+    s = sigma.to(latents.dtype).view(-1, *([1] * (latents.ndim - 1)))
+    feeds["latents"] = (1 - s) * latents + s * noise
+    feeds["timestep"] = sigma.to(latents.dtype)
+    target = noise - latents
+    return feeds, target
@@ -0,0 +1,224 @@
+import torch
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterable
+
+OPTIMIZER_BACKENDS = (
+    "schedulefree",
+    "adamw",
+    "adamw8bit",
+    "paged_adamw8bit",
+    "cpu_offload",
+)
+
+
+def unwrap_optimizer(optimizer):
+    """
+    Strips wrappers such as accelerate's `AcceleratedOptimizer`.
+    """
+    while hasattr(optimizer, "optimizer"):
+        optimizer = optimizer.optimizer
+    return optimizer
+
+
+def synchronize_optimizer(optimizer):
+    """
+    Waits for an in-flight offloaded update so the device weights are current.
+    """
+    optimizer = unwrap_optimizer(optimizer)
+    if hasattr(optimizer, "synchronize"):
+        optimizer.synchronize()
+
+
+@contextmanager
+def eval_mode_weights(optimizer):
+    """
+    Swaps schedule-free optimizers to their averaged (eval) weights for the
+    duration of the block. The train weights are restored from a copy rather
+    than recomputed, so training continues bit-exactly.
+    """
+    if optimizer is not None:
+        synchronize_optimizer(optimizer)
+    inner = unwrap_optimizer(optimizer)
+    if not hasattr(inner, "eval") or isinstance(inner, CPUOffloadOptimizer):
+        yield
+        return
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+    with torch.no_grad():
+        train_weights = [p.detach().clone() for p in params]
+    optimizer.eval()
+    try:
+        yield
+    finally:
+        optimizer.train()
+        with torch.no_grad():
+            for param, weight in zip(params, train_weights):
+                param.copy_(weight)
+
+
+class CPUOffloadOptimizer:
+    """
+    Keeps fp32 master weights, gradients and optimizer state in host memory
+    and runs the update on the cpu. `step` copies the gradients off the
+    device and returns immediately; the update runs in a background thread
+    while the next forward/backward is computed, and its result is copied
+    back to the device at the start of the following `step`. The device
+    weights therefore lag the optimizer by one step, as in ZeRO-Offload's
+    delayed parameter update. With `overlap=False` every step is applied
+    before `step` returns.
+    """
+
+    def __init__(
+        self,
+        params: Iterable[torch.nn.Parameter],
+        optimizer_cls=torch.optim.AdamW,
+        overlap: bool = True,
+        **optimizer_kwargs,
+    ):
+        self.params = [p for p in params]
+        self.overlap = overlap
+        pin = torch.cuda.is_available()
+        self.master_params = []
+        for param in self.params:
+            master = torch.empty(
+                param.shape, dtype=torch.float32, device="cpu", pin_memory=pin
+            )
+            master.copy_(param.detach())
+            master.grad = torch.zeros_like(master)
+            self.master_params.append(master)
+        self.host_optimizer = optimizer_cls(self.master_params, **optimizer_kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    @property
+    def param_groups(self):
+        return self.host_optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.host_optimizer.state
+
+    @property
+    def defaults(self):
+        return self.host_optimizer.defaults
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        self.synchronize()
+        for param, master in zip(self.params, self.master_params):
+            if param.grad is None:
+                master.grad.zero_()
+            else:
+                master.grad.copy_(param.grad, non_blocking=True)
+        copied = None
+        if any(p.is_cuda for p in self.params):
+            copied = torch.cuda.Event()
+            copied.record()
+        self._pending = self._executor.submit(self._update, copied)
+        if not self.overlap:
+            self.synchronize()
+
+    def _update(self, copied):
+        if copied is not None:
+            copied.synchronize()
+        self.host_optimizer.step()
+
+    @torch.no_grad()
+    def synchronize(self):
+        """
+        Finishes the pending update and copies the new weights to the device.
+        """
+        if self._pending is None:
+            return
+        self._pending.result()
+        self._pending = None
+        for param, master in zip(self.params, self.master_params):
+            param.copy_(master, non_blocking=True)
+
+    def train(self):
+        """
+        Same weights in train and eval mode, kept so callers can treat every
+        backend like a schedule-free optimizer.
+        """
+
+    def eval(self):
+        pass
+
+    def zero_grad(self, set_to_none: bool = True):
+        for param in self.params:
+            if set_to_none:
+                param.grad = None
+            elif param.grad is not None:
+                param.grad.zero_()
+
+    def state_dict(self):
+        self.synchronize()
+        return self.host_optimizer.state_dict()
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        self.synchronize()
+        # the device weights were restored separately, refresh the master copy
+        for param, master in zip(self.params, self.master_params):
+            master.copy_(param.detach())
+        self.host_optimizer.load_state_dict(state_dict)
+
+
+def build_optimizer(
+    params: Iterable[torch.nn.Parameter],
+    backend: str = "schedulefree",
+    lr: float = 1e-4,
+    weight_decay: float = 1e-4,
+):
+    params = [p for p in params]
+    if backend == "schedulefree":
+        import schedulefree
+
+        return schedulefree.AdamWScheduleFree(params, lr=lr, weight_decay=weight_decay)
+    if backend == "adamw":
+        return torch.optim.AdamW(params, lr=lr, weight_decay=weight_decay)
+    if backend in ("adamw8bit", "paged_adamw8bit"):
+        import bitsandbytes as bnb
+
+        optimizer_cls = (
+            bnb.optim.AdamW8bit if backend == "adamw8bit" else bnb.optim.PagedAdamW8bit
+        )
+        return optimizer_cls(params, lr=lr, weight_decay=weight_decay)
+    if backend == "cpu_offload":
+        return CPUOffloadOptimizer(params, lr=lr, weight_decay=weight_decay)
+    raise ValueError(f"Unknown optimizer backend: {backend}")
+
+
+def optimizer_memory(optimizer) -> Dict[str, int]:
+    """
+    Bytes held by the optimizer per device type: its state plus, when
+    offloading, the host master weights and gradients. Optimizer state is
+    allocated lazily, call this after the first step.
+    """
+    optimizer = unwrap_optimizer(optimizer)
+    memory = defaultdict(int)
+    tensors = [
+        value
+        for param_state in optimizer.state.values()
+        for value in param_state.values()
+        if torch.is_tensor(value)
+    ]
+    if isinstance(optimizer, CPUOffloadOptimizer):
+        tensors += optimizer.master_params
+        tensors += [p.grad for p in optimizer.master_params]
+    seen = set()
+    for tensor in tensors:
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        memory[tensor.device.type] += tensor.numel() * tensor.element_size()
+    return dict(memory)
+
+
+def format_memory(memory: Dict[str, int]) -> str:
+    if not memory:
+        return "no state"
+    return ", ".join(
+        f"{device} {size / 2**20:.1f}MB" for device, size in memory.items()
+    )
@@ -1,10 +1,27 @@
+import time
+
+# startup is timed from here, the imports below are part of it
+STARTUP = time.perf_counter()
+
 from lightning_modules.lightning_flux import FluxLightning
 from data.core_data import CoreCachedDataset, collate_fn
+from data.prefetch import DevicePrefetcher
+from data.cache_codec import decode_tensors
+from data.sampler import BucketBatchSampler, TokenBudgetBatchSampler, resume_loader
+from lightning_modules.noise_schedule import build_timestep_sampler, repeat_batch
+from training.instrumentation import StartupTimer, StepProfiler, format_record
+from training.checkpoint import CheckpointManager, rank_state
+from training.accumulation import GradientAccumulation
+from training.token_budget import cuda_peak_memory, cuda_reset_peak, probe_token_budget
+from lightning_modules.optimizers import (
+    OPTIMIZER_BACKENDS,
+    format_memory,
+    optimizer_memory,
+)
 import torch
+import math
 import os
 import argparse
-from lightning.pytorch.loggers import WandbLogger
-from pytorch_lightning.callbacks import Callback, ModelCheckpoint, LearningRateMonitor
 import wandb
 import accelerate
 
@@ -23,69 +40,477 @@ def parse_args():
         help="Validation check interval",
     )
     parser.add_argument("--gpus", type=int, default=1, help="Number of GPUs")
-    parser.add_argument("--batch_size", default=1, help="Precision", type=int)
+    parser.add_argument("--batch_size", default=1, help="Batch size", type=int)
+    parser.add_argument(
+        "--gradient_accumulation",
+        type=int,
+        default=1,
+        help="Micro-batches summed into every optimizer step",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="DataLoader workers, 0 loads batches in the training process",
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="Batches loaded ahead by every DataLoader worker",
+    )
+    parser.add_argument(
+        "--cache_dequantize",
+        default="dataset",
+        choices=["dataset", "device"],
+        help="Where quantized caches are dequantized, on the device moves fewer bytes",
+    )
+    parser.add_argument(
+        "--token_budget",
+        type=int,
+        default=0,
+        help="Image plus text tokens per step, sizes batches per bucket instead of --batch_size",
+    )
+    parser.add_argument(
+        "--probe_token_budget",
+        action="store_true",
+        help="Measure the token budget with a short memory probe at startup",
+    )
+    parser.add_argument(
+        "--probe_memory_fraction",
+        type=float,
+        default=0.85,
+        help="Share of device memory the probe may fill, leave room for optimizer state",
+    )
+    parser.add_argument(
+        "--max_batch_size", type=int, default=None, help="Cap of token budget batches"
+    )
+    parser.add_argument(
+        "--loss_normalization",
+        default="sample",
+        choices=["sample", "batch"],
+        help='"sample" weighs every sample equally across variable batch sizes '
+        "by dividing by --batch_size, full batches match a plain mean; "
+        '"batch" averages within each step',
+    )
+    parser.add_argument(
+        "--drop_last",
+        action="store_true",
+        help="Drop partial batches left over in each bucket",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Sampler seed")
+    parser.add_argument(
+        "--timestep_sampler",
+        default="uniform",
+        choices=["uniform", "logit_normal", "shifted", "shifted_logit_normal"],
+        help="Distribution of training sigmas",
+    )
+    parser.add_argument(
+        "--timestep_shift", type=float, default=3.0, help="Shift of shifted samplers"
+    )
+    parser.add_argument(
+        "--latent_reuse",
+        type=int,
+        default=1,
+        help="Number of independently noised samples drawn per cached latent read",
+    )
+    parser.add_argument(
+        "--latent_reuse_mode",
+        default="batch",
+        choices=["batch", "steps"],
+        help="Stack the noised copies in one batch or spread them over consecutive steps",
+    )
+    parser.add_argument(
+        "--log_every", type=int, default=20, help="Steps per metrics window"
+    )
+    parser.add_argument(
+        "--metrics_file",
+        default="debug/metrics.jsonl",
+        help="JSONL file receiving step time, throughput and memory metrics",
+    )
+    parser.add_argument("--checkpoint_dir", default="lora_ckpt/checkpoints")
+    parser.add_argument(
+        "--save_every", type=int, default=0, help="Checkpoint every N steps, 0 disables"
+    )
+    parser.add_argument(
+        "--keep_last",
+        type=int,
+        default=3,
+        help="Number of checkpoints to keep, at least 1",
+    )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        help='Checkpoint directory to resume from, or "latest"',
+    )
+    parser.add_argument(
+        "--validate_every",
+        type=int,
+        default=0,
+        help="Render validation images every N steps, 0 disables",
+    )
+    parser.add_argument("--num_validation_prompts", type=int, default=4)
+    parser.add_argument("--validation_inference_steps", type=int, default=20)
+    parser.add_argument(
+        "--fuse_lora_for_validation",
+        action="store_true",
+        help="Merge LoRA into the base weights while sampling validation images",
+    )
+    parser.add_argument(
+        "--quantize_base",
+        default=None,
+        choices=["qfloat8", "qint8", "qint4"],
+        help="Quantize the frozen base transformer weights, LoRA stays in bf16",
+    )
+    parser.add_argument(
+        "--optimizer",
+        default="schedulefree",
+        choices=OPTIMIZER_BACKENDS,
+        help="Optimizer backend, 8-bit and cpu_offload trade speed for memory",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        default="all",
+        help='Blocks recomputed in backward: "all", "none", "double", "single", '
+        'a fraction such as "0.5", block indices such as "0-9,30", or "auto"',
+    )
+    parser.add_argument(
+        "--checkpoint_budget_gb",
+        type=float,
+        default=None,
+        help="Activation memory budget of the auto policy, defaults to 80%% of free memory",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the denoiser blocks, every bucket shape is compiled at startup",
+    )
+    parser.add_argument(
+        "--compile_mode",
+        default=None,
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="torch.compile mode",
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        default="debug/compile_cache",
+        help="Compiled kernels are kept here and reused by later runs",
+    )
+    parser.add_argument(
+        "--full_pipeline",
+        action="store_true",
+        help="Load the whole Flux pipeline at startup, by default only the "
+        "transformer is loaded and the VAE follows on the first validation",
+    )
+    parser.add_argument(
+        "--text_attention_mask",
+        action="store_true",
+        help="Mask the per-batch padding of trimmed prompt embeddings",
+    )
 
     return parser.parse_args()
 
 
 args = parse_args()
+startup = StartupTimer(STARTUP)
+startup.mark("imports")
 
 wandb.init(project=args.project)
 
+accelerator = accelerate.Accelerator()
+startup.mark("init")
+
 model = FluxLightning(
     denoiser_pretrained_path="black-forest-labs/FLUX.1-dev",
     learning_rate=1e-5,
     weight_decay=1e-8,
+    use_text_attention_mask=args.text_attention_mask,
+    quantize_base=args.quantize_base,
+    optimizer_backend=args.optimizer,
+    gradient_checkpointing=args.gradient_checkpointing,
+    fast_start=not args.full_pipeline,
+    timestep_sampler=build_timestep_sampler(
+        args.timestep_sampler,
+        seed=args.seed,
+        rank=accelerator.process_index,
+        shift=args.timestep_shift,
+    ),
 )
 
-cached_dataset = CoreCachedDataset(cached_folder="debug/test_cache")
+startup.mark("model")
 
-train_dataloader = torch.utils.data.DataLoader(
-    cached_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn
+cached_dataset = CoreCachedDataset(
+    cached_folder="debug/test_cache", dequantize_on=args.cache_dequantize
 )
-val_dataloader = torch.utils.data.DataLoader(
-    cached_dataset, batch_size=1, shuffle=False, collate_fn=collate_fn
+
+bucket_keys = [cached_dataset.bucket_key(i) for i in range(len(cached_dataset))]
+largest_bucket = max(set(bucket_keys), key=math.prod)
+largest_indices = [i for i, key in enumerate(bucket_keys) if key == largest_bucket]
+
+# a fixed set of cached prompt embeddings, rendered as one batch
+VALIDATION_KEYS = ("prompt_embeds", "pooled_prompt_embeds", "text_length")
+# each sample is read and decoded once
+val_samples = (
+    decode_tensors(cached_dataset[i])
+    for i in range(min(args.num_validation_prompts, len(cached_dataset)))
+)
+val_batch = collate_fn(
+    [{k: sample[k] for k in VALIDATION_KEYS} for sample in val_samples]
 )
 
-optimizer = model.configure_optimizers()
+# in "steps" mode every loaded batch is trained on for `latent_reuse` steps,
+# in "batch" mode each step carries `latent_reuse` noised copies per sample
+batch_repeats = args.latent_reuse if args.latent_reuse_mode == "batch" else 1
+steps_per_batch = args.latent_reuse if args.latent_reuse_mode == "steps" else 1
 
-accelerator = accelerate.Accelerator()
+startup.mark("data")
+
+if args.gradient_checkpointing == "auto":
+    # probe with a full batch of the bucket holding the most latent tokens
+    probe_size = args.batch_size
+    if args.token_budget:
+        probe_size = args.token_budget // sum(
+            cached_dataset.token_counts(largest_indices[0])
+        )
+    probe_batch = collate_fn(
+        [cached_dataset[i] for i in largest_indices[: max(probe_size, 1)]]
+    )
+    if args.checkpoint_budget_gb is not None:
+        budget_bytes = int(args.checkpoint_budget_gb * 2**30)
+    else:
+        budget_bytes = int(0.8 * torch.cuda.mem_get_info(accelerator.device)[0])
+    model.configure_checkpointing(
+        "auto",
+        probe_batch=repeat_batch(probe_batch, batch_repeats),
+        budget_bytes=budget_bytes,
+    )
+
+token_budget = args.token_budget
+if args.probe_token_budget:
+    probe_batch = collate_fn([cached_dataset[largest_indices[0]]])
+    total_memory = torch.cuda.mem_get_info(accelerator.device)[1]
+    token_budget = probe_token_budget(
+        lambda batch_size: model.memory_probe_step(
+            probe_batch, batch_size * batch_repeats
+        ),
+        tokens_per_sample=sum(cached_dataset.token_counts(largest_indices[0])),
+        memory_limit=int(args.probe_memory_fraction * total_memory),
+        peak_memory=cuda_peak_memory(accelerator.device),
+        reset_peak=cuda_reset_peak(accelerator.device),
+        max_batch_size=args.max_batch_size or 256,
+    )
+    print(f"Probed token budget: {token_budget} tokens per step")
+
+startup.mark("probes")
+
+if token_budget:
+    train_sampler = TokenBudgetBatchSampler(
+        bucket_keys,
+        [cached_dataset.token_counts(i) for i in range(len(cached_dataset))],
+        token_budget=token_budget,
+        max_batch_size=args.max_batch_size,
+        drop_last=args.drop_last,
+        seed=args.seed,
+    )
+else:
+    train_sampler = BucketBatchSampler(
+        bucket_keys,
+        batch_size=args.batch_size,
+        drop_last=args.drop_last,
+        seed=args.seed,
+    )
+train_dataloader = torch.utils.data.DataLoader(
+    cached_dataset,
+    batch_sampler=train_sampler,
+    collate_fn=collate_fn,
+    num_workers=args.num_workers,
+    pin_memory=torch.cuda.is_available(),
+    persistent_workers=args.num_workers > 0,
+    prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+)
+# with variable batch sizes, dividing the summed per-sample losses by a fixed
+# normalizer keeps the weight of every sample independent of its bucket. With
+# --batch_size it is the batch size, so full batches train exactly as with a
+# plain mean and only partial batches weigh less; token budget batches have
+# no nominal size and use the mean one.
+loss_normalizer = None
+if args.loss_normalization == "sample":
+    nominal_batch_size = (
+        train_sampler.mean_batch_size() if token_budget else args.batch_size
+    )
+    loss_normalizer = nominal_batch_size * batch_repeats
+
+startup.mark("sampler")
+
+if args.compile:
+    # buckets are keyed by their latent grid, batch sizes as the sampler
+    # forms them
+    compile_shapes = {
+        (len(batch) * batch_repeats, bucket_keys[batch[0]])
+        for batch in train_sampler.batches()
+    }
+    model.compile_denoiser(
+        sorted(compile_shapes),
+        text_length=cached_dataset.token_counts(largest_indices[0])[1],
+        cache_dir=args.compile_cache_dir,
+        mode=args.compile_mode,
+    )
+
+startup.mark("compile")
+
+optimizer = model.configure_optimizers()
 
-model, optimizer, train_dataloader, val_dataloader = accelerator.prepare(
-    model, optimizer, train_dataloader, val_dataloader
+model, optimizer = accelerator.prepare(model, optimizer)
+# batches are moved by the prefetcher, accelerate only shards them
+train_dataloader = accelerator.prepare_data_loader(
+    train_dataloader, device_placement=False
 )
 
 model.to(accelerator.device)
-model.pipeline.to(accelerator.device)
+startup.mark("optimizer")
+
+# token budget batches are re-formed every epoch, their count varies slightly
+total_steps = (
+    len(train_dataloader) * args.max_epochs * steps_per_batch
+) // args.gradient_accumulation
 
-total_steps = len(train_dataloader) * args.max_epochs
+flux = accelerator.unwrap_model(model)
 
 model.train()
-val_batch = next(iter(val_dataloader))
 
 step = 0
+epoch = 0
+batch_in_epoch = 0
+
+checkpoint_manager = CheckpointManager(args.checkpoint_dir, keep_last=args.keep_last)
+resume_path = checkpoint_manager.latest() if args.resume == "latest" else args.resume
+if resume_path is not None:
+    state = checkpoint_manager.load(resume_path, flux.denoiser, optimizer)
+    step, epoch, batch_in_epoch = state["step"], state["epoch"], state["batch_in_epoch"]
+    # every rank continues its own sigma and noise stream
+    sampler_state = rank_state(state["timestep_sampler"], accelerator.process_index)
+    if sampler_state is not None:
+        flux.timestep_sampler.load_state_dict(sampler_state)
+    # the sampler counts global batches, each rank consumed one in num_processes
+    resume_loader(
+        train_dataloader,
+        train_sampler,
+        epoch,
+        batch_in_epoch * accelerator.num_processes,
+    )
+    total_steps -= step
+last_saved_step = step
+startup.mark("resume")
 
-lora_save_path = "lora_ckpt"
+# schedule-free optimizers must be switched to train mode explicitly
+optimizer.train()
+
+profiler = StepProfiler(
+    log_file=args.metrics_file if accelerator.is_main_process else None,
+    log_every=args.log_every,
+    use_wandb=accelerator.is_main_process,
+    device=accelerator.device,
+)
+
+# the copies are timed as h2d
+prefetcher = DevicePrefetcher(train_dataloader, flux.denoiser.device, profiler)
+accumulation = GradientAccumulation(
+    accelerator, model, args.gradient_accumulation, loss_normalizer
+)
+
+window = {"samples": 0, "image_tokens": 0, "text_tokens": 0, "loss": 0.0}
 
 while total_steps > 0:
-    for i, batch in enumerate(train_dataloader):
-        feeds, targets, metadata = batch
-        for k, v in feeds.items():
-            feeds[k] = v.to(model.denoiser.device)
-        noise_pred = model(**feeds)
-        loss = torch.nn.functional.mse_loss(
-            noise_pred.float(), targets.float(), reduction="mean"
-        )
-        print(f"Step {step} Loss {loss}")
-
-        # if step % 20 == 0:
-        #     print("Validating")
-        #     model = accelerator.unwrap_model(model)
-        #     model.save_lora(lora_save_path)
-        #     model.validation_step(val_batch, lora_save_path)
-        # wandb.log({"loss": loss})
-        step += 1
-        total_steps -= 1
-        accelerator.backward(loss)
-        optimizer.step()
-        optimizer.zero_grad()
+    # the next batch is copied to the device while the current one trains,
+    # waiting for the DataLoader shows up as data_wait, the copy as h2d
+    train_iter = iter(prefetcher)
+    while True:
+        with profiler.phase("data_wait", host=True):
+            clean_feeds = next(train_iter, None)
+        if clean_feeds is None:
+            break
+        batch_start_step = step
+        for _ in range(steps_per_batch):
+            with accumulation.micro_batch() as sync:
+                with profiler.phase("forward"):
+                    feeds, targets = flux.add_noise(clean_feeds, repeats=batch_repeats)
+                    noise_pred = model(**feeds)
+                    loss = accumulation.loss(flux.loss_fn, noise_pred, targets)
+                with profiler.phase("backward"):
+                    accelerator.backward(loss)
+            batch_size = feeds["latents"].shape[0]
+            window["samples"] += batch_size
+            window["image_tokens"] += batch_size * feeds["latents"].shape[1]
+            window["text_tokens"] += batch_size * feeds["prompt_embeds"].shape[1]
+            window["loss"] = window["loss"] + loss.detach()
+            if not sync:
+                continue
+            step += 1
+            total_steps -= 1
+            with profiler.phase("optimizer"):
+                optimizer.step()
+                optimizer.zero_grad()
+            record = profiler.step(
+                batch_size=window["samples"],
+                image_tokens=window["image_tokens"] / window["samples"],
+                text_tokens=window["text_tokens"] / window["samples"],
+                loss=window["loss"],
+            )
+            window = {"samples": 0, "image_tokens": 0, "text_tokens": 0, "loss": 0.0}
+            if record is not None and accelerator.is_main_process:
+                print(format_record(record))
+            if startup is not None:
+                startup.mark("first_step")
+                if accelerator.is_main_process:
+                    print(startup.format())
+                    wandb.run.summary.update(
+                        {f"startup/{k}": v for k, v in startup.report().items()}
+                    )
+                startup = None
+            if step == 1 and accelerator.is_main_process:
+                # optimizer state only exists after the first update
+                print(
+                    f"Optimizer {args.optimizer} state: "
+                    f"{format_memory(optimizer_memory(optimizer))}"
+                )
+        batch_in_epoch += 1
+
+        if (
+            args.validate_every
+            and step // args.validate_every > batch_start_step // args.validate_every
+        ):
+            if accelerator.is_main_process:
+                flux.validation_step(
+                    val_batch,
+                    optimizer=optimizer,
+                    fuse_lora=args.fuse_lora_for_validation,
+                    steps=args.validation_inference_steps,
+                )
+            accelerator.wait_for_everyone()
+
+        # a checkpoint taken mid-step would drop the accumulated gradients
+        if (
+            args.save_every
+            and accumulation.pending == 0
+            and step - last_saved_step >= args.save_every
+        ):
+            last_saved_step = step
+            # one generator state per rank, gathered by every rank
+            sampler_states = accelerate.utils.gather_object(
+                [flux.timestep_sampler.state_dict()]
+            )
+            if accelerator.is_main_process:
+                checkpoint_manager.save(
+                    step,
+                    flux.denoiser,
+                    optimizer,
+                    {
+                        "epoch": epoch,
+                        "batch_in_epoch": batch_in_epoch,
+                        "timestep_sampler": sampler_states,
+                    },
+                )
+    epoch += 1
+    batch_in_epoch = 0
+
+checkpoint_manager.wait()
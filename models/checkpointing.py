@@ -0,0 +1,205 @@
+import collections
+import functools
+import weakref
+import torch
+from contextlib import contextmanager
+from typing import Callable, List, Sequence
+from torch.utils.checkpoint import checkpoint
+
+CHECKPOINT_POLICIES = ("all", "none", "double", "single", "auto")
+
+
+def transformer_blocks(model) -> List[torch.nn.Module]:
+    """
+    Double-stream blocks followed by single-stream blocks, in forward order.
+    Block indices used by the policies below refer to this list.
+    """
+    return list(model.transformer_blocks) + list(model.single_transformer_blocks or [])
+
+
+def _checkpointed(forward):
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        if torch.is_grad_enabled():
+            return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+
+    wrapper.is_checkpointed = True
+    return wrapper
+
+
+def apply_checkpointing(model, block_indices: Sequence[int]) -> List[int]:
+    """
+    Recomputes only the given blocks in the backward pass. The wrapper is
+    set on the block instance, so parameter names and saved LoRA weights are
+    unchanged. Replaces the model-wide `enable_gradient_checkpointing`.
+    """
+    if getattr(model, "gradient_checkpointing", False):
+        model.disable_gradient_checkpointing()
+    block_indices = sorted(set(block_indices))
+    for index, block in enumerate(transformer_blocks(model)):
+        if "forward" in block.__dict__:
+            del block.forward
+        if index in block_indices:
+            block.forward = _checkpointed(block.forward)
+    return block_indices
+
+
+def checkpointed_blocks(model) -> List[int]:
+    return [
+        index
+        for index, block in enumerate(transformer_blocks(model))
+        if getattr(block.__dict__.get("forward"), "is_checkpointed", False)
+    ]
+
+
+def parse_blocks(policy: str, num_double: int, num_single: int) -> List[int]:
+    """
+    Block indices for a fixed policy:
+    - "all" / "none"
+    - "double" / "single": every block of one stream type
+    - a fraction such as "0.5": that share of all blocks, evenly spaced
+    - explicit indices and ranges such as "0-9,19,25"
+    """
+    num_blocks = num_double + num_single
+    if policy == "all":
+        return list(range(num_blocks))
+    if policy == "none":
+        return []
+    if policy == "double":
+        return list(range(num_double))
+    if policy == "single":
+        return list(range(num_double, num_blocks))
+    if "," not in policy and "-" not in policy and "." in policy:
+        fraction = float(policy)
+        if not 0 <= fraction <= 1:
+            raise ValueError(f"Checkpoint fraction must be in [0, 1]: {policy}")
+        count = round(fraction * num_blocks)
+        if count == 0:
+            return []
+        return sorted({int(i * num_blocks / count) for i in range(count)})
+    indices = set()
+    for part in policy.split(","):
+        start, _, end = part.partition("-")
+        indices.update(range(int(start), int(end or start) + 1))
+    if indices and not 0 <= min(indices) <= max(indices) < num_blocks:
+        raise ValueError(f"Block indices out of range [0, {num_blocks}): {policy}")
+    return sorted(indices)
+
+
+@contextmanager
+def _track_current_block(blocks):
+    current = [None]
+    handles = []
+    for index, block in enumerate(blocks):
+        handles.append(
+            block.register_forward_pre_hook(
+                lambda module, args, index=index: current.__setitem__(0, index)
+            )
+        )
+        handles.append(
+            block.register_forward_hook(
+                lambda module, args, output: current.__setitem__(0, None)
+            )
+        )
+    try:
+        yield current
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def activation_bytes_per_block(model, probe: Callable[[], object]) -> List[int]:
+    """
+    Bytes of activations each block saves for backward while `probe` runs a
+    forward pass through `model` without checkpointing. Saved tensors are
+    counted and dropped immediately, so the probe needs no more memory than
+    a forward pass under `torch.no_grad`. A storage is counted once while
+    any tensor saved from it is alive; the allocator may hand a freed
+    address to a later activation, which is then counted again.
+    """
+    blocks = transformer_blocks(model)
+    block_bytes = [0] * len(blocks)
+    # storage address -> saved tensors of it still alive, per block
+    live = [collections.Counter() for _ in blocks]
+    param_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved_blocks = checkpointed_blocks(model)
+    apply_checkpointing(model, [])
+
+    def release(index, address):
+        live[index][address] -= 1
+        if not live[index][address]:
+            del live[index][address]
+
+    def pack(tensor):
+        index = current[0]
+        storage = tensor.untyped_storage()
+        address = storage.data_ptr()
+        if index is None or address in param_storages:
+            return
+        if address not in live[index]:
+            block_bytes[index] += storage.nbytes()
+        live[index][address] += 1
+        # views keep their base alive, the base lives as long as the storage
+        # in practice and dies before its address can be reused
+        base = tensor._base if tensor._base is not None else tensor
+        weakref.finalize(base, release, index, address)
+
+    try:
+        with _track_current_block(blocks) as current, torch.enable_grad():
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda _: None):
+                probe()
+    finally:
+        apply_checkpointing(model, saved_blocks)
+    return block_bytes
+
+
+def plan_checkpointing(block_bytes: Sequence[int], budget_bytes: int) -> List[int]:
+    """
+    Fewest blocks to recompute so the activations kept for backward fit in
+    `budget_bytes`. Blocks holding the most activations are checkpointed
+    first; a checkpointed block is treated as keeping nothing.
+    """
+    kept = sum(block_bytes)
+    selected = []
+    for index in sorted(range(len(block_bytes)), key=lambda i: -block_bytes[i]):
+        if kept <= budget_bytes:
+            break
+        selected.append(index)
+        kept -= block_bytes[index]
+    return sorted(selected)
+
+
+def configure_checkpointing(
+    model,
+    policy: str = "all",
+    probe: Callable[[], object] = None,
+    budget_bytes: int = None,
+) -> List[int]:
+    """
+    Applies a checkpointing policy and returns the checkpointed block
+    indices. "auto" measures the activations of `probe`, a forward pass on
+    the largest batch expected in training, and checkpoints just enough
+    blocks to fit them in `budget_bytes`.
+    """
+    if policy == "auto":
+        if probe is None or budget_bytes is None:
+            raise ValueError("auto checkpointing needs a probe and a budget")
+        block_bytes = activation_bytes_per_block(model, probe)
+        indices = plan_checkpointing(block_bytes, budget_bytes)
+        print(
+            f"Activation memory {sum(block_bytes) / 2**20:.1f}MB, "
+            f"budget {budget_bytes / 2**20:.1f}MB"
+        )
+    else:
+        indices = parse_blocks(
+            policy,
+            len(model.transformer_blocks),
+            len(model.single_transformer_blocks or []),
+        )
+    indices = apply_checkpointing(model, indices)
+    print(
+        f"Gradient checkpointing {policy}: "
+        f"{len(indices)}/{len(transformer_blocks(model))} blocks"
+    )
+    return indices
@@ -0,0 +1,232 @@
+"""
+Regional `torch.compile` of the Flux transformer blocks.
+
+Only the double and single stream blocks are compiled. Blocks of one type
+share their compiled code, so a shape costs two compiles instead of one per
+block, and the embedders, rotary cache and checkpointing policy stay eager.
+
+Shapes are known ahead of training: image tokens come from the bucket
+(static, one graph per bucket), text tokens vary with the longest caption
+of each batch (dynamic), and the batch size is static unless a bucket is
+seen with several batch sizes.
+"""
+
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import torch
+import torch._dynamo
+from models.checkpointing import transformer_blocks
+
+# block inputs and their text token dimension
+TEXT_DIMS = {"encoder_hidden_states": 1}
+ARTIFACTS_FILE = "compile_artifacts.bin"
+
+
+def plan_shapes(
+    shapes: Iterable[Tuple[int, Tuple[int, int]]],
+) -> Tuple[bool, List[Tuple[int, Tuple[int, int]]]]:
+    """
+    Whether the batch dimension must be dynamic, and the (batch size, latent
+    size) shapes to warm up. A dynamic batch is compiled once per latent
+    size at its largest batch, plus batch size 1, which is always
+    specialized.
+    """
+    batch_sizes = {}
+    for batch_size, latent_size in shapes:
+        batch_sizes.setdefault(tuple(latent_size), set()).add(batch_size)
+    dynamic_batch = any(len(sizes) > 1 for sizes in batch_sizes.values())
+    warmup = []
+    for latent_size, sizes in sorted(batch_sizes.items()):
+        if dynamic_batch:
+            sizes = {max(sizes)} | ({1} & sizes)
+        warmup.extend((batch_size, latent_size) for batch_size in sorted(sizes))
+    return dynamic_batch, warmup
+
+
+def synthetic_batch(
+    config,
+    batch_size: int,
+    latent_size: Tuple[int, int],
+    text_length: int,
+    dtype=torch.float32,
+    padded: bool = False,
+) -> dict:
+    """
+    Random collated batch shaped like cached samples of one bucket, for a
+    transformer `config`. With `padded`, the last text token is padding.
+    """
+    height, width = latent_size
+    text_attention_mask = torch.ones(batch_size, text_length, dtype=torch.bool)
+    if padded:
+        text_attention_mask[:, -1] = False
+    return {
+        "latents": torch.randn(
+            batch_size, height * width, config.in_channels, dtype=dtype
+        ),
+        "prompt_embeds": torch.randn(
+            batch_size, text_length, config.joint_attention_dim, dtype=dtype
+        ),
+        "pooled_prompt_embeds": torch.randn(
+            batch_size, config.pooled_projection_dim, dtype=dtype
+        ),
+        "guidance": torch.full((batch_size,), 3.5, dtype=dtype),
+        "latent_size": tuple(latent_size),
+        "text_attention_mask": text_attention_mask,
+    }
+
+
+def _dense(tensor: torch.Tensor) -> torch.Tensor:
+    # views into the joint text + image sequence would guard on strides that
+    # depend on the text length, also on size 1 dims which `contiguous` keeps
+    return tensor.contiguous().view(tensor.shape)
+
+
+def _mark_dims(kwargs: dict, dynamic_batch: bool) -> dict:
+    marked = {}
+    for name, value in kwargs.items():
+        if torch.is_tensor(value):
+            value = _dense(value)
+            if name in TEXT_DIMS:
+                torch._dynamo.maybe_mark_dynamic(value, TEXT_DIMS[name])
+            if dynamic_batch:
+                torch._dynamo.maybe_mark_dynamic(value, 0)
+        elif name == "image_rotary_emb" and value is not None:
+            # (text + image tokens, dim), its length follows the text length
+            value = tuple(_dense(t) for t in value)
+            for t in value:
+                torch._dynamo.maybe_mark_dynamic(t, 0)
+        elif name == "joint_attention_kwargs" and value and "attention_mask" in value:
+            mask = _dense(value["attention_mask"])
+            torch._dynamo.maybe_mark_dynamic(mask, mask.ndim - 1)
+            if dynamic_batch:
+                torch._dynamo.maybe_mark_dynamic(mask, 0)
+            value = {**value, "attention_mask": mask}
+        marked[name] = value
+    return marked
+
+
+def compile_blocks(
+    model,
+    backend="inductor",
+    mode: str = None,
+    dynamic_batch: bool = False,
+    num_shapes: int = 8,
+) -> int:
+    """
+    Compiles every transformer block of `model` in place and returns the
+    number of blocks. `num_shapes` is the number of distinct (batch, image
+    tokens) shapes expected, it raises the recompile limit so none of them
+    falls back to eager. Blocks are called with keyword arguments by the
+    diffusers transformer.
+    """
+    # a recompile must not turn the static image dimension dynamic
+    torch._dynamo.config.automatic_dynamic_shapes = False
+    # a graph per shape, block type and checkpointing / requires_grad variant
+    limit = 8 * num_shapes
+    torch._dynamo.config.recompile_limit = max(
+        torch._dynamo.config.recompile_limit, limit
+    )
+    torch._dynamo.config.accumulated_recompile_limit = max(
+        torch._dynamo.config.accumulated_recompile_limit, 4 * limit
+    )
+    blocks = transformer_blocks(model)
+    for block in blocks:
+        compiled = torch.compile(
+            block._call_impl, backend=backend, mode=mode, dynamic=False
+        )
+
+        def call(*args, _compiled=compiled, **kwargs):
+            return _compiled(*args, **_mark_dims(kwargs, dynamic_batch))
+
+        # nn.Module.__call__ dispatches here, as after `Module.compile`
+        block._compiled_call_impl = call
+    return len(blocks)
+
+
+def enable_compile_cache(cache_dir: str):
+    """
+    Keeps inductor's FX graph and autograd caches in `cache_dir` and loads
+    the artifacts saved by a previous run with `save_compile_cache`. Dynamo
+    still traces every shape, code generation and C++/Triton builds are
+    skipped. Call before the first compile.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    path = os.path.join(cache_dir, ARTIFACTS_FILE)
+    if os.path.exists(path) and hasattr(torch.compiler, "load_cache_artifacts"):
+        with open(path, "rb") as f:
+            torch.compiler.load_cache_artifacts(f.read())
+        print(f"Loaded compile cache from {path}")
+
+
+def save_compile_cache(cache_dir: str):
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is not None:
+        data, _ = artifacts
+        path = os.path.join(cache_dir, ARTIFACTS_FILE)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def warmup_shapes(
+    run_step: Callable[[int, Tuple[int, int]], None],
+    shapes: Sequence[Tuple[int, Tuple[int, int]]],
+    device="cpu",
+) -> Dict[tuple, float]:
+    """
+    Runs `run_step(batch_size, latent_size)` once per shape so compilation
+    happens before training. Returns the seconds spent on each shape.
+    """
+    seconds = {}
+    for batch_size, latent_size in shapes:
+        _synchronize(device)
+        start = time.perf_counter()
+        run_step(batch_size, latent_size)
+        _synchronize(device)
+        seconds[(batch_size, tuple(latent_size))] = time.perf_counter() - start
+        print(
+            f"Compiled batch {batch_size} latent {latent_size[0]}x{latent_size[1]} "
+            f"in {seconds[(batch_size, tuple(latent_size))]:.1f}s"
+        )
+    return seconds
+
+
+def time_steps(run_step: Callable[[], None], iters: int, device="cpu") -> float:
+    """
+    Median seconds of `run_step` over `iters` calls.
+    """
+    times = []
+    for _ in range(iters):
+        _synchronize(device)
+        start = time.perf_counter()
+        run_step()
+        _synchronize(device)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def compile_report(
+    compile_seconds: float, eager_step: float, compiled_step: float
+) -> dict:
+    """
+    Compile cost against steady state speedup, with the number of steps
+    after which compiling has paid for itself.
+    """
+    saved = eager_step - compiled_step
+    return {
+        "compile_seconds": compile_seconds,
+        "eager_step_ms": eager_step * 1000,
+        "compiled_step_ms": compiled_step * 1000,
+        "speedup": eager_step / compiled_step,
+        "break_even_steps": compile_seconds / saved if saved > 0 else float("inf"),
+    }
@@ -0,0 +1,90 @@
+"""
+Loads only the Flux transformer for training.
+
+The model is built on the meta device and its weights are read from
+memory mapped safetensors files directly onto the target device, cast
+tensor by tensor, so neither a full fp32 copy nor the rest of the pipeline
+(VAE, text encoders, tokenizers) is ever materialized.
+"""
+
+import glob
+import json
+import os
+import torch
+from safetensors import safe_open
+
+TRANSFORMER_SUBFOLDER = "transformer"
+SAFETENSORS_INDEX = "diffusion_pytorch_model.safetensors.index.json"
+
+
+def resolve_model_dir(pretrained_path: str, subfolder: str = None) -> str:
+    """
+    Local folder holding the config and weights, downloading only that
+    subfolder of a hub repository.
+    """
+    if os.path.isdir(pretrained_path):
+        root = pretrained_path
+    else:
+        from huggingface_hub import snapshot_download
+
+        patterns = [f"{subfolder}/*"] if subfolder else None
+        root = snapshot_download(pretrained_path, allow_patterns=patterns)
+    return os.path.join(root, subfolder) if subfolder else root
+
+
+def weight_files(model_dir: str):
+    index_path = os.path.join(model_dir, SAFETENSORS_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [
+            os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))
+        ]
+    files = sorted(glob.glob(os.path.join(model_dir, "*.safetensors")))
+    if not files:
+        raise FileNotFoundError(f"No safetensors weights in {model_dir}")
+    return files
+
+
+def load_transformer(
+    pretrained_path: str,
+    subfolder: str = TRANSFORMER_SUBFOLDER,
+    torch_dtype: torch.dtype = torch.bfloat16,
+    device="cuda",
+    model_cls=None,
+):
+    """
+    Builds `model_cls` (diffusers' `FluxTransformer2DModel` by default) from
+    the config in `pretrained_path/subfolder` and loads its safetensors
+    weights onto `device` in `torch_dtype`.
+    """
+    if model_cls is None:
+        from diffusers import FluxTransformer2DModel as model_cls
+
+    model_dir = resolve_model_dir(pretrained_path, subfolder)
+    config = model_cls.load_config(model_dir)
+    with torch.device("meta"):
+        model = model_cls.from_config(config)
+    expected = set(model.state_dict())
+    loaded = set()
+    device = torch.device(device)
+    for path in weight_files(model_dir):
+        # safetensors maps the file and copies each tensor straight to device
+        with safe_open(path, framework="pt", device=str(device)) as f:
+            state_dict = {}
+            for name in f.keys():
+                tensor = f.get_tensor(name)
+                if tensor.is_floating_point():
+                    tensor = tensor.to(torch_dtype)
+                state_dict[name] = tensor
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        loaded.update(state_dict)
+    missing = expected - loaded
+    if missing:
+        raise RuntimeError(f"Missing weights in {model_dir}: {sorted(missing)[:5]}")
+    # buffers missing from the checkpoint would stay on the meta device
+    for module in model.modules():
+        for name, buffer in module.named_buffers(recurse=False):
+            if buffer.is_meta:
+                raise RuntimeError(f"Buffer {name} of {type(module)} is not loaded")
+    return model.eval().requires_grad_(False)
@@ -0,0 +1,46 @@
+import torch
+from contextlib import contextmanager
+from peft import LoraConfig
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+LORA_TARGET_MODULES = ["to_k", "to_q", "to_v", "to_out.0."]
+
+
+def apply_lora(
+    model,
+    rank=32,
+    alpha=32,
+    init_lora_weights="gaussian",
+    target_modules=LORA_TARGET_MODULES,
+):
+    transformer_lora_config = LoraConfig(
+        r=rank,
+        lora_alpha=alpha,
+        init_lora_weights=init_lora_weights,
+        target_modules=target_modules,
+    )
+    model.add_adapter(transformer_lora_config)
+
+
+@contextmanager
+def fused_lora(model, enabled: bool = True):
+    """
+    Merges the LoRA adapters into the base weights for faster sampling. The
+    base weights are restored from a host copy afterwards, unmerging in low
+    precision would slowly drift them.
+    """
+    layers = (
+        [m for m in model.modules() if isinstance(m, BaseTunerLayer)] if enabled else []
+    )
+    base_weights = [
+        layer.get_base_layer().weight.detach().to("cpu", copy=True) for layer in layers
+    ]
+    for layer in layers:
+        layer.merge()
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for layer, weight in zip(layers, base_weights):
+                layer.get_base_layer().weight.copy_(weight)
+                layer.merged_adapters.clear()
@@ -1,10 +1,72 @@
 import torch
 from diffusers import FluxTransformer2DModel
+from diffusers.utils import logging
 import torch
 import torch.nn as nn
+from contextlib import nullcontext
+from typing import Tuple
+from torch.utils.checkpoint import checkpoint
+from models.rotary import position_ids, rotary_key
+
+logger = logging.get_logger(__name__)
+
+# small enough to build, run and backprop on a laptop cpu
+TINY_FLUX_CONFIG = {
+    "patch_size": 1,
+    "in_channels": 64,
+    "num_layers": 2,
+    "num_single_layers": 2,
+    "attention_head_dim": 32,
+    "num_attention_heads": 4,
+    "joint_attention_dim": 256,
+    "pooled_projection_dim": 64,
+    "guidance_embeds": True,
+    "axes_dims_rope": (8, 12, 12),
+}
+
+
+def make_inputs(
+    model, resolution, text_length: int, batch_size: int, device, dtype
+) -> dict:
+    """
+    Random inputs shaped like a cached sample of the given bucket resolution.
+    """
+    width, height = resolution
+    # the flux vae downsamples by 8 and latents are packed 2x2
+    latent_height, latent_width = height // 16, width // 16
+    config = model.config
+    img_ids = torch.zeros(latent_height, latent_width, 3)
+    img_ids[..., 1] = torch.arange(latent_height)[:, None]
+    img_ids[..., 2] = torch.arange(latent_width)[None, :]
+    inputs = {
+        "hidden_states": torch.randn(
+            batch_size, latent_height * latent_width, config.in_channels
+        ),
+        "encoder_hidden_states": torch.randn(
+            batch_size, text_length, config.joint_attention_dim
+        ),
+        "pooled_projections": torch.randn(batch_size, config.pooled_projection_dim),
+        "timestep": torch.rand(batch_size),
+        "img_ids": img_ids.reshape(-1, 3),
+        "txt_ids": torch.zeros(text_length, 3),
+        "guidance": torch.full((batch_size,), 3.5) if config.guidance_embeds else None,
+    }
+    return {
+        k: v.to(device, dtype) if v is not None and v.is_floating_point() else v
+        for k, v in inputs.items()
+    }
 
 
 class PartialFluxTransformer2DModel(FluxTransformer2DModel):
+    @classmethod
+    def from_tiny_config(cls, seed: int = 0, **overrides):
+        """
+        Builds a randomly initialized model from `TINY_FLUX_CONFIG`, no weights
+        are downloaded.
+        """
+        torch.manual_seed(seed)
+        return cls(**{**TINY_FLUX_CONFIG, **overrides})
+
     def truncate(self):
         self.single_transformer_blocks = None
         self.transformer_blocks = self.transformer_blocks[:1]
@@ -18,6 +80,7 @@ class PartialFluxTransformer2DModel(FluxTransformer2DModel):
         img_ids: torch.Tensor = None,
         txt_ids: torch.Tensor = None,
         guidance: torch.Tensor = None,
+        latent_size: Tuple[int, int] = None,
     ):
         """
         The [`FluxTransformer2DModel`] forward method.
@@ -37,6 +100,9 @@ class PartialFluxTransformer2DModel(FluxTransformer2DModel):
                 A kwargs dictionary that if specified is passed along to the `AttentionProcessor` as defined under
                 `self.processor` in
                 [diffusers.models.attention_processor](https://github.com/huggingface/diffusers/blob/main/src/diffusers/models/attention_processor.py).
+            latent_size (`Tuple[int, int]`, *optional*):
+                Height and width of the packed latent grid. When given, missing `txt_ids` / `img_ids` are generated
+                and the rotary embeddings are memoized per (text length, latent size).
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~models.transformer_2d.Transformer2DModelOutput`] instead of a plain
                 tuple.
@@ -60,6 +126,11 @@ class PartialFluxTransformer2DModel(FluxTransformer2DModel):
         )
         encoder_hidden_states = self.context_embedder(encoder_hidden_states)
 
+        text_length = encoder_hidden_states.shape[1]
+        if latent_size is not None and (txt_ids is None or img_ids is None):
+            txt_ids, img_ids = position_ids(
+                text_length, latent_size, hidden_states.device
+            )
         if txt_ids.ndim == 3:
             logger.warning(
                 "Passing `txt_ids` 3d torch.Tensor is deprecated."
@@ -73,14 +144,30 @@ class PartialFluxTransformer2DModel(FluxTransformer2DModel):
             )
             img_ids = img_ids[0]
         ids = torch.cat((txt_ids, img_ids), dim=0)
-        image_rotary_emb = self.pos_embed(ids)
+        with (
+            rotary_key(self, text_length, latent_size)
+            if latent_size is not None
+            else nullcontext()
+        ):
+            image_rotary_emb = self.pos_embed(ids)
 
-        for index_block, block in enumerate(self.transformer_blocks):
-            encoder_hidden_states, hidden_states = block(
-                hidden_states=hidden_states,
-                encoder_hidden_states=encoder_hidden_states,
-                temb=temb,
-                image_rotary_emb=image_rotary_emb,
-            )
+        single_blocks = self.single_transformer_blocks or []
+        for block in list(self.transformer_blocks) + list(single_blocks):
+            if torch.is_grad_enabled() and self.gradient_checkpointing:
+                encoder_hidden_states, hidden_states = checkpoint(
+                    block,
+                    hidden_states,
+                    encoder_hidden_states,
+                    temb,
+                    image_rotary_emb,
+                    use_reentrant=False,
+                )
+            else:
+                encoder_hidden_states, hidden_states = block(
+                    hidden_states=hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                )
 
         return encoder_hidden_states, hidden_states
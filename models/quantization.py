@@ -0,0 +1,45 @@
+import torch
+from optimum.quanto import freeze, qfloat8, qint4, qint8, quantize
+
+QUANTO_WEIGHTS = {"qfloat8": qfloat8, "qint8": qint8, "qint4": qint4}
+
+# adapters stay trainable in high precision, the small input/output
+# projections are kept as is for accuracy
+QUANTIZE_EXCLUDE = [
+    "*lora_A*",
+    "*lora_B*",
+    "x_embedder",
+    "context_embedder",
+    "proj_out",
+    "norm_out*",
+    "time_text_embed*",
+]
+
+
+def quantize_base_weights(
+    model,
+    weights: str = "qint8",
+    exclude=QUANTIZE_EXCLUDE,
+    lora_dtype: torch.dtype = None,
+):
+    """
+    Quantizes the frozen base weights of a model that already carries LoRA
+    adapters. Only the adapters remain trainable, optionally upcast to
+    `lora_dtype`.
+    """
+    quantize(model, weights=QUANTO_WEIGHTS[weights], exclude=exclude)
+    freeze(model)
+    for name, param in model.named_parameters():
+        is_lora = "lora_" in name
+        param.requires_grad_(is_lora)
+        if is_lora and lora_dtype is not None:
+            param.data = param.data.to(lora_dtype)
+    return model
+
+
+def state_dict_bytes(model) -> int:
+    """
+    Size of the model weights, quantized tensors counted by their packed data
+    and scales.
+    """
+    return sum(t.numel() * t.element_size() for t in model.state_dict().values())
@@ -0,0 +1,89 @@
+import torch
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Tuple
+from torch import nn
+
+
+@lru_cache(maxsize=64)
+def _position_ids(text_length: int, height: int, width: int, device: str):
+    text_ids = torch.zeros(text_length, 3, device=device)
+    image_ids = torch.zeros(height, width, 3, device=device)
+    image_ids[..., 1] = torch.arange(height, device=device)[:, None]
+    image_ids[..., 2] = torch.arange(width, device=device)[None, :]
+    return text_ids, image_ids.reshape(height * width, 3)
+
+
+def position_ids(
+    text_length: int, latent_size: Tuple[int, int], device="cpu"
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Flux text ids (all zeros) and image ids (row, column) for a packed latent
+    grid of `latent_size` = (height, width). Memoized, do not modify in place.
+    """
+    height, width = latent_size
+    return _position_ids(text_length, height, width, str(torch.device(device)))
+
+
+class CachedPosEmbed(nn.Module):
+    """
+    Memoizes the rotary embeddings of a `FluxPosEmbed`. The embedding is
+    computed row by row, so the image part is cached per latent grid and the
+    text part, whose ids are all zeros, is one cached row repeated. Caching
+    only applies while a key is set with `rotary_key`; ids passed without a
+    key are embedded as usual.
+    """
+
+    def __init__(self, pos_embed: nn.Module, capacity: int = 32):
+        super().__init__()
+        self.pos_embed = pos_embed
+        self.capacity = capacity
+        self.key = None
+        self._image = OrderedDict()
+        self._text = {}
+
+    def _text_row(self, ids: torch.Tensor):
+        if ids.device not in self._text:
+            self._text[ids.device] = self.pos_embed(ids.new_zeros(1, ids.shape[-1]))
+        return self._text[ids.device]
+
+    def _image_rows(self, key, ids: torch.Tensor):
+        if key in self._image:
+            self._image.move_to_end(key)
+        else:
+            self._image[key] = self.pos_embed(ids)
+            if len(self._image) > self.capacity:
+                self._image.popitem(last=False)
+        return self._image[key]
+
+    def forward(self, ids: torch.Tensor):
+        if self.key is None:
+            return self.pos_embed(ids)
+        text_length, height, width = self.key
+        text = self._text_row(ids)
+        image = self._image_rows((height, width, ids.device), ids[text_length:])
+        return tuple(
+            torch.cat([t.expand(text_length, -1), i], dim=0)
+            for t, i in zip(text, image)
+        )
+
+
+def enable_rotary_cache(model, capacity: int = 32):
+    if not isinstance(model.pos_embed, CachedPosEmbed):
+        model.pos_embed = CachedPosEmbed(model.pos_embed, capacity=capacity)
+    return model.pos_embed
+
+
+@contextmanager
+def rotary_key(model, text_length: int, latent_size: Tuple[int, int]):
+    """
+    Marks the position ids of the forward passes in the block as those of
+    `position_ids(text_length, latent_size)`, so their embeddings are reused.
+    """
+    pos_embed = enable_rotary_cache(model)
+    pos_embed.key = (text_length, *latent_size)
+    try:
+        yield
+    finally:
+        pos_embed.key = None
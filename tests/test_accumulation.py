@@ -0,0 +1,41 @@
+import accelerate
+import functools
+import pytest
+import torch
+from lightning_modules.lightning_flux import FluxLightning
+from training.accumulation import GradientAccumulation
+
+# the loss does not touch the module, which needs the Flux weights to build
+loss_fn = functools.partial(FluxLightning.loss_fn, None)
+
+
+def gradients(model, inputs, targets, normalizer, steps):
+    accelerator = accelerate.Accelerator(cpu=True)
+    prepared = accelerator.prepare(model)
+    accumulation = GradientAccumulation(accelerator, prepared, steps, normalizer)
+    syncs = []
+    for micro_inputs, micro_targets in zip(inputs.chunk(steps), targets.chunk(steps)):
+        with accumulation.micro_batch() as sync:
+            loss = accumulation.loss(loss_fn, prepared(micro_inputs), micro_targets)
+            accelerator.backward(loss)
+        syncs.append(sync)
+    assert syncs == [False] * (steps - 1) + [True]
+    assert accumulation.pending == 0
+    grads = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+    return grads
+
+
+@pytest.mark.parametrize("normalization", ["sample", "batch"])
+def test_accumulated_micro_batches_match_full_batch(normalization):
+    torch.manual_seed(0)
+    model = torch.nn.Linear(8, 8)
+    inputs, targets = torch.randn(6, 4, 8), torch.randn(6, 4, 8)
+    # main.py normalizes by the per micro-batch size, the full batch by all
+    micro_normalizer = 2 if normalization == "sample" else None
+    full_normalizer = 6 if normalization == "sample" else None
+
+    full = gradients(model, inputs, targets, full_normalizer, steps=1)
+    accumulated = gradients(model, inputs, targets, micro_normalizer, steps=3)
+    for expected, actual in zip(full, accumulated):
+        torch.testing.assert_close(actual, expected)
@@ -0,0 +1,118 @@
+import functools
+import os
+import types
+import diffusers
+import pytest
+import torch
+from diffusers.image_processor import VaeImageProcessor
+from data.cache_codec import (
+    decode_tensors,
+    encode_tensors,
+    image_psnr,
+    quantize,
+    reconstruction_report,
+)
+from data.cache_data import CacheFlux
+from data.core_data import CoreCachedDataset, collate_fn, move_batch
+from data.shard_cache import ShardWriter
+from data.text_cache import TEXT_SUBDIR
+
+
+def make_sample(seed, text_length):
+    generator = torch.Generator().manual_seed(seed)
+    latents = torch.randn(1, 12, 64, generator=generator)
+    # a few outlier channels, as in T5 embeddings
+    prompt_embeds = torch.randn(1, text_length, 32, generator=generator)
+    prompt_embeds[..., :2] *= 50
+    return {
+        "latents": latents.to(torch.bfloat16),
+        "prompt_embeds": prompt_embeds.to(torch.bfloat16),
+        "pooled_prompt_embeds": torch.randn(1, 16, generator=generator),
+    }
+
+
+@pytest.mark.parametrize("storage_format", ["int8", "fp8"])
+def test_per_channel_quantization_roundtrip(storage_format):
+    sample = make_sample(0, 5)
+    q, scale = quantize(sample["prompt_embeds"], storage_format)
+    assert q.element_size() == 1
+    assert scale.shape == (1, 1, 32) and scale.dtype == torch.bfloat16
+    assert quantize(sample["pooled_prompt_embeds"], storage_format)[1].shape == (1, 1)
+
+    report = reconstruction_report([sample], [storage_format])[storage_format]
+    # scales are a large share of these tiny tensors
+    assert report["compression"] > 1.5
+    assert report["latents_rel_l2"] < 0.05
+    assert report["prompt_embeds_rel_l2"] < 0.05
+
+
+def test_device_dequantization_matches_dataset(tmp_path):
+    samples = [make_sample(i, length) for i, length in enumerate([3, 5])]
+    with ShardWriter(os.path.join(tmp_path, TEXT_SUBDIR)) as writer:
+        for i, sample in enumerate(samples):
+            text = {k: v for k, v in sample.items() if k != "latents"}
+            writer.add(
+                f"t{i}", encode_tensors(text, "int8"), {"text_length": 3 + 2 * i}
+            )
+    with ShardWriter(str(tmp_path)) as writer:
+        for i, sample in enumerate(samples):
+            writer.add(
+                f"{i}",
+                encode_tensors({"latents": sample["latents"]}, "int8"),
+                {"text_key": f"t{i}", "latent_size": [3, 4]},
+            )
+
+    on_host = CoreCachedDataset(str(tmp_path))
+    on_device = CoreCachedDataset(str(tmp_path), dequantize_on="device")
+    assert on_host[0]["latents"].dtype == torch.bfloat16
+    assert on_device[0]["latents"].dtype == torch.int8
+
+    expected = collate_fn([on_host[0], on_host[1]])
+    batch = collate_fn([on_device[0], on_device[1]])
+    assert batch["prompt_embeds"].dtype == torch.int8
+    actual = move_batch(batch, "cpu")
+    assert set(actual) == set(expected)
+    for key, value in expected.items():
+        if torch.is_tensor(value):
+            assert torch.equal(actual[key], value), key
+    assert torch.equal(
+        decode_tensors(on_device[1])["prompt_embeds"], on_host[1]["prompt_embeds"]
+    )
+
+
+class UpsamplingVAE(torch.nn.Module):
+    """
+    Stands in for the FLUX VAE: 16 latent channels, 8x compression.
+    """
+
+    config = types.SimpleNamespace(scaling_factor=1.0, shift_factor=0.0)
+
+    def decode(self, latents, return_dict=False):
+        assert latents.shape[1] == 16
+        image = torch.nn.functional.interpolate(latents[:, :3], scale_factor=8)
+        return (image.clamp(-1, 1),)
+
+
+def test_image_psnr_decodes_real_sizes():
+    # CacheFlux attributes as set up for FLUX, without loading the model
+    cache_flux = types.SimpleNamespace(
+        pipeline=types.SimpleNamespace(
+            _unpack_latents=diffusers.FluxPipeline._unpack_latents,
+            vae=UpsamplingVAE(),
+        ),
+        vae_scale_factor=16,
+        image_processor=VaeImageProcessor(vae_scale_factor=16),
+        device="cpu",
+    )
+    cache_flux.decode_from_latent = functools.partial(
+        CacheFlux.decode_from_latent, cache_flux
+    )
+    # a 1024x768 (height x width) image
+    latents = torch.rand(1, 64 * 48, 64) * 2 - 1
+    reference = {"latents": latents, "latent_size": (64, 48)}
+    image = cache_flux.decode_from_latent(latents, 1024, 768)
+    assert image.size == (768, 1024)
+
+    assert image_psnr(cache_flux, reference, dict(reference)) > 100
+    noisy = {"latents": latents + 0.05 * torch.randn_like(latents)}
+    assert 20 < image_psnr(cache_flux, reference, noisy) < 100
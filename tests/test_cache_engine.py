@@ -0,0 +1,107 @@
+import json
+from PIL import Image
+from torch.utils.data import Dataset
+from data.cache_engine import CacheEngine
+from data.core_data import CoreDataset
+
+
+class ListDataset(Dataset):
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        return Image.new("RGB", self.sizes[index]), f"caption {index}"
+
+
+class KeyedDataset(ListDataset):
+    def __init__(self, sizes, captions):
+        super().__init__(sizes)
+        self.captions = captions
+        self.decoded = []
+
+    def cache_key(self, index, settings):
+        return f"{self.captions[index]}-{settings['dtype']}"
+
+    def __getitem__(self, index):
+        self.decoded.append(index)
+        return Image.new("RGB", self.sizes[index]), self.captions[index]
+
+
+class RecordingCacheFlux:
+    def __init__(self):
+        self.batches = []
+        self.written = {}
+        self.closed = False
+
+    def encode_batch(self, images, prompts):
+        self.batches.append([image.size for image in images])
+        return [{"prompt": prompt} for prompt in prompts]
+
+    def write(self, feeds, filename):
+        self.written[filename] = feeds
+
+    def close(self):
+        self.closed = True
+
+
+class IncrementalCacheFlux(RecordingCacheFlux):
+    encoder_settings = {"dtype": "bf16"}
+
+    def is_cached(self, filename):
+        return filename in self.written
+
+    def retain(self, filenames):
+        stale = set(self.written) - set(filenames)
+        for filename in stale:
+            del self.written[filename]
+        return len(stale)
+
+
+def test_engine_batches_by_bucket_and_writes_all():
+    sizes = [(64, 32), (32, 64)] * 5
+    cache_flux = RecordingCacheFlux()
+    meters = CacheEngine(cache_flux, batch_size=3, num_workers=2, prefetch=4).run(
+        ListDataset(sizes)
+    )
+
+    assert cache_flux.closed
+    assert all(len(set(batch)) == 1 for batch in cache_flux.batches)
+    assert sorted(len(batch) for batch in cache_flux.batches) == [2, 2, 3, 3]
+    assert len(cache_flux.written) == len(sizes)
+    assert cache_flux.written["00000007"] == {"prompt": "caption 7"}
+    assert meters["encode"].images == len(sizes)
+    assert meters["write"].images == len(sizes)
+
+
+def test_engine_only_encodes_new_content():
+    cache_flux = IncrementalCacheFlux()
+    dataset = KeyedDataset([(64, 32)] * 3, ["a", "b", "a"])
+    CacheEngine(cache_flux, batch_size=2, num_workers=2).run(dataset)
+    # identical content is encoded once
+    assert sorted(cache_flux.written) == ["a-bf16", "b-bf16"]
+    assert len(dataset.decoded) == 2
+
+    dataset = KeyedDataset([(64, 32)] * 3, ["b", "c", "d"])
+    CacheEngine(cache_flux, batch_size=2, num_workers=2).run(dataset)
+    assert sorted(dataset.decoded) == [1, 2]
+    assert sorted(cache_flux.written) == ["b-bf16", "c-bf16", "d-bf16"]
+
+
+def test_core_dataset_cache_key_tracks_content(tmp_path):
+    Image.new("RGB", (1024, 768)).save(tmp_path / "a.png")
+    with open(tmp_path / "metadata.json", "w") as f:
+        json.dump([{"image_path": "a.png", "caption": "a cat"}], f)
+    dataset = CoreDataset(str(tmp_path / "metadata.json"), str(tmp_path))
+    settings = {"dtype": "torch.bfloat16"}
+    key = dataset.cache_key(0, settings)
+
+    assert dataset.cache_key(0, settings) == key
+    assert dataset.cache_key(0, {"dtype": "torch.float32"}) != key
+    dataset.metadata[0]["caption"] = "a dog"
+    assert dataset.cache_key(0, settings) != key
+    dataset.metadata[0]["caption"] = "a cat"
+    Image.new("RGB", (1024, 768), "white").save(tmp_path / "a.png")
+    assert dataset.cache_key(0, settings) != key
@@ -3,9 +3,10 @@
 
 from lightning_modules.lightning_flux import FluxLightning
 from data.cache_data import CacheFlux
+from data.cache_engine import CacheEngine
 from data.core_data import CoreDataset, CoreCachedDataset, collate_fn
+from data.sampler import BucketBatchSampler
 from torch.utils.data import DataLoader
-from tqdm import tqdm
 import torch
 import gc
 
@@ -22,12 +23,8 @@ root_folder = "dataset/itay_test/images"
 torch_dtype = torch.bfloat16
 
 dataset = CoreDataset(root_folder=root_folder, metadata_file=metadata_file)
-pbar = tqdm(desc=f"Caching root folder: {root_folder}", total=len(dataset))
 cache_flux = CacheFlux(save_dir="debug/test_cache", torch_dtype=torch_dtype)
-for item in dataset:
-    image, caption = item
-    cache_flux(image, caption, "image")
-    pbar.update(1)
+CacheEngine(cache_flux, batch_size=4, num_workers=4).run(dataset)
 
 del cache_flux
 
@@ -35,8 +32,11 @@ flush()
 
 cached_dataset = CoreCachedDataset(cached_folder="debug/test_cache")
 
+batch_sampler = BucketBatchSampler(
+    [cached_dataset.bucket_key(i) for i in range(len(cached_dataset))], batch_size=2
+)
 dataloader = DataLoader(
-    cached_dataset, batch_size=2, shuffle=True, collate_fn=collate_fn
+    cached_dataset, batch_sampler=batch_sampler, collate_fn=collate_fn
 )
 
 flux_lightning = FluxLightning(denoiser_pretrained_path="black-forest-labs/FLUX.1-dev")
@@ -0,0 +1,81 @@
+import os
+import pytest
+import schedulefree
+import torch
+from peft.utils import get_peft_model_state_dict
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+from lightning_modules.noise_schedule import build_timestep_sampler
+from training.checkpoint import CheckpointManager, rank_state
+
+
+def build():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    model.requires_grad_(False)
+    apply_lora(model, rank=4, alpha=4)
+    optimizer = schedulefree.AdamWScheduleFree(
+        [p for p in model.parameters() if p.requires_grad], lr=1e-2
+    )
+    optimizer.train()
+    return model, optimizer
+
+
+def train(model, optimizer, steps):
+    for i in range(steps):
+        torch.manual_seed(i)
+        inputs = make_inputs(model, (64, 64), 8, 1, "cpu", torch.float32)
+        _, hidden_states = model(**inputs)
+        hidden_states.pow(2).mean().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+
+def test_resume_reproduces_uninterrupted_run(tmp_path):
+    model, optimizer = build()
+    manager = CheckpointManager(str(tmp_path), keep_last=2)
+    for step in range(1, 4):
+        train(model, optimizer, 1)
+        manager.save(step, model, optimizer, {"epoch": 0, "batch_in_epoch": step})
+    train(model, optimizer, 2)
+    manager.wait()
+    expected = get_peft_model_state_dict(model)
+
+    assert manager.checkpoints() == ["checkpoint-00000002", "checkpoint-00000003"]
+    latest = manager.latest()
+    assert os.path.exists(os.path.join(latest, "pytorch_lora_weights.safetensors"))
+
+    model, optimizer = build()
+    state = manager.load(latest, model, optimizer)
+    assert state["step"] == 3 and state["batch_in_epoch"] == 3
+    train(model, optimizer, 2)
+    for key, value in get_peft_model_state_dict(model).items():
+        assert torch.equal(value, expected[key]), key
+
+
+def test_keep_last_must_keep_a_checkpoint(tmp_path):
+    with pytest.raises(ValueError, match="keep_last"):
+        CheckpointManager(str(tmp_path), keep_last=0)
+
+
+def test_timestep_samplers_resume_per_rank(tmp_path):
+    samplers = [build_timestep_sampler("uniform", seed=0, rank=r) for r in range(2)]
+    for sampler in samplers:
+        sampler.sample(8, "cpu")
+    model, optimizer = build()
+    manager = CheckpointManager(str(tmp_path))
+    manager.save(
+        1, model, optimizer, {"timestep_sampler": [s.state_dict() for s in samplers]}
+    )
+    manager.wait()
+    expected = [sampler.sample(8, "cpu") for sampler in samplers]
+
+    state = manager.load(manager.latest(), *build())
+    for rank, reference in enumerate(expected):
+        sampler = build_timestep_sampler("uniform", seed=0, rank=rank)
+        sampler.load_state_dict(rank_state(state["timestep_sampler"], rank))
+        assert torch.equal(sampler.sample(8, "cpu"), reference)
+    assert not torch.equal(expected[0], expected[1])
+
+    # checkpoints from before per rank states only restore rank 0
+    legacy = samplers[0].state_dict()
+    assert rank_state(legacy, 0) is legacy and rank_state(legacy, 1) is None
@@ -0,0 +1,105 @@
+import torch
+from models.checkpointing import (
+    activation_bytes_per_block,
+    checkpointed_blocks,
+    configure_checkpointing,
+    parse_blocks,
+    plan_checkpointing,
+    transformer_blocks,
+)
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+
+
+def build():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    model.requires_grad_(False)
+    apply_lora(model, rank=4, alpha=4)
+    return model
+
+
+def lora_grads(model, inputs):
+    model.zero_grad()
+    _, hidden_states = model(**inputs)
+    hidden_states.pow(2).mean().backward()
+    return [p.grad.clone() for p in model.parameters() if p.requires_grad]
+
+
+def test_parse_blocks():
+    assert parse_blocks("all", 2, 3) == [0, 1, 2, 3, 4]
+    assert parse_blocks("none", 2, 3) == []
+    assert parse_blocks("double", 2, 3) == [0, 1]
+    assert parse_blocks("single", 2, 3) == [2, 3, 4]
+    assert parse_blocks("0.4", 2, 3) == [0, 2]
+    assert parse_blocks("0-1,4", 2, 3) == [0, 1, 4]
+
+
+def test_selective_checkpointing_matches_eager_gradients():
+    model = build()
+    inputs = make_inputs(model, (64, 96), 8, 2, "cpu", torch.float32)
+    keys = list(model.state_dict())
+    expected = lora_grads(model, inputs)
+
+    assert configure_checkpointing(model, "0,3") == [0, 3]
+    assert checkpointed_blocks(model) == [0, 3]
+    assert list(model.state_dict()) == keys
+    for actual, grad in zip(lora_grads(model, inputs), expected):
+        torch.testing.assert_close(actual, grad)
+
+
+def saved_bytes_per_block(model, inputs):
+    """
+    Reference count with every saved tensor kept alive, as in training.
+    """
+    blocks = transformer_blocks(model)
+    current, storages, kept = [None], [{} for _ in blocks], []
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    handles = []
+    for index, block in enumerate(blocks):
+        handles.append(
+            block.register_forward_pre_hook(
+                lambda module, args, index=index: current.__setitem__(0, index)
+            )
+        )
+        handles.append(
+            block.register_forward_hook(
+                lambda module, args, output: current.__setitem__(0, None)
+            )
+        )
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if current[0] is not None and storage.data_ptr() not in params:
+            storages[current[0]][storage.data_ptr()] = storage.nbytes()
+        kept.append(tensor)
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(**inputs)
+    for handle in handles:
+        handle.remove()
+    return [sum(block.values()) for block in storages]
+
+
+def test_activation_bytes_are_deterministic_and_exact():
+    model = build()
+    inputs = make_inputs(model, (64, 64), 8, 1, "cpu", torch.float32)
+    probe = lambda: model(**inputs)
+    runs = [activation_bytes_per_block(model, probe) for _ in range(10)]
+    assert all(run == runs[0] for run in runs)
+    assert runs[0] == saved_bytes_per_block(model, inputs)
+
+
+def test_auto_policy_fits_budget():
+    model = build()
+    inputs = make_inputs(model, (64, 64), 8, 1, "cpu", torch.float32)
+    probe = lambda: model(**inputs)
+    block_bytes = activation_bytes_per_block(model, probe)
+    assert all(b > 0 for b in block_bytes)
+
+    assert plan_checkpointing(block_bytes, sum(block_bytes)) == []
+    assert plan_checkpointing(block_bytes, 0) == [0, 1, 2, 3]
+    budget = sum(block_bytes) - min(block_bytes)
+    indices = configure_checkpointing(model, "auto", probe, budget)
+    assert len(indices) == 1
+    assert sum(b for i, b in enumerate(block_bytes) if i not in indices) <= budget
@@ -0,0 +1,57 @@
+import pytest
+import torch
+from data.core_data import CoreCachedDataset, collate_fn
+from data.sampler import BucketBatchSampler
+from data.shard_cache import ShardWriter
+
+
+def make_sample(text_length, max_length=6, latent_size=(4, 4)):
+    prompt_embeds = torch.zeros(1, max_length, 4)
+    prompt_embeds[:, :text_length] = 1
+    feeds = {
+        "latents": torch.randn(1, 16, 8),
+        "prompt_embeds": prompt_embeds[:, :text_length],
+        "pooled_prompt_embeds": torch.randn(1, 3),
+        "latent_size": latent_size,
+        "text_length": torch.tensor([text_length]),
+    }
+    return feeds
+
+
+def test_collate_pads_text_to_longest_caption():
+    feeds = collate_fn([make_sample(2), make_sample(4), make_sample(3)])
+
+    assert feeds["prompt_embeds"].shape == (3, 4, 4)
+    assert feeds["latent_size"] == (4, 4)
+    assert feeds["latents"].shape == (3, 16, 8)
+    assert feeds["text_attention_mask"].tolist() == [
+        [True, True, False, False],
+        [True, True, True, True],
+        [True, True, True, False],
+    ]
+    assert torch.equal(
+        feeds["prompt_embeds"][..., 0].bool(), feeds["text_attention_mask"]
+    )
+
+
+def test_collate_rejects_mixed_latent_sizes():
+    with pytest.raises(AssertionError, match="latent_size"):
+        collate_fn([make_sample(2), make_sample(2, latent_size=(2, 8))])
+
+
+def test_transposed_grids_are_separate_buckets(tmp_path):
+    sizes = [(3, 4), (4, 3)] * 3
+    with ShardWriter(str(tmp_path)) as writer:
+        for i, latent_size in enumerate(sizes):
+            feeds = make_sample(2)
+            del feeds["latent_size"], feeds["text_length"]
+            feeds["latents"] = torch.full((1, 12, 8), float(i))
+            writer.add(f"{i}", feeds, {"latent_size": list(latent_size)})
+    dataset = CoreCachedDataset(str(tmp_path))
+    keys = [dataset.bucket_key(i) for i in range(len(dataset))]
+    assert keys == sizes
+
+    for batch in BucketBatchSampler(keys, batch_size=3, seed=0):
+        collated = collate_fn([dataset[i] for i in batch])
+        assert collated["latent_size"] == sizes[batch[0]]
+        assert all(sizes[i] == collated["latent_size"] for i in batch)
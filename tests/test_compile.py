@@ -0,0 +1,104 @@
+import pytest
+import torch
+import torch._dynamo
+from models.checkpointing import apply_checkpointing
+from models.compile import compile_blocks, compile_report, plan_shapes
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+
+
+class CountingBackend:
+    def __init__(self):
+        self.graphs = 0
+
+    def __call__(self, graph_module, example_inputs):
+        self.graphs += 1
+        return graph_module.forward
+
+
+@pytest.fixture(autouse=True)
+def fresh_dynamo():
+    torch._dynamo.reset()
+    # compile_blocks changes global dynamo settings
+    with torch._dynamo.config.patch(
+        automatic_dynamic_shapes=True,
+        recompile_limit=8,
+        accumulated_recompile_limit=256,
+    ):
+        yield
+    torch._dynamo.reset()
+
+
+def lora_model():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    model.requires_grad_(False)
+    apply_lora(model, rank=4, alpha=4)
+    apply_checkpointing(model, [0, 2])
+    return model
+
+
+def step(model, latent_size, text_length, batch_size):
+    height, width = latent_size
+    inputs = make_inputs(
+        model, (width * 16, height * 16), text_length, batch_size, "cpu", torch.float32
+    )
+    output = model(**inputs)[1]
+    output.pow(2).mean().backward()
+    return inputs, output
+
+
+def test_plan_shapes():
+    assert plan_shapes([(4, (64, 48)), (2, (48, 64))]) == (
+        False,
+        [(2, (48, 64)), (4, (64, 48))],
+    )
+    dynamic, warmup = plan_shapes([(4, (8, 8)), (3, (8, 8)), (1, (8, 8)), (2, (4, 4))])
+    assert dynamic
+    assert warmup == [(2, (4, 4)), (1, (8, 8)), (4, (8, 8))]
+
+
+def test_compiled_blocks_match_eager():
+    model = lora_model()
+    inputs = make_inputs(model, (96, 64), 8, 2, "cpu", torch.float32)
+    with torch.no_grad():
+        expected = model(**inputs)[1]
+        compile_blocks(model, backend=CountingBackend())
+        actual = model(**inputs)[1]
+    torch.testing.assert_close(actual, expected)
+
+
+def test_text_length_is_dynamic_and_buckets_static():
+    model = lora_model()
+    backend = CountingBackend()
+    compile_blocks(model, backend=backend, num_shapes=2)
+    step(model, (6, 4), 8, 2)
+    first = backend.graphs
+    for text_length in (12, 20, 33):
+        step(model, (6, 4), text_length, 2)
+    assert backend.graphs == first
+    step(model, (6, 4), 8, 1)
+    single = backend.graphs
+    step(model, (6, 4), 21, 1)
+    assert backend.graphs == single
+    # a new bucket compiles again, once
+    step(model, (4, 4), 9, 1)
+    step(model, (4, 4), 17, 1)
+    assert backend.graphs == single + (single - first)
+
+
+def test_dynamic_batch_reuses_graphs():
+    model = lora_model()
+    backend = CountingBackend()
+    compile_blocks(model, backend=backend, dynamic_batch=True)
+    step(model, (4, 4), 8, 2)
+    first = backend.graphs
+    step(model, (4, 4), 8, 3)
+    step(model, (4, 4), 11, 5)
+    assert backend.graphs == first
+
+
+def test_compile_report():
+    report = compile_report(compile_seconds=30.0, eager_step=1.0, compiled_step=0.8)
+    assert report["speedup"] == pytest.approx(1.25)
+    assert report["break_even_steps"] == pytest.approx(150)
+    assert compile_report(1.0, 1.0, 1.2)["break_even_steps"] == float("inf")
@@ -0,0 +1,74 @@
+import json
+import numpy as np
+from PIL import Image
+from data.core_data import CoreDataset
+from data.image_decode import iter_decoded
+
+
+def make_dataset(tmp_path, sizes, **kwargs):
+    metadata = []
+    for i, (width, height) in enumerate(sizes):
+        # smooth gradients, like photos and unlike noise, survive reduced decoding
+        y, x = np.mgrid[0:height, 0:width]
+        pixels = np.stack([x * 255 // width, y * 255 // height, (x + y) % 256], -1)
+        pixels = pixels.astype(np.uint8)
+        Image.fromarray(pixels).save(tmp_path / f"{i}.jpg", quality=90)
+        metadata.append({"image_path": f"{i}.jpg", "caption": f"image {i}"})
+    with open(tmp_path / "metadata.json", "w") as f:
+        json.dump(metadata, f)
+    return CoreDataset(str(tmp_path / "metadata.json"), str(tmp_path), **kwargs)
+
+
+def test_bucket_lookup_matches_nearest_ratio(tmp_path):
+    dataset = make_dataset(tmp_path, [])
+    rng = np.random.default_rng(0)
+    widths = rng.integers(200, 6000, 500)
+    heights = rng.integers(200, 6000, 500)
+    ratios = list(dataset.bucket_config)
+    expected = [
+        dataset.bucket_config[min(ratios, key=lambda r: abs(r - w / h))]
+        for w, h in zip(widths, heights)
+    ]
+    assert dataset.nearest_buckets(widths, heights) == expected
+    assert dataset.nearest_bucket(int(widths[0]), int(heights[0])) == expected[0]
+
+
+def test_draft_decode_matches_full_decode(tmp_path):
+    dataset = make_dataset(tmp_path, [(3000, 2000)])
+    bucket_size = dataset.nearest_bucket(3000, 2000)
+    drafted = dataset[0][0]
+    dataset.draft = False
+    full = dataset[0][0]
+
+    assert drafted.size == full.size == bucket_size
+    error = np.abs(np.asarray(drafted, float) - np.asarray(full, float)).mean()
+    assert error < 2
+
+
+def test_resized_cache_is_reused(tmp_path):
+    dataset = make_dataset(
+        tmp_path, [(2000, 1500)], resized_cache_dir=str(tmp_path / "resized")
+    )
+    first = dataset[0][0]
+    cache_path = dataset.resized_cache_path(0, first.size)
+    assert (tmp_path / "resized").exists() and cache_path.endswith(".png")
+
+    Image.open(cache_path).convert("RGB").point(lambda _: 7).save(cache_path)
+    assert np.asarray(dataset[0][0]).max() == 7
+
+
+def test_iter_decoded_keeps_order(tmp_path):
+    sizes = [(1200, 900), (900, 1200), (1000, 1000), (1500, 700)] * 2
+    dataset = make_dataset(tmp_path, sizes)
+    indices = [5, 0, 7, 2, 3]
+    for processes in (False, True):
+        decoded = list(
+            iter_decoded(
+                dataset, indices, num_workers=2, prefetch=2, processes=processes
+            )
+        )
+        assert [index for index, *_ in decoded] == indices
+        for index, image, caption, seconds in decoded:
+            assert caption == f"image {index}"
+            assert image.size == dataset.nearest_bucket(*sizes[index])
+            assert seconds >= 0
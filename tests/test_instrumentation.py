@@ -0,0 +1,43 @@
+import json
+import pytest
+import torch
+from training.instrumentation import StartupTimer, StepProfiler, format_record
+
+
+def test_profiler_writes_window_records_on_cpu(tmp_path):
+    log_file = tmp_path / "metrics.jsonl"
+    profiler = StepProfiler(log_file=str(log_file), log_every=2)
+    model = torch.nn.Linear(8, 8)
+    records = []
+    for _ in range(4):
+        with profiler.phase("data_wait", host=True):
+            x = torch.randn(3, 16, 8)
+        with profiler.phase("forward"):
+            loss = model(x).pow(2).mean()
+        with profiler.phase("backward"):
+            loss.backward()
+        records.append(
+            profiler.step(batch_size=3, image_tokens=16, text_tokens=4, loss=loss)
+        )
+
+    assert records[0] is None and records[2] is None
+    lines = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert [line["step"] for line in lines] == [2, 4]
+    for line in lines:
+        assert line["steps"] == 2
+        assert line["forward_time"] > 0 and line["backward_time"] > 0
+        assert "optimizer_time" not in line
+        assert line["tokens_per_sec"] == pytest.approx(20 * line["samples_per_sec"])
+        assert line["peak_memory_mb"] > 0
+    assert "Step 4" in format_record(records[3])
+
+
+def test_startup_timer_splits_total_into_phases():
+    timer = StartupTimer()
+    for name in ("imports", "model", "imports"):
+        sum(range(10000))
+        timer.mark(name)
+    report = timer.report()
+    assert list(report) == ["imports", "model", "total"]
+    assert report["total"] == pytest.approx(report["imports"] + report["model"])
+    assert timer.format().startswith("Time to first step")
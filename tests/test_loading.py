@@ -0,0 +1,46 @@
+import json
+import pytest
+import torch
+from models.loading import load_transformer, weight_files
+from models.partial_flux_transformer import PartialFluxTransformer2DModel
+
+
+@pytest.mark.parametrize("max_shard_size", [None, "200KB"])
+def test_load_transformer_matches_saved_weights(tmp_path, max_shard_size):
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    kwargs = {"max_shard_size": max_shard_size} if max_shard_size else {}
+    model.save_pretrained(tmp_path / "transformer", **kwargs)
+    if max_shard_size:
+        assert len(weight_files(str(tmp_path / "transformer"))) > 1
+
+    loaded = load_transformer(
+        str(tmp_path),
+        torch_dtype=torch.bfloat16,
+        device="cpu",
+        model_cls=PartialFluxTransformer2DModel,
+    )
+    expected = model.state_dict()
+    state_dict = loaded.state_dict()
+    assert state_dict.keys() == expected.keys()
+    for name, tensor in state_dict.items():
+        assert not tensor.is_meta and tensor.dtype == torch.bfloat16
+        torch.testing.assert_close(tensor, expected[name].to(torch.bfloat16))
+    assert not any(p.requires_grad for p in loaded.parameters())
+
+
+def test_load_transformer_reports_missing_weights(tmp_path):
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    model.save_pretrained(tmp_path, max_shard_size="200KB")
+    index_path = tmp_path / "diffusion_pytorch_model.safetensors.index.json"
+    index = json.loads(index_path.read_text())
+    dropped = sorted(set(index["weight_map"].values()))[0]
+    index["weight_map"] = {k: v for k, v in index["weight_map"].items() if v != dropped}
+    index_path.write_text(json.dumps(index))
+
+    with pytest.raises(RuntimeError, match="Missing weights"):
+        load_transformer(
+            str(tmp_path),
+            subfolder=None,
+            device="cpu",
+            model_cls=PartialFluxTransformer2DModel,
+        )
@@ -0,0 +1,81 @@
+import accelerate
+import importlib.util
+import pytest
+import torch
+from lightning_modules.optimizers import (
+    OPTIMIZER_BACKENDS,
+    CPUOffloadOptimizer,
+    build_optimizer,
+    optimizer_memory,
+)
+from training.checkpoint import flatten_optimizer_state, unflatten_optimizer_state
+
+
+def make_params(seed=0):
+    torch.manual_seed(seed)
+    return [torch.nn.Parameter(torch.randn(8, 4)), torch.nn.Parameter(torch.randn(4))]
+
+
+def train(params, optimizer, steps):
+    for step in range(steps):
+        loss = sum((p * (step + 1)).pow(2).sum() for p in params)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+
+def test_synchronous_offload_matches_adamw():
+    reference, offloaded = make_params(), make_params()
+    train(reference, torch.optim.AdamW(reference, lr=0.1), 3)
+    optimizer = CPUOffloadOptimizer(offloaded, lr=0.1, overlap=False)
+    train(offloaded, optimizer, 3)
+    for expected, actual in zip(reference, offloaded):
+        torch.testing.assert_close(actual, expected)
+
+
+def test_overlapped_offload_applies_updates_one_step_late():
+    params = make_params()
+    initial = [p.detach().clone() for p in params]
+    optimizer = CPUOffloadOptimizer(params, lr=0.1)
+    train(params, optimizer, 1)
+    # the first update is still pending or not yet copied back
+    assert all(torch.equal(p, w) for p, w in zip(params, initial))
+    optimizer.synchronize()
+    assert not any(torch.equal(p, w) for p, w in zip(params, initial))
+
+    memory = optimizer_memory(optimizer)
+    # fp32 master, grad, exp_avg and exp_avg_sq per parameter
+    numel = sum(p.numel() for p in params)
+    assert memory["cpu"] >= 4 * 4 * numel
+
+
+def test_offload_state_dict_round_trip():
+    params = make_params()
+    optimizer = build_optimizer(params, backend="cpu_offload", lr=0.1)
+    train(params, optimizer, 2)
+    tensors, meta = flatten_optimizer_state(optimizer.state_dict())
+
+    restored = [torch.nn.Parameter(p.detach().clone()) for p in params]
+    resumed = CPUOffloadOptimizer(restored, lr=0.1)
+    resumed.load_state_dict(unflatten_optimizer_state(tensors, meta))
+    train(params, optimizer, 1)
+    train(restored, resumed, 1)
+    optimizer.synchronize()
+    resumed.synchronize()
+    for expected, actual in zip(params, restored):
+        torch.testing.assert_close(actual, expected)
+
+
+@pytest.mark.parametrize("backend", OPTIMIZER_BACKENDS)
+def test_every_backend_switches_mode_after_prepare(backend):
+    if "8bit" in backend and importlib.util.find_spec("bitsandbytes") is None:
+        pytest.skip("bitsandbytes is not installed")
+    model = torch.nn.Linear(4, 4)
+    accelerator = accelerate.Accelerator(cpu=True)
+    optimizer = build_optimizer(model.parameters(), backend=backend)
+    model, optimizer = accelerator.prepare(model, optimizer)
+    # main.py switches every backend to train mode before the first step
+    optimizer.train()
+    model(torch.randn(2, 4)).sum().backward()
+    optimizer.step()
+    optimizer.eval()
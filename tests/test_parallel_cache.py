@@ -0,0 +1,149 @@
+import functools
+import json
+import os
+import pytest
+import torch
+from PIL import Image
+from data.cache_data import CacheFlux
+from data.core_data import CoreCachedDataset, CoreDataset
+from data.parallel_cache import (
+    cache_part,
+    launch,
+    merge_parts,
+    part_dir,
+    part_indices,
+    part_status,
+)
+from data.shard_cache import ShardWriter
+from data.text_cache import TEXT_SUBDIR, text_key
+
+ENGINE_KWARGS = {"batch_size": 2, "num_workers": 2, "prefetch": 4}
+
+
+class TinyCacheFlux(CacheFlux):
+    """
+    Writes real shards with a stand-in encoder: latents hold the red value
+    of the image. Fails while a `fail-<part>` file exists in `fail_dir`.
+    """
+
+    def __init__(self, save_dir, device="cpu", fail_dir=None):
+        self.save_dir = save_dir
+        self.device = device
+        self.fail_dir = fail_dir
+        self.storage_format = None
+        self.cache_format = "sharded"
+        self.text_settings = {"encoder": "tiny"}
+        self.encoder_settings = {"encoder": "tiny", "text": self.text_settings}
+        self.writer = ShardWriter(save_dir, resume=True)
+        self.text_writer = ShardWriter(os.path.join(save_dir, TEXT_SUBDIR), resume=True)
+        self.text_keys = set(self.text_writer.keys())
+
+    def encode_batch(self, images, prompts):
+        marker = f"fail-{os.path.basename(self.save_dir)}"
+        if self.fail_dir and os.path.exists(os.path.join(self.fail_dir, marker)):
+            raise RuntimeError("encoder failure")
+        batch = []
+        for image, prompt in zip(images, prompts):
+            key = text_key(prompt, self.text_settings)
+            feeds = {
+                "latents": torch.full((1, 4, 8), float(image.getpixel((0, 0))[0])),
+                "latent_size": [2, 2],
+                "guidance_scale": 3.5,
+                "text_key": key,
+            }
+            if key not in self.text_keys:
+                self.text_keys.add(key)
+                feeds["text_embeds"] = {
+                    "prompt_embeds": torch.randn(1, 3, 16),
+                    "pooled_prompt_embeds": torch.randn(1, 8),
+                    "text_length": 3,
+                }
+            batch.append(feeds)
+        return batch
+
+
+def write_dataset(tmp_path, count):
+    metadata = []
+    for i in range(count):
+        Image.new("RGB", (48, 32), (10 * i, 0, 0)).save(tmp_path / f"{i}.png")
+        # two images share a caption, their embeddings are stored once
+        metadata.append({"image_path": f"{i}.png", "caption": f"caption {i // 2}"})
+    with open(tmp_path / "metadata.json", "w") as f:
+        json.dump(metadata, f)
+    return functools.partial(
+        CoreDataset,
+        metadata_file=str(tmp_path / "metadata.json"),
+        root_folder=str(tmp_path),
+    )
+
+
+def cached_values(save_dir):
+    dataset = CoreCachedDataset(save_dir)
+    return sorted(int(dataset[i]["latents"][0, 0, 0]) for i in range(len(dataset)))
+
+
+def test_parts_are_disjoint_and_stable(tmp_path):
+    dataset = write_dataset(tmp_path, 12)()
+    parts = [part_indices(dataset, part, 3) for part in range(3)]
+    assert sorted(sum(parts, [])) == list(range(12))
+
+    # reordering the metadata keeps every image in its part
+    dataset.metadata = dataset.metadata[6:] + dataset.metadata[:6]
+    moved = [part_indices(dataset, part, 3) for part in range(3)]
+    for before, after in zip(parts, moved):
+        assert {(i + 6) % 12 for i in before} == set(after)
+
+
+def test_failed_part_is_retried_alone_and_merged(tmp_path):
+    dataset_fn = write_dataset(tmp_path, 10)
+    save_dir = str(tmp_path / "cache")
+    cache_flux_fn = functools.partial(TinyCacheFlux, fail_dir=str(tmp_path))
+    (tmp_path / "fail-part-001-of-002").touch()
+
+    cache_part(0, 2, save_dir, "cpu", dataset_fn, cache_flux_fn, ENGINE_KWARGS)
+    with pytest.raises(RuntimeError, match="encoder failure"):
+        cache_part(1, 2, save_dir, "cpu", dataset_fn, cache_flux_fn, ENGINE_KWARGS)
+    with pytest.raises(RuntimeError, match="--parts 1"):
+        merge_parts(save_dir, 2)
+
+    (tmp_path / "fail-part-001-of-002").unlink()
+    status = cache_part(1, 2, save_dir, "cpu", dataset_fn, cache_flux_fn, ENGINE_KWARGS)
+    assert status["encoded"] == status["samples"]
+    # the finished part is not touched by the retry
+    assert part_status(save_dir, 2)[0]["encoded"] > 0
+
+    assert merge_parts(save_dir, 2) == 10
+    assert cached_values(save_dir) == [10 * i for i in range(10)]
+    dataset = CoreCachedDataset(save_dir)
+    assert dataset.token_counts(0) == (4, 3)
+    assert dataset[0]["prompt_embeds"].shape == (1, 3, 16)
+
+
+def test_unchanged_parts_are_not_reencoded(tmp_path):
+    dataset_fn = write_dataset(tmp_path, 6)
+    save_dir = str(tmp_path / "cache")
+    for _ in range(2):
+        statuses = [
+            cache_part(
+                part, 2, save_dir, "cpu", dataset_fn, TinyCacheFlux, ENGINE_KWARGS
+            )
+            for part in range(2)
+        ]
+    assert [status["encoded"] for status in statuses] == [0, 0]
+    assert merge_parts(save_dir, 2) == 6
+
+
+def test_launch_runs_parts_in_processes(tmp_path):
+    dataset_fn = write_dataset(tmp_path, 6)
+    save_dir = str(tmp_path / "cache")
+    exit_codes = launch(
+        save_dir,
+        ["cpu", "cpu"],
+        dataset_fn,
+        TinyCacheFlux,
+        engine_kwargs=ENGINE_KWARGS,
+    )
+    assert exit_codes == {0: 0, 1: 0}
+    assert os.path.isdir(part_dir(save_dir, 1, 2))
+    assert merge_parts(save_dir, 2) == 6
+    assert cached_values(save_dir) == [10 * i for i in range(6)]
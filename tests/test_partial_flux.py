@@ -0,0 +1,33 @@
+import torch
+from benchmarks.bench_transformer import run
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+
+
+def test_gradient_checkpointing_matches_eager_gradients():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    inputs = make_inputs(model, (64, 96), 8, 2, "cpu", torch.float32)
+
+    grads = []
+    for checkpointing in [False, True]:
+        if checkpointing:
+            model.enable_gradient_checkpointing()
+        model.zero_grad()
+        _, hidden_states = model(**inputs)
+        hidden_states.pow(2).mean().backward()
+        grads.append(model.x_embedder.weight.grad.clone())
+
+    assert hidden_states.shape == (2, 24, model.inner_dim)
+    assert torch.allclose(grads[0], grads[1], atol=1e-6)
+
+
+def test_benchmark_grid_runs_on_cpu():
+    grid = {
+        "resolutions": [[64, 64]],
+        "text_lengths": [8],
+        "batch_sizes": [1],
+        "lora_ranks": [0, 4],
+        "gradient_checkpointing": [True],
+    }
+    results = run(grid, {}, warmup=0, iters=1, device="cpu", dtype=torch.float32)
+    assert [r["lora_rank"] for r in results] == [0, 4]
+    assert all(r["forward_ms"] > 0 and r["backward_ms"] > 0 for r in results)
@@ -0,0 +1,72 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from data.cache_codec import encode_tensors
+from data.core_data import collate_fn
+from data.prefetch import DevicePrefetcher
+from data.sampler import BucketBatchSampler
+from training.instrumentation import StepProfiler
+
+
+def make_samples(count, storage_format=None):
+    samples = []
+    for i in range(count):
+        feeds = {
+            "latents": torch.full((1, 4, 8), float(i)),
+            "prompt_embeds": torch.randn(1, 3 + i % 2, 16),
+            "pooled_prompt_embeds": torch.randn(1, 8),
+            "text_length": torch.tensor([3 + i % 2]),
+        }
+        feeds = encode_tensors(feeds, storage_format)
+        feeds["latent_size"] = (2, 2)
+        samples.append(feeds)
+    return samples
+
+
+def make_loader(samples, **kwargs):
+    sampler = BucketBatchSampler(["a"] * len(samples), batch_size=2, seed=0)
+    return DataLoader(samples, batch_sampler=sampler, collate_fn=collate_fn, **kwargs)
+
+
+def test_prefetcher_keeps_order_and_content():
+    samples = make_samples(7)
+    # the sampler reshuffles every epoch, compare against a fresh one
+    expected = list(make_loader(samples))
+    prefetcher = DevicePrefetcher(make_loader(samples), "cpu")
+    batches = list(prefetcher)
+
+    assert len(prefetcher) == len(batches) == 4
+    for batch, reference in zip(batches, expected):
+        assert batch["latent_size"] == (2, 2)
+        for name in ("latents", "prompt_embeds", "text_attention_mask"):
+            assert torch.equal(batch[name], reference[name])
+    # iterating again starts a new epoch
+    assert len(list(prefetcher)) == 4
+
+
+def test_prefetcher_dequantizes_after_the_copy():
+    loader = make_loader(make_samples(4, "int8"))
+    for batch in DevicePrefetcher(loader, "cpu"):
+        assert "latents_scale" not in batch
+        assert batch["latents"].dtype == torch.float32
+
+
+def test_prefetcher_times_copies_as_h2d():
+    profiler = StepProfiler(log_every=100)
+    for batch in DevicePrefetcher(make_loader(make_samples(6)), "cpu", profiler):
+        profiler.step(batch_size=batch["latents"].shape[0])
+    record = profiler.flush()
+    assert record["steps"] == 3
+    assert record["h2d_time"] > 0
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a GPU")
+def test_prefetcher_copies_from_pinned_memory_on_cuda():
+    loader = make_loader(make_samples(6), pin_memory=False)
+    profiler = StepProfiler(log_every=100, device="cuda")
+    batches = list(DevicePrefetcher(loader, "cuda", profiler))
+    assert all(batch["latents"].is_cuda for batch in batches)
+    values = [int(v) for batch in batches for v in batch["latents"][:, 0, 0]]
+    assert sorted(values) == list(range(6))
+    profiler.step(batch_size=6)
+    assert profiler.flush()["h2d_time"] > 0
@@ -0,0 +1,29 @@
+import torch
+from models.lora import apply_lora
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+from models.quantization import quantize_base_weights, state_dict_bytes
+
+
+def build():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    model.requires_grad_(False)
+    apply_lora(model, rank=4, alpha=4)
+    return model
+
+
+def test_qint8_base_keeps_only_lora_trainable():
+    reference = build()
+    model = quantize_base_weights(build(), weights="qint8")
+    inputs = make_inputs(model, (64, 64), 8, 1, "cpu", torch.float32)
+
+    trainable = [n for n, p in model.named_parameters() if p.requires_grad]
+    assert trainable and all("lora_" in n for n in trainable)
+    assert state_dict_bytes(model) < state_dict_bytes(reference)
+
+    _, hidden_states = model(**inputs)
+    hidden_states.pow(2).mean().backward()
+    assert all(p.grad is not None for p in model.parameters() if p.requires_grad)
+    with torch.no_grad():
+        expected = reference(**inputs)[1]
+        actual = model(**inputs)[1]
+    assert (actual - expected).norm() / expected.norm() < 0.05
@@ -0,0 +1,58 @@
+import torch
+from data.core_data import CoreCachedDataset
+from data.shard_cache import ShardWriter
+from models.partial_flux_transformer import PartialFluxTransformer2DModel, make_inputs
+from models.rotary import CachedPosEmbed, position_ids
+
+
+def test_position_ids_match_flux_layout():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    inputs = make_inputs(model, (64, 96), 8, 1, "cpu", torch.float32)
+    text_ids, image_ids = position_ids(8, (6, 4))
+    assert torch.equal(text_ids, inputs["txt_ids"])
+    assert torch.equal(image_ids, inputs["img_ids"])
+    assert position_ids(8, (6, 4))[1] is image_ids
+
+
+def test_memoized_rotary_matches_explicit_ids():
+    model = PartialFluxTransformer2DModel.from_tiny_config()
+    inputs = make_inputs(model, (64, 96), 8, 2, "cpu", torch.float32)
+    with torch.no_grad():
+        expected = model(**inputs)[1]
+        compact = {k: v for k, v in inputs.items() if k not in ("txt_ids", "img_ids")}
+        actual = model(**compact, latent_size=(6, 4))[1]
+        # a different text length reuses the cached image rows
+        shorter = dict(
+            compact, encoder_hidden_states=compact["encoder_hidden_states"][:, :5]
+        )
+        model(**shorter, latent_size=(6, 4))
+
+    torch.testing.assert_close(actual, expected)
+    assert isinstance(model.pos_embed, CachedPosEmbed)
+    assert list(model.pos_embed._image) == [(6, 4, torch.device("cpu"))]
+    assert model.pos_embed.key is None
+
+
+def test_dataset_derives_sizes_of_legacy_samples(tmp_path):
+    _, image_ids = position_ids(0, (3, 5))
+    with ShardWriter(str(tmp_path)) as writer:
+        writer.add(
+            "legacy",
+            {
+                "latents": torch.randn(1, 15, 64),
+                "prompt_embeds": torch.randn(1, 4, 32),
+                "latent_image_ids": image_ids.to(torch.bfloat16),
+                "text_ids": torch.zeros(4, 3),
+            },
+        )
+        writer.add(
+            "compact",
+            {"latents": torch.randn(1, 15, 64), "prompt_embeds": torch.randn(1, 4, 32)},
+            {"latent_size": [3, 5], "guidance_scale": 3.5},
+        )
+    dataset = CoreCachedDataset(str(tmp_path))
+    for index in range(2):
+        feeds = dataset[index]
+        assert feeds["latent_size"] == (3, 5)
+        assert feeds["guidance"].tolist() == [3.5]
+        assert "text_ids" not in feeds and "latent_image_ids" not in feeds
@@ -0,0 +1,72 @@
+import accelerate
+import torch
+from data.sampler import BucketBatchSampler, TokenBudgetBatchSampler, resume_loader
+
+
+def test_batches_never_mix_buckets():
+    keys = [(1, 64, 64), (1, 96, 64), (1, 64, 64)] * 7
+    sampler = BucketBatchSampler(keys, batch_size=4, seed=1)
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(keys)))
+    for batch in batches:
+        assert len({keys[i] for i in batch}) == 1
+
+
+def test_drop_last_and_epoch_reshuffle():
+    keys = ["a"] * 10 + ["b"] * 3
+    sampler = BucketBatchSampler(keys, batch_size=4, drop_last=True)
+    first = list(sampler)
+    second = list(sampler)
+
+    assert len(first) == len(sampler) == 2
+    assert all(len(batch) == 4 for batch in first)
+    assert first != second
+    sampler.set_epoch(0)
+    assert list(sampler) == first
+
+
+def test_token_budget_sizes_batches_per_bucket():
+    keys = ["small"] * 12 + ["large"] * 6
+    tokens = [(64, 16)] * 12 + [(256, 64)] * 6
+    sampler = TokenBudgetBatchSampler(keys, tokens, token_budget=640, seed=2)
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(18))
+    sizes = sorted((keys[batch[0]], len(batch)) for batch in batches)
+    assert sizes == [("large", 2)] * 3 + [("small", 4), ("small", 8)]
+    assert sampler.mean_batch_size() == 18 / len(batches)
+
+
+def test_token_budget_pads_text_and_drops_partial_batches():
+    keys = ["a"] * 5
+    tokens = [(10, 10), (10, 30), (10, 10), (10, 10), (10, 10)]
+    sampler = TokenBudgetBatchSampler(keys, tokens, token_budget=80, shuffle=False)
+    # two samples padded to 30 text tokens already use the budget
+    assert sampler.batches() == [[0, 1], [2, 3, 4]]
+    sampler.drop_last = True
+    # a fourth short sample would still fit the trailing batch
+    assert sampler.batches() == [[0, 1]]
+    capped = TokenBudgetBatchSampler(
+        keys, tokens, token_budget=1000, max_batch_size=2, shuffle=False
+    )
+    assert capped.batches() == [[0, 1], [2, 3], [4]]
+
+
+def test_resume_through_prepared_loader():
+    keys = ["a"] * 6 + ["b"] * 2
+    reference = BucketBatchSampler(keys, batch_size=2, seed=0)
+    reference.set_epoch(3)
+    epoch_3, epoch_4 = list(reference), list(reference)
+
+    sampler = BucketBatchSampler(keys, batch_size=2, seed=0)
+    loader = torch.utils.data.DataLoader(list(range(len(keys))), batch_sampler=sampler)
+    loader = accelerate.Accelerator(cpu=True).prepare_data_loader(
+        loader, device_placement=False
+    )
+    resume_loader(loader, sampler, epoch=3, start_batch=1)
+
+    assert [batch.tolist() for batch in loader] == epoch_3[1:]
+    assert [batch.tolist() for batch in loader] == epoch_4
@@ -0,0 +1,97 @@
+import torch
+from data.shard_cache import ShardWriter, ShardedCacheReader, convert_pt_folder
+from data.core_data import CoreCachedDataset
+
+
+def make_feeds(seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        "latents": torch.randn(1, 16, 64, generator=generator).to(torch.bfloat16),
+        "prompt_embeds": torch.randn(1, 8, 32, generator=generator),
+        "guidance": torch.tensor([3.5]),
+    }
+
+
+def test_roundtrip_across_shards(tmp_path):
+    samples = [make_feeds(i) for i in range(5)]
+    with ShardWriter(str(tmp_path), shard_size=2048) as writer:
+        for i, feeds in enumerate(samples):
+            writer.add(f"sample_{i}", feeds)
+    assert len(writer.shards) > 1
+
+    reader = ShardedCacheReader(str(tmp_path))
+    assert len(reader) == 5
+    for i, feeds in enumerate(samples):
+        loaded = reader[i]
+        assert reader.key(i) == f"sample_{i}"
+        for k, v in feeds.items():
+            assert loaded[k].dtype == v.dtype
+            assert torch.equal(loaded[k], v)
+
+
+def test_convert_pt_folder(tmp_path):
+    pt_folder = tmp_path / "pt"
+    pt_folder.mkdir()
+    for i in range(3):
+        torch.save(make_feeds(i), pt_folder / f"image_{i}.pt")
+    convert_pt_folder(str(pt_folder), str(tmp_path / "sharded"))
+
+    dataset = CoreCachedDataset(cached_folder=str(tmp_path / "sharded"))
+    assert dataset.reader is not None
+    assert len(dataset) == 3
+    assert torch.equal(dataset.load(1)["latents"], make_feeds(1)["latents"])
+
+
+def test_resume_after_crash_and_drop_stale(tmp_path):
+    samples = {f"sample_{i}": make_feeds(i) for i in range(4)}
+    with ShardWriter(str(tmp_path), shard_size=2048) as writer:
+        writer.add("sample_0", samples["sample_0"])
+        writer.add("sample_1", samples["sample_1"])
+    # a second run dies after one sample, before writing the index
+    crashed = ShardWriter(str(tmp_path), shard_size=2048, resume=True)
+    crashed.add("sample_2", samples["sample_2"])
+    crashed._journal.close()
+
+    writer = ShardWriter(str(tmp_path), shard_size=2048, resume=True)
+    assert sorted(writer.keys()) == ["sample_0", "sample_1", "sample_2"]
+    writer.add("sample_3", samples["sample_3"])
+    assert writer.retain(["sample_1", "sample_2", "sample_3"]) == 1
+    writer.close()
+
+    reader = ShardedCacheReader(str(tmp_path))
+    assert sorted(reader.key(i) for i in range(len(reader))) == [
+        "sample_1",
+        "sample_2",
+        "sample_3",
+    ]
+    for i in range(len(reader)):
+        expected = samples[reader.key(i)]
+        assert torch.equal(reader[i]["latents"], expected["latents"])
+    # the shard holding only sample_0 is gone
+    assert sorted(p.name for p in tmp_path.glob("shard-*")) == sorted(reader.shards)
+
+
+def test_interrupted_rebuild_keeps_previous_cache(tmp_path):
+    old = [make_feeds(i) for i in range(3)]
+    with ShardWriter(str(tmp_path), shard_size=2048) as writer:
+        for i, feeds in enumerate(old):
+            writer.add(f"sample_{i}", feeds)
+    old_shards = set(writer.shards)
+
+    # a rebuild that dies before close must not touch the indexed shards
+    rebuild = ShardWriter(str(tmp_path), shard_size=2048)
+    for i in range(3):
+        rebuild.add(f"new_{i}", make_feeds(10 + i))
+    rebuild._file.close()
+    assert not old_shards & set(rebuild.shards)
+    reader = ShardedCacheReader(str(tmp_path))
+    for i, feeds in enumerate(old):
+        assert torch.equal(reader[i]["latents"], feeds["latents"])
+
+    with ShardWriter(str(tmp_path), shard_size=2048) as writer:
+        writer.add("new_0", make_feeds(10))
+    reader = ShardedCacheReader(str(tmp_path))
+    assert [reader.key(i) for i in range(len(reader))] == ["new_0"]
+    assert torch.equal(reader[0]["latents"], make_feeds(10)["latents"])
+    # old shards and those of the interrupted rebuild are gone
+    assert sorted(p.name for p in tmp_path.glob("*.bin")) == writer.shards
@@ -0,0 +1,143 @@
+import json
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from data.core_data import AspectBuckets
+from data.tar_stream import (
+    StreamProgress,
+    TarShardDataset,
+    TarShardWriter,
+    encode_cached,
+    write_raw_shards,
+)
+
+
+def write_cached(tmp_path, sizes, samples_per_shard=3):
+    with TarShardWriter(str(tmp_path), samples_per_shard) as writer:
+        for i, (height, width) in enumerate(sizes):
+            feeds = {
+                "latents": torch.full((1, height * width, 64), float(i)),
+                "prompt_embeds": torch.randn(1, 5 + i % 3, 32),
+                "pooled_prompt_embeds": torch.randn(1, 16),
+                "text_length": torch.tensor([5 + i % 3]),
+                "guidance": torch.tensor([3.5]),
+                "latent_size": (height, width),
+            }
+            writer.add(f"{i:08d}", encode_cached(feeds))
+    return str(tmp_path / "*.tar")
+
+
+def sample_ids(batches):
+    return [int(v) for batch in batches for v in batch["latents"][:, 0, 0]]
+
+
+def test_raw_shards_round_trip(tmp_path):
+    metadata = []
+    for i in range(5):
+        Image.new("RGB", (64 + i, 48), (i, 0, 0)).save(tmp_path / f"{i}.png")
+        metadata.append({"image_path": f"{i}.png", "caption": f"caption {i}"})
+    with open(tmp_path / "metadata.json", "w") as f:
+        json.dump(metadata, f)
+    shards = write_raw_shards(
+        str(tmp_path / "metadata.json"), str(tmp_path), str(tmp_path / "tar"), 2
+    )
+    assert len(shards) == 3
+
+    dataset = TarShardDataset(
+        str(tmp_path / "tar" / "*.tar"), mode="raw", shuffle=False
+    )
+    samples = list(dataset)
+    assert [caption for _, caption, _ in samples] == [f"caption {i}" for i in range(5)]
+    assert [image.size for image, _, _ in samples] == [(64 + i, 48) for i in range(5)]
+    # (shard, offset, shard size on the last sample of a shard)
+    assert [p.tolist() for _, _, p in samples] == [
+        [[0, 0, -1]],
+        [[0, 1, 2]],
+        [[1, 0, -1]],
+        [[1, 1, 2]],
+        [[2, 0, 1]],
+    ]
+
+    resized = TarShardDataset(
+        str(tmp_path / "tar" / "*.tar"), mode="raw", resize_to_bucket=True
+    )
+    buckets = AspectBuckets()
+    for image, _, _ in resized:
+        assert image.size in buckets.sizes.values()
+
+
+def test_cached_batches_share_shape_and_cover_epoch(tmp_path):
+    # transposed grids hold as many tokens but are batched apart
+    sizes = [(2, 2), (2, 3), (3, 2)] * 4
+    shards = write_cached(tmp_path, sizes)
+    dataset = TarShardDataset(shards, batch_size=2, buffer_size=4, seed=1)
+    batches = list(dataset)
+
+    assert sorted(sample_ids(batches)) == list(range(12))
+    for batch in batches:
+        ids = [int(v) for v in batch["latents"][:, 0, 0]]
+        assert {sizes[i] for i in ids} == {batch["latent_size"]}
+        assert batch["stream_position"].shape == (batch["latents"].shape[0], 3)
+        assert batch["text_attention_mask"].shape == batch["prompt_embeds"].shape[:2]
+    assert sample_ids(TarShardDataset(shards, batch_size=2, buffer_size=4, seed=1)) == (
+        sample_ids(batches)
+    )
+    dataset.set_epoch(1)
+    assert sample_ids(dataset) != sample_ids(batches)
+
+
+def test_shards_split_across_ranks_and_workers(tmp_path):
+    shards = write_cached(tmp_path, [(2, 2)] * 16, samples_per_shard=2)
+    seen = []
+    for rank in range(2):
+        dataset = TarShardDataset(shards, batch_size=1, rank=rank, world_size=2)
+        loader = DataLoader(dataset, batch_size=None, num_workers=2)
+        seen.append(sample_ids(loader))
+    assert len(seen[0]) == len(seen[1]) == 8
+    assert sorted(seen[0] + seen[1]) == list(range(16))
+
+
+def test_resume_from_shard_and_offset(tmp_path):
+    shards = write_cached(tmp_path, [(2, 2)] * 10)
+    dataset = TarShardDataset(shards, batch_size=1, buffer_size=1, seed=3)
+    dataset.set_epoch(2)
+    progress = StreamProgress()
+    consumed = []
+    for batch in dataset:
+        consumed += sample_ids([batch])
+        progress.update(batch["stream_position"])
+        if len(consumed) == 4:
+            break
+
+    resumed = TarShardDataset(shards, batch_size=1, buffer_size=1, seed=3)
+    resumed.resume(2, progress.state_dict()["positions"])
+    rest = sample_ids(resumed)
+    assert consumed + rest == sample_ids(dataset)
+    # only the epoch being resumed starts late
+    resumed.set_epoch(3)
+    assert len(sample_ids(resumed)) == 10
+
+
+def test_resume_replays_samples_left_in_the_shuffle_buffer(tmp_path):
+    shards = write_cached(tmp_path, [(2, 2)] * 12)
+    dataset = TarShardDataset(shards, batch_size=1, buffer_size=5, seed=0)
+    progress = StreamProgress()
+    consumed = []
+    for batch in dataset:
+        consumed += sample_ids([batch])
+        progress.update(batch["stream_position"])
+        if len(consumed) == 7:
+            break
+
+    resumed = TarShardDataset(shards, batch_size=1, buffer_size=5, seed=0)
+    resumed.resume(0, progress.state_dict()["positions"])
+    rest = sample_ids(resumed)
+    assert sorted(consumed + rest) == list(range(12))
+
+    # finished shards are recorded with their size and not read again
+    finished = [
+        p
+        for p, shard in progress.state_dict()["positions"].items()
+        if shard["next"] == shard["size"]
+    ]
+    assert finished
@@ -0,0 +1,54 @@
+import os
+import torch
+from data.shard_cache import ShardWriter
+from data.text_cache import TEXT_SUBDIR, LRUCache, text_key
+from data.core_data import CoreCachedDataset
+
+
+def test_text_key_depends_on_caption_and_settings():
+    settings = {"max_sequence_length": 256, "dtype": "torch.bfloat16"}
+    assert text_key("a cat", settings) == text_key("a cat", dict(settings))
+    assert text_key("a cat", settings) != text_key("a dog", settings)
+    assert text_key("a cat", settings) != text_key(
+        "a cat", {**settings, "max_sequence_length": 512}
+    )
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(capacity=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_dataset_resolves_shared_prompt_embeds(tmp_path):
+    captions = {"k0": torch.randn(1, 8, 32), "k1": torch.randn(1, 8, 32)}
+    with ShardWriter(os.path.join(tmp_path, TEXT_SUBDIR)) as writer:
+        for key, prompt_embeds in captions.items():
+            writer.add(key, {"prompt_embeds": prompt_embeds})
+    with ShardWriter(str(tmp_path)) as writer:
+        for i, key in enumerate(["k0", "k1", "k0"]):
+            writer.add(f"{i}", {"latents": torch.randn(1, 4, 64)}, {"text_key": key})
+
+    dataset = CoreCachedDataset(cached_folder=str(tmp_path), text_cache_size=1)
+    assert torch.equal(dataset.load(0)["prompt_embeds"], captions["k0"])
+    assert torch.equal(dataset.load(1)["prompt_embeds"], captions["k1"])
+    assert torch.equal(dataset.load(2)["prompt_embeds"], captions["k0"])
+    assert len(dataset.text_store.cache) == 1
+
+
+def test_token_counts_read_only_the_index(tmp_path):
+    with ShardWriter(os.path.join(tmp_path, TEXT_SUBDIR)) as writer:
+        writer.add("k0", {"prompt_embeds": torch.randn(1, 5, 32)}, {"text_length": 3})
+        writer.add("k1", {"prompt_embeds": torch.randn(1, 7, 32)})
+    with ShardWriter(str(tmp_path)) as writer:
+        writer.add("0", {"latents": torch.randn(1, 4, 64)}, {"text_key": "k0"})
+        writer.add("1", {"latents": torch.randn(1, 6, 64)}, {"text_key": "k1"})
+
+    dataset = CoreCachedDataset(cached_folder=str(tmp_path))
+    assert dataset.token_counts(0) == (4, 3)
+    assert dataset.token_counts(1) == (6, 7)
+    assert len(dataset.text_store.cache) == 0
@@ -0,0 +1,33 @@
+import pytest
+import torch
+from training.token_budget import probe_token_budget
+
+
+def fake_memory(base, per_sample, oom_above=None):
+    peak = [0]
+
+    def run_step(batch_size):
+        if oom_above is not None and batch_size > oom_above:
+            raise torch.cuda.OutOfMemoryError("out of memory")
+        peak[0] = base + per_sample * batch_size
+
+    return run_step, lambda: peak[0]
+
+
+def test_probe_interpolates_between_doublings():
+    run_step, peak = fake_memory(base=1000, per_sample=100)
+    budget = probe_token_budget(
+        run_step, tokens_per_sample=50, memory_limit=2250, peak_memory=peak
+    )
+    # 11 samples need 2100, 12 would need 2200, 13 exceed the limit
+    assert budget == 12 * 50
+
+
+def test_probe_stops_at_oom_and_cap():
+    run_step, peak = fake_memory(base=0, per_sample=1, oom_above=4)
+    assert probe_token_budget(run_step, 10, 10**9, peak) == 40
+    run_step, peak = fake_memory(base=0, per_sample=1)
+    assert probe_token_budget(run_step, 10, 10**9, peak, max_batch_size=8) == 80
+    run_step, peak = fake_memory(base=100, per_sample=1)
+    with pytest.raises(RuntimeError):
+        probe_token_budget(run_step, 10, 50, peak)
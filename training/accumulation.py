@@ -0,0 +1,40 @@
+import contextlib
+from contextlib import contextmanager
+
+
+class GradientAccumulation:
+    """
+    Sums the gradients of `steps` micro-batches into one optimizer step.
+
+    `normalizer` is the per-step normalizer of the "sample" loss (see
+    `FluxLightning.loss_fn`), it is multiplied by `steps` so every sample
+    keeps its weight. With `normalizer=None` ("batch") each micro-batch mean
+    is divided by `steps`. Gradients are only all-reduced on the last
+    micro-batch of a step.
+    """
+
+    def __init__(self, accelerator, model, steps: int = 1, normalizer: float = None):
+        self.accelerator = accelerator
+        self.model = model
+        self.steps = steps
+        self.normalizer = None if normalizer is None else normalizer * steps
+        # micro-batches of the optimizer step in progress
+        self.pending = 0
+
+    @contextmanager
+    def micro_batch(self):
+        """
+        Wraps forward and backward of one micro-batch, yields whether the
+        optimizer steps after it.
+        """
+        sync = self.pending + 1 == self.steps
+        no_sync = self.accelerator.no_sync(self.model)
+        with contextlib.nullcontext() if sync else no_sync:
+            yield sync
+        self.pending = 0 if sync else self.pending + 1
+
+    def loss(self, loss_fn, noise_pred, targets):
+        loss = loss_fn(noise_pred, targets, self.normalizer)
+        if self.normalizer is None:
+            loss = loss / self.steps
+        return loss
@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+import torch
+from peft.utils import get_peft_model_state_dict, set_peft_model_state_dict
+from safetensors.torch import load_file, save_file
+from lightning_modules.optimizers import eval_mode_weights, synchronize_optimizer
+
+ADAPTER_STATE_FILE = "adapter_state.safetensors"
+OPTIMIZER_STATE_FILE = "optimizer.safetensors"
+TRAINER_STATE_FILE = "trainer_state.json"
+
+
+def to_host(tensors: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    return {k: v.detach().to("cpu", copy=True).contiguous() for k, v in tensors.items()}
+
+
+def flatten_optimizer_state(state_dict: dict):
+    """
+    Splits an optimizer state dict into host tensors for safetensors and a
+    json serializable remainder.
+    """
+    tensors = {}
+    meta = {"param_groups": state_dict["param_groups"], "state": {}}
+    for param_id, param_state in state_dict["state"].items():
+        meta_state = {}
+        for name, value in param_state.items():
+            if torch.is_tensor(value):
+                tensors[f"state.{param_id}.{name}"] = value
+            else:
+                meta_state[name] = value
+        meta["state"][str(param_id)] = meta_state
+    return to_host(tensors), meta
+
+
+def unflatten_optimizer_state(tensors: Dict[str, torch.Tensor], meta: dict) -> dict:
+    state = {int(k): dict(v) for k, v in meta["state"].items()}
+    for key, value in tensors.items():
+        _, param_id, name = key.split(".", 2)
+        state.setdefault(int(param_id), {})[name] = value
+    return {"state": state, "param_groups": meta["param_groups"]}
+
+
+def rank_state(states, rank: int):
+    """
+    The state of `rank` from a list saved with one entry per rank. Older
+    checkpoints hold a single state, written by rank 0. Returns None when
+    the checkpoint has no state for `rank`, which then keeps its own seed.
+    """
+    if isinstance(states, list):
+        return states[rank] if rank < len(states) else None
+    return states if rank == 0 else None
+
+
+class CheckpointManager:
+    """
+    Snapshots the LoRA weights and optimizer state to host memory on the
+    training thread and writes them as safetensors from a background thread.
+    Only the newest `keep_last` checkpoints are kept.
+
+    Each checkpoint directory holds
+    - pytorch_lora_weights.safetensors: the exported adapter, loadable with
+      `FluxPipeline.load_lora_weights`
+    - adapter_state.safetensors, optimizer.safetensors, trainer_state.json:
+      everything needed to resume the run exactly
+    """
+
+    def __init__(self, save_dir: str, keep_last: int = 3):
+        if keep_last < 1:
+            # the newest checkpoint is the one a run resumes from
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}")
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        os.makedirs(save_dir, exist_ok=True)
+
+    def checkpoints(self):
+        names = [
+            name
+            for name in os.listdir(self.save_dir)
+            if name.startswith("checkpoint-") and not name.endswith(".tmp")
+        ]
+        return sorted(names, key=lambda name: int(name.split("-")[1]))
+
+    def latest(self) -> str:
+        checkpoints = self.checkpoints()
+        return os.path.join(self.save_dir, checkpoints[-1]) if checkpoints else None
+
+    @torch.no_grad()
+    def save(self, step: int, denoiser, optimizer, trainer_state: dict = None):
+        # at most one snapshot waits in host memory
+        self.wait()
+        synchronize_optimizer(optimizer)
+        adapter_state = to_host(get_peft_model_state_dict(denoiser))
+        # schedule-free keeps the averaged weights only in eval mode
+        with eval_mode_weights(optimizer):
+            lora_weights = to_host(get_peft_model_state_dict(denoiser))
+        optimizer_tensors, optimizer_meta = flatten_optimizer_state(
+            optimizer.state_dict()
+        )
+        trainer_state = {
+            "step": step,
+            "optimizer": optimizer_meta,
+            **(trainer_state or {}),
+        }
+        self._pending = self._executor.submit(
+            self._write,
+            step,
+            lora_weights,
+            adapter_state,
+            optimizer_tensors,
+            trainer_state,
+        )
+
+    def _write(self, step, lora_weights, adapter_state, optimizer_tensors, state):
+        import diffusers
+
+        path = os.path.join(self.save_dir, f"checkpoint-{step:08d}")
+        tmp_path = path + ".tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        diffusers.FluxPipeline.save_lora_weights(
+            save_directory=tmp_path, transformer_lora_layers=lora_weights
+        )
+        save_file(adapter_state, os.path.join(tmp_path, ADAPTER_STATE_FILE))
+        save_file(optimizer_tensors, os.path.join(tmp_path, OPTIMIZER_STATE_FILE))
+        with open(os.path.join(tmp_path, TRAINER_STATE_FILE), "w") as f:
+            json.dump(state, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        for name in self.checkpoints()[: -self.keep_last]:
+            shutil.rmtree(os.path.join(self.save_dir, name))
+        print(f"Saved checkpoint {path}")
+        return path
+
+    def wait(self):
+        """
+        Blocks until the pending write, if any, is on disk.
+        """
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def load(self, path: str, denoiser, optimizer) -> dict:
+        """
+        Restores adapter and optimizer state in place, returns the trainer state.
+        """
+        with open(os.path.join(path, TRAINER_STATE_FILE)) as f:
+            state = json.load(f)
+        adapter_state = load_file(os.path.join(path, ADAPTER_STATE_FILE))
+        set_peft_model_state_dict(denoiser, adapter_state)
+        optimizer_tensors = load_file(os.path.join(path, OPTIMIZER_STATE_FILE))
+        optimizer.load_state_dict(
+            unflatten_optimizer_state(optimizer_tensors, state.pop("optimizer"))
+        )
+        print(f"Resumed from {path} at step {state['step']}")
+        return state
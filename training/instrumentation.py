@@ -0,0 +1,171 @@
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import torch
+
+
+class StepProfiler:
+    """
+    Times the phases of each training step and aggregates them over windows
+    of `log_every` steps.
+
+    On CUDA, device phases are timed with events that are only resolved when a
+    window is flushed, so there is one device sync per window instead of one
+    per step. On CPU everything runs synchronously and is timed on the host.
+    """
+
+    PHASES = ("data_wait", "h2d", "forward", "backward", "optimizer")
+
+    def __init__(
+        self,
+        log_file: str = None,
+        log_every: int = 50,
+        use_wandb: bool = False,
+        device: torch.device = "cpu",
+    ):
+        self.log_file = log_file
+        self.log_every = log_every
+        self.use_wandb = use_wandb
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.global_step = 0
+        if log_file is not None and os.path.dirname(log_file):
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        self._reset()
+
+    def _reset(self):
+        self._seconds = defaultdict(float)
+        self._events = defaultdict(list)
+        self._steps = 0
+        self._samples = 0
+        self._image_tokens = 0
+        self._text_tokens = 0
+        self._loss_sum = None
+        self._window_start = time.perf_counter()
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextmanager
+    def phase(self, name: str, host: bool = False):
+        """
+        Times a phase. `host=True` forces host timing, e.g. for waiting on the
+        DataLoader which does not show up on the device timeline.
+        """
+        if self.use_cuda and not host:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._events[name].append((start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self._seconds[name] += time.perf_counter() - start
+
+    def step(
+        self,
+        batch_size: int,
+        image_tokens: int = 0,
+        text_tokens: int = 0,
+        loss: torch.Tensor = None,
+    ):
+        """
+        Marks the end of a step. `image_tokens` and `text_tokens` are per sample.
+        The loss is accumulated on its device and only read back on flush.
+        """
+        self._steps += 1
+        self._samples += batch_size
+        self._image_tokens += batch_size * image_tokens
+        self._text_tokens += batch_size * text_tokens
+        if loss is not None:
+            loss = loss.detach().float()
+            self._loss_sum = loss if self._loss_sum is None else self._loss_sum + loss
+        self.global_step += 1
+        if self.global_step % self.log_every == 0:
+            return self.flush()
+
+    def peak_memory_mb(self) -> float:
+        if self.use_cuda:
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        # ru_maxrss is reported in KiB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def flush(self) -> dict:
+        if self._steps == 0:
+            return None
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - self._window_start
+        seconds = dict(self._seconds)
+        for name, events in self._events.items():
+            seconds[name] = seconds.get(name, 0.0) + sum(
+                start.elapsed_time(end) / 1000 for start, end in events
+            )
+        record = {
+            "step": self.global_step,
+            "steps": self._steps,
+            "step_time": elapsed / self._steps,
+            "samples_per_sec": self._samples / elapsed,
+            "image_tokens_per_sec": self._image_tokens / elapsed,
+            "text_tokens_per_sec": self._text_tokens / elapsed,
+            "tokens_per_sec": (self._image_tokens + self._text_tokens) / elapsed,
+            "peak_memory_mb": self.peak_memory_mb(),
+        }
+        for name in self.PHASES:
+            if name in seconds:
+                record[f"{name}_time"] = seconds[name] / self._steps
+        if self._loss_sum is not None:
+            record["loss"] = self._loss_sum.item() / self._steps
+
+        if self.log_file is not None:
+            with open(self.log_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.use_wandb:
+            import wandb
+
+            wandb.log(
+                {f"perf/{k}": v for k, v in record.items()}, step=self.global_step
+            )
+        self._reset()
+        return record
+
+
+def format_record(record: dict) -> str:
+    phases = " ".join(
+        f"{name} {record[f'{name}_time'] * 1000:.1f}ms"
+        for name in StepProfiler.PHASES
+        if f"{name}_time" in record
+    )
+    return (
+        f"Step {record['step']} Loss {record.get('loss', float('nan')):.4f} "
+        f"| {record['samples_per_sec']:.2f} samples/s {record['tokens_per_sec']:.0f} tokens/s "
+        f"| {phases} | peak {record['peak_memory_mb']:.0f}MB"
+    )
+
+
+class StartupTimer:
+    """
+    Wall clock time of the startup phases up to the first training step.
+    Each `mark` closes the phase running since the previous one.
+    """
+
+    def __init__(self, start: float = None):
+        self.start = time.perf_counter() if start is None else start
+        self._last = self.start
+        self.phases = {}
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._last
+        self._last = now
+
+    def report(self) -> dict:
+        return {**self.phases, "total": self._last - self.start}
+
+    def format(self) -> str:
+        phases = " ".join(f"{k} {v:.1f}s" for k, v in self.phases.items())
+        return f"Time to first step {self._last - self.start:.1f}s | {phases}"
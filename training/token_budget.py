@@ -0,0 +1,58 @@
+import gc
+from typing import Callable
+import torch
+
+
+def cuda_peak_memory(device) -> Callable[[], int]:
+    return lambda: torch.cuda.max_memory_allocated(device)
+
+
+def cuda_reset_peak(device) -> Callable[[], None]:
+    def reset():
+        gc.collect()
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+
+    return reset
+
+
+def probe_token_budget(
+    run_step: Callable[[int], None],
+    tokens_per_sample: int,
+    memory_limit: int,
+    peak_memory: Callable[[], int],
+    reset_peak: Callable[[], None] = lambda: None,
+    max_batch_size: int = 256,
+) -> int:
+    """
+    Finds how many tokens fit in one training step. `run_step(batch_size)`
+    runs forward and backward on a batch of the largest bucket; the batch
+    size is doubled until the peak memory passes `memory_limit`, the step
+    runs out of memory or `max_batch_size` is reached. When a probe went over
+    the limit, peak memory is interpolated linearly in the batch size between
+    it and the last probe that fit.
+    """
+    fits, fit_peak, over_peak = 0, None, None
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        reset_peak()
+        try:
+            run_step(batch_size)
+        except torch.cuda.OutOfMemoryError:
+            break
+        peak = peak_memory()
+        if peak > memory_limit:
+            over_peak = peak
+            break
+        fits, fit_peak = batch_size, peak
+        batch_size *= 2
+    reset_peak()
+    if fits == 0:
+        raise RuntimeError(
+            f"A single sample of {tokens_per_sample} tokens does not fit in "
+            f"{memory_limit / 2**30:.1f}GB"
+        )
+    if over_peak is not None and over_peak > fit_peak:
+        per_sample = (over_peak - fit_peak) / (batch_size - fits)
+        fits = min(batch_size - 1, fits + int((memory_limit - fit_peak) / per_sample))
+    return fits * tokens_per_sample